@@ -4,24 +4,85 @@ from __future__ import absolute_import
 import os
 import re
 import json
-from collections import defaultdict
+import time
+import zlib
+import struct
+import tempfile
+import threading
 
 import flask
 import requests
 import urllib3
+from urllib3.util.retry import Retry
+from requests_toolbelt.multipart.encoder import MultipartEncoder, MultipartEncoderMonitor
 
 import octoprint.plugin
-from octoprint.slicing import SlicingProfile
+from octoprint.slicing import SlicingProfile, SlicingCancelled
 from octoprint.util.paths import normalize as normalize_path
 from octoprint.filemanager.destinations import FileDestinations
+from octoprint.filemanager.util import DiskFileWrapper
 
 try:
-    from .profile import Profile
+    from .profile import Profile, ProfileStore
 except:
-    from profile import Profile
+    from profile import Profile, ProfileStore
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# size of the chunks in which the machinecode is written to disk while it is downloaded
+CHUNK_SIZE = 64 * 1024
+# compression level of the models that are uploaded gzip compressed, the fastest one keeps the load on the printer low
+UPLOAD_COMPRESSION_LEVEL = 1
+# factor of the exponential backoff between retries of failed requests, in seconds
+RETRY_BACKOFF_FACTOR = 0.5
+# server errors on which idempotent requests are retried
+RETRY_STATUS_CODES = [502, 503, 504]
+# seconds for which the result of the health check of the PrePrintService is reused while it is up
+HEALTH_CHECK_TTL = 30
+# the health checks of a PrePrintService that is down back off exponentially between these seconds
+HEALTH_CHECK_MIN_BACKOFF = 1
+HEALTH_CHECK_MAX_BACKOFF = 60
+# seconds to wait for the response of a health check, and for the result of the first one
+HEALTH_CHECK_TIMEOUT = 2
+# seconds that the PrePrintService holds a status request of a job back until the job changes
+LONG_POLL_TIMEOUT = 5
+# share of each stage in the overall progress of slicing as (start, end), the stages in between upload and transfer
+# are reported by the PrePrintService
+PROGRESS_STAGES = dict(upload=(0.0, 0.1),
+                       queued=(0.1, 0.1),
+                       preparation=(0.1, 0.12),
+                       preprocessing=(0.12, 0.15),
+                       orientation=(0.15, 0.4),
+                       callback=(0.4, 0.45),
+                       slicing=(0.45, 0.9),
+                       transfer=(0.9, 1.0))
+# header in which the PrePrintService sends the analysis of the machinecode
+ANALYSIS_HEADER = "X-PrePrint-Analysis"
+# the slicers write the analysis comments at the end of the machinecode, which is scanned from this size before its end
+ANALYSIS_TAIL_SIZE = 512 * 1024
+# if no analysis comments are within the tail, the machinecode is scanned forward up to this size
+ANALYSIS_MAX_SCAN = 16 * 1024 * 1024
+# comments with the filament usage, the print time and the layer count of Slic3r and PrusaSlicer
+ANALYSIS_PATTERN = re.compile(
+    rb"^[ \t]*;[ \t]*(?:"
+    rb"filament used[ \t]*=[ \t]*(?P<length>[0-9.]+)[ \t]*mm[ \t]*\((?P<volume>[0-9.]+)cm3\)"
+    rb"|filament used \[(?P<unit>mm|cm3)\][ \t]*=[ \t]*(?P<values>[0-9., \t]+)"
+    rb"|estimated (?P<first_layer>first layer )?printing time[ \t]*(?:\((?P<mode>[^)\r\n]*)\))?[ \t]*=[ \t](?P<time>[^\r\n]*)"
+    rb"|total layers count[ \t]*=[ \t]*(?P<layers>[0-9]+)"
+    rb")", re.MULTILINE)
+PRINT_TIME_PART_PATTERN = re.compile(rb"\s*([0-9.]+)([dhms])")
+PRINT_TIME_UNITS = {b"d": 24 * 60 * 60, b"h": 60 * 60, b"m": 60, b"s": 1}
+# binary STL consists of a header of 80 bytes, the number of facets and the facets of the normal, three vertices and
+# an attribute each
+STL_HEADER_SIZE = 84
+STL_FACET = struct.Struct("<12fH")
+STL_HEADER = b"binary STL rotated by the PrePrintService plugin"
+STL_VERTEX_PATTERN = re.compile(rb"vertex\s+(\S+)\s+(\S+)\s+(\S+)")
+# models are rotated in chunks of this number of facets, which bounds the memory for large models
+STL_CHUNK_FACETS = 16 * 1024
+# ASCII STL is read in chunks of this size, about the same number of facets
+STL_TEXT_CHUNK_SIZE = 4 * 1024 * 1024
+
 
 class PreprintservicePlugin(octoprint.plugin.SlicerPlugin,
                             octoprint.plugin.StartupPlugin,
@@ -31,6 +92,15 @@ class PreprintservicePlugin(octoprint.plugin.SlicerPlugin,
                             octoprint.plugin.TemplatePlugin,
                             octoprint.plugin.EventHandlerPlugin):
 
+    def __init__(self):
+        self._job_lock = threading.Lock()
+        self._slicing_jobs = dict()  # machinecode_path: url of the job on the PrePrintService
+        self._cancelled_jobs = set()
+        self._session_lock = threading.Lock()
+        self._sessions = dict()  # (scheme, host): session with a pool of keep-alive connections
+        self._service_health = ServiceHealth(self._probe_service)
+        self._profiles = ProfileStore()
+
     # ~~ StartupPlugin API
     def on_after_startup(self):
         self._logger.debug("Starting PrePrintService plugin, using settings: {}".format(self._settings.get_all_data()))
@@ -41,6 +111,10 @@ class PreprintservicePlugin(octoprint.plugin.SlicerPlugin,
                     octoprint_url="http://127.0.0.1:5000",  # mode without port is also possible
                     apikey="find API-key under API",
                     tweak_option="tweak_extended_volume_returntweaked",
+                    stall_timeout=600,  # seconds without progress after which a job is aborted, 0 to wait forever
+                    connect_timeout=5,  # seconds to establish a connection to the PrePrintService
+                    read_timeout=120,  # seconds to wait for data of the PrePrintService
+                    retries=3,  # retries of failed idempotent requests, with exponential backoff
                     isurlok=False,
                     default_profile=os.path.join(os.path.dirname(os.path.realpath(__file__)), "profiles", "no_slicing"))
                                                 #  "default_slic3r_profile.ini"))
@@ -84,6 +158,9 @@ class PreprintservicePlugin(octoprint.plugin.SlicerPlugin,
         new_gettweakedstl = self._settings.get_boolean(["get_tweaked_stl"])
         if old_gettweakedstl != new_gettweakedstl:
             self._logger.info("New setting, getting auto-rotated stl is set to: {}".format(new_gettweakedstl))
+        # the sessions are created again with the new settings on their next use
+        self._close_sessions()
+        self._service_health.invalidate()
 
     # ~~ AssetPlugin mixin
 
@@ -201,22 +278,26 @@ class PreprintservicePlugin(octoprint.plugin.SlicerPlugin,
 
     # SlicerPlugin API
     def is_slicer_configured(self):
-        # Try connection to PrePrintService
-        url = self._settings.get(["url"]).strip()
+        """Return if the PrePrintService is reachable. OctoPrint asks this on each refresh of the file list, so the
+        cached result of the health check in the background is returned at once."""
+        return self._service_health.is_ok()
+
+    def _probe_service(self):
+        """Check the connection to the cheap endpoint '/connection' of the PrePrintService."""
+        url = self._get_service_url("/connection")
         if "localhost" in url:
             self._logger.warning("It's risky to set localhost in url, it might not work: {}".format(url))
         try:
-            r = requests.get(url, timeout=2, verify=False)
-            if r.status_code != 200:
-                self._logger.warning(
-                    "Connection to PrePrintService on {} couldn't be established, status code {}".format(url,
-                                                                                                         r.status_code))
-                return False
-        except requests.ConnectionError:
-            self._logger.warning("Connection to PrePrintService on {} couldn't be established".format(url))
+            r = self._get_session(url).get(url, timeout=HEALTH_CHECK_TIMEOUT)
+            r.close()
+        except Exception as e:
+            self._logger.warning("Connection to PrePrintService on {} couldn't be established: {}".format(url, e))
             return False
-        self._logger.info("Connection to PrePrintService on {} is ready, status code {}"
-                          .format(url, r.status_code))
+        if r.status_code != 200:
+            self._logger.warning("Connection to PrePrintService on {} couldn't be established, status code {}"
+                                 .format(url, r.status_code))
+            return False
+        self._logger.debug("Connection to PrePrintService on {} is ready, status code {}".format(url, r.status_code))
         return True
 
     def get_slicer_properties(self):
@@ -224,7 +305,7 @@ class PreprintservicePlugin(octoprint.plugin.SlicerPlugin,
             type="preprintservice",
             name="PrePrintService",
             same_device=False,
-            progress_report=False)
+            progress_report=True)
 
     def get_slicer_default_profile(self):
         self._logger.debug("get_slicer_default_profile")
@@ -260,8 +341,12 @@ class PreprintservicePlugin(octoprint.plugin.SlicerPlugin,
 
         self._logger.info("Return tweaked model: {}".format(self._settings.get(["return_tweaked"])))  # boolean
         tweak_option = self._settings.get(["tweak_option"])  # "tweak_option": "tweak_extended_volume"
-        if self._settings.get(["return_tweaked"]):
-            tweak_option += "_returntweaked"
+        # with tweak_keep, the model isn't rotated and there is no tweaked model to save
+        save_tweaked = self._settings.get(["return_tweaked"]) and tweak_option.startswith("tweak_") \
+            and "_keep" not in tweak_option
+        if save_tweaked:
+            # the PrePrintService returns the orientation instead of uploading the tweaked model, which is rotated here
+            tweak_option += "_returnorientation"
         self._logger.info(f"Using Tweak option: '{tweak_option}'")
         
         # machinecode_path is a string based on a random tmpfile
@@ -275,49 +360,349 @@ class PreprintservicePlugin(octoprint.plugin.SlicerPlugin,
 
         url = self._settings.get(["url"]).strip()
         self._logger.info("Sending file {} and profile {} to {}".format(model_path, profile_path, url))
+        fields = {
+            "machinecode_name": os.path.split(machinecode_path)[-1],
+            "tweak_option": tweak_option,
+            "request_source": "octoprint",
+            "octoprint_url": self._settings.get(["octoprint_url"]).strip(),
+            "apikey": self._settings.get(["apikey"]).strip()
+            # "octoprinturl": self._settings.get(["url"])  # url of the PrePrintService
+        }
+
+        def report(stage, progress=0.0):
+            if on_progress is None:
+                return
+            start, end = PROGRESS_STAGES.get(stage, (0.0, 0.0))
+            progress_kwargs = dict(on_progress_kwargs or dict())
+            progress_kwargs["_progress"] = start + (end - start) * min(max(progress, 0.0), 1.0)
+            on_progress(*(on_progress_args or list()), **progress_kwargs)
+
+        with self._job_lock:
+            self._cancelled_jobs.discard(machinecode_path)
         try:
-            r = requests.post(url,
-                files={
-                    'model': open(model_path, 'rb'),
-                    'profile': open(profile_path, 'rb'), # tmp file
-                },
-                data={
-                    "machinecode_name": os.path.split(machinecode_path)[-1],
-                    "tweak_option": tweak_option,
-                    "request_source": "octoprint",
-                    "octoprint_url": self._settings.get(["octoprint_url"]).strip(),
-                    "apikey": self._settings.get(["apikey"]).strip()
-                    # "octoprinturl": self._settings.get(["url"])  # url of the PrePrintService
-                },
-                verify=False)
-            if r.status_code == 200:
-                self._logger.info(f"Successful response from {url}; writing to {machinecode_path}")
-                with open(machinecode_path, 'wb') as f:
-                    f.write(r.content)
-                self._logger.info(f"Wrote {len(r.content)} bytes to {machinecode_path}")
-            else:
-                raise Exception("Error response from {}; status code {}".format(url, r.status_code))
+            jobs_url = self._get_service_url("/jobs")
+            profile_hash = self._upload_profile(profile_path)
+            r = self._post_model(jobs_url, fields, model_path, profile_path, report, compress=True,
+                                 profile_hash=profile_hash)
+            if self._rejects_compression(r):
+                # the PrePrintService doesn't accept compressed models yet, send it as it is
+                self._logger.info(f"{jobs_url} doesn't accept compressed models, sending it uncompressed")
+                r.close()
+                r = self._post_model(jobs_url, fields, model_path, profile_path, report, profile_hash=profile_hash)
+            if r.status_code in [404, 405]:
+                # the PrePrintService doesn't support jobs yet, fall back to the synchronous API
+                self._logger.info(f"No job API at {jobs_url}, sending the model to {url}")
+                r.close()
+                r = self._post_model(url, fields, model_path, profile_path, report, synchronous=True)
+            elif r.status_code == 202:
+                job_url = self._get_service_url(r.headers["Location"])
+                r.close()
+                self._wait_for_job(job_url, machinecode_path, report)
+                r = self._get_session(job_url).get(job_url + "/result", stream=True, timeout=self._get_timeout())
+            if r.status_code == 400:
+                # e.g. an unknown tweak_option, the message of the PrePrintService tells the user what to change
+                error = self._get_error(r)
+                r.close()
+                raise Exception("The request was rejected by {}: {}".format(r.url, error))
+            self._download(r, machinecode_path, report)
+        except SlicingCancelled:
+            self._logger.info(f"Slicing of {machinecode_path} was cancelled")
+            raise
         except Exception as e:
             self._logger.info(e)
             return False, "Failed to slice via url {}: {}".format(url, e)
 
-        analysis = get_analysis_from_gcode(machinecode_path)
+        analysis = self._get_analysis(r, machinecode_path)
         self._logger.info("Analysis for gcode {}: {}".format(machinecode_path, analysis))
 
         # Setting metadata here prevents errors when calling `has_analysis` and other metadata-fetching functions via filemanager
         self._file_manager.set_additional_metadata(FileDestinations.LOCAL, machinecode_path, "preprintservice", analysis, overwrite=True)
         self._logger.info("Set additional metadata")
+        if save_tweaked:
+            self._save_tweaked_model(model_path, analysis)
 
         return True, {'analysis': analysis} if analysis else None
 
+    def cancel_slicing(self, machinecode_path):
+        with self._job_lock:
+            self._cancelled_jobs.add(machinecode_path)
+            job_url = self._slicing_jobs.get(machinecode_path)
+        if job_url:
+            self._cancel_job(job_url)
+
+    def _get_service_url(self, path):
+        """Return the url of an endpoint of the PrePrintService, based on the configured url of '/tweak'."""
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        url = self._settings.get(["url"]).strip().rstrip("/")
+        if url.endswith("/tweak"):
+            url = url[:-len("/tweak")]
+        return url + path
+
+    def _get_session(self, url):
+        """Return the session for the host of the url, which keeps its connections alive between the requests.
+        Failed connections and idempotent requests that got a server error are retried with exponential backoff."""
+        url = urllib3.util.parse_url(url)
+        key = (url.scheme, url.netloc)
+        with self._session_lock:
+            if key not in self._sessions:
+                retry = Retry(total=self._settings.get_int(["retries"]), backoff_factor=RETRY_BACKOFF_FACTOR,
+                              status_forcelist=RETRY_STATUS_CODES, allowed_methods=["HEAD", "GET", "DELETE"],
+                              raise_on_status=False)
+                session = requests.Session()
+                session.verify = False
+                session.mount("http://", requests.adapters.HTTPAdapter(max_retries=retry))
+                session.mount("https://", requests.adapters.HTTPAdapter(max_retries=retry))
+                self._sessions[key] = session
+            return self._sessions[key]
+
+    def _close_sessions(self):
+        with self._session_lock:
+            sessions, self._sessions = list(self._sessions.values()), dict()
+        for session in sessions:
+            session.close()
+
+    def _get_timeout(self, read_timeout=None):
+        """Return the tuple of the connect and the read timeout of requests to the PrePrintService, 0 waits forever."""
+        if read_timeout is None:
+            read_timeout = self._settings.get_int(["read_timeout"])
+        return self._settings.get_int(["connect_timeout"]) or None, read_timeout or None
+
+    def _upload_profile(self, profile_path):
+        """Make sure that the PrePrintService has the profile in its registry and return the hash to refer to it,
+        or None if the PrePrintService doesn't support profiles by hash, then the profile is sent with the model."""
+        profile_hash = self._profiles.hash(profile_path)
+        url = self._get_service_url("/profiles/{}".format(profile_hash))
+        try:
+            session = self._get_session(url)
+            r = session.head(url, timeout=self._get_timeout())
+            if r.status_code == 404:
+                with open(profile_path, 'rb') as f:
+                    r = session.put(url, data=f, timeout=self._get_timeout())
+        except Exception as e:
+            self._logger.warning(f"Couldn't upload the profile to {url}: {e}")
+            return None
+        if r.status_code not in [200, 201]:
+            self._logger.info(f"No profile registry at {url}, status code {r.status_code}, sending the profile")
+            return None
+        return profile_hash
+
+    def _post_model(self, url, fields, model_path, profile_path, report, compress=False, synchronous=False,
+                    profile_hash=None):
+        """Post the model and the profile as streaming multipart request, which reports the upload progress.
+        If compress is set, the request body is gzip compressed on the fly and sent in chunks. The synchronous API
+        responds once the model is sliced, its response is awaited as long as a stalled job. If the profile_hash is
+        given, the profile is referred to by its hash instead of being sent."""
+        with open(model_path, 'rb') as model_file, open(profile_path, 'rb') as profile_file:
+            if profile_hash:
+                fields = dict(fields, profile_hash=profile_hash)
+            else:
+                fields = dict(fields, profile=(os.path.basename(profile_path), profile_file,
+                                               'application/octet-stream'))  # tmp file
+            encoder = MultipartEncoder(fields=dict(
+                fields,
+                model=(os.path.basename(model_path), model_file, 'application/octet-stream')))
+            monitor = MultipartEncoderMonitor(encoder, lambda m: report("upload", m.bytes_read / max(m.len, 1)))
+            headers = {'Content-Type': monitor.content_type}
+            timeout = self._get_timeout(self._settings.get_int(["stall_timeout"]) if synchronous else None)
+            if compress:
+                headers['Content-Encoding'] = 'gzip'
+                monitor = _gzip_stream(monitor)
+            return self._get_session(url).post(url, data=monitor, headers=headers, stream=True, timeout=timeout)
+
+    def _rejects_compression(self, r):
+        """Return True if the PrePrintService rejected the request r for its compressed body. That is answered with
+        415, or with 400 and a message about the Content-Encoding, other bad requests fail without compression too."""
+        if r.status_code == 415:
+            return True
+        return r.status_code == 400 and "content-encoding" in self._get_error(r).lower()
+
+    @staticmethod
+    def _get_error(r):
+        """Return the error message of the response r, which the PrePrintService sends as JSON string."""
+        try:
+            error = r.json()
+        except ValueError:
+            return r.text.strip()
+        return error if isinstance(error, str) else json.dumps(error)
+
+    def _wait_for_job(self, job_url, machinecode_path, report):
+        """Long-poll the status of the job and relay its progress until it is finished. The job is cancelled on the
+        PrePrintService if the slicing was cancelled in OctoPrint or the job makes no progress for too long."""
+        with self._job_lock:
+            self._slicing_jobs[machinecode_path] = job_url
+        try:
+            stall_timeout = self._settings.get_int(["stall_timeout"])
+            version, last_change = -1, time.time()
+            while True:
+                if machinecode_path in self._cancelled_jobs:
+                    self._cancel_job(job_url)
+                    raise SlicingCancelled()
+                r = self._get_session(job_url).get(job_url, params=dict(wait=LONG_POLL_TIMEOUT, version=version),
+                                                   timeout=self._get_timeout(LONG_POLL_TIMEOUT + 10))
+                if r.status_code != 200:
+                    raise Exception("Error response from {}; status code {}".format(job_url, r.status_code))
+                job = r.json()
+                if job["version"] != version:
+                    version, last_change = job["version"], time.time()
+                    report(job["stage"], job["progress"])
+                    self._logger.debug(f"Job {job_url} is {job['status']} in stage {job['stage']}: {job['progress']}")
+                if job["status"] == "finished":
+                    return job
+                elif job["status"] in ["failed", "cancelled"]:
+                    raise Exception("Job {} {}: {}".format(job_url, job["status"], job["error"]))
+                elif stall_timeout and time.time() - last_change > stall_timeout:
+                    self._cancel_job(job_url)
+                    raise Exception("Job {} made no progress in stage {} for {} s".format(
+                        job_url, job["stage"], stall_timeout))
+        finally:
+            with self._job_lock:
+                self._slicing_jobs.pop(machinecode_path, None)
+
+    def _cancel_job(self, job_url):
+        try:
+            self._get_session(job_url).delete(job_url, timeout=self._get_timeout(10))
+            self._logger.info(f"Cancelled job {job_url}")
+        except requests.RequestException as e:
+            self._logger.warning(f"Couldn't cancel job {job_url}: {e}")
+
+    def _get_analysis(self, r, machinecode_path):
+        """Return the analysis that the PrePrintService sent along with the machinecode, older versions of the
+        PrePrintService don't send it, then the analysis is extracted from the machinecode."""
+        header = r.headers.get(ANALYSIS_HEADER)
+        if isinstance(header, str):
+            try:
+                return json.loads(header)
+            except ValueError:
+                self._logger.warning("Got an invalid analysis from the PrePrintService: {}".format(header))
+        return get_analysis_from_gcode(machinecode_path)
+
+    def _download(self, r, machinecode_path, report):
+        """Write the body of the streamed response r to machinecode_path chunk by chunk. A compressed body is
+        decompressed while it is streamed, the progress is then based on the received compressed bytes."""
+        try:
+            if r.status_code != 200:
+                raise Exception("Error response from {}; status code {}".format(r.url, r.status_code))
+            self._logger.info(f"Successful response from {r.url}; writing to {machinecode_path}")
+            size = int(r.headers.get("Content-Length") or 0)
+            encoding = r.headers.get("Content-Encoding")
+            written = 0
+            with open(machinecode_path, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+                    written += len(chunk)
+                    if size:
+                        report("transfer", (r.raw.tell() if encoding else written) / size)
+            report("transfer", 1.0)
+            if encoding:
+                self._logger.info(f"Wrote {written} bytes to {machinecode_path}, received {size} bytes in {encoding}")
+            else:
+                self._logger.info(f"Wrote {written} bytes to {machinecode_path}")
+        finally:
+            r.close()
+
+    def _save_tweaked_model(self, model_path, analysis):
+        """Rotate the model by the orientation that the PrePrintService sent along with the machinecode and add it
+        next to the model. Older versions of the PrePrintService upload the tweaked model themselves."""
+        orientation = (analysis or dict()).get("orientation")
+        if not orientation or not orientation.get("matrix"):
+            self._logger.info("Got no orientation from the PrePrintService, the tweaked model isn't saved")
+            return
+        name = os.path.splitext(os.path.basename(model_path))[0].split(".tmp.")[0] + "_tweaked.stl"
+        fd, tmp_path = tempfile.mkstemp(suffix=".stl")
+        os.close(fd)
+        try:
+            rotate_stl(model_path, tmp_path, orientation["matrix"])
+            folder = self._storage_folder(model_path)
+            path = self._file_manager.join_path(FileDestinations.LOCAL, folder, name) if folder else name
+            self._file_manager.add_file(FileDestinations.LOCAL, path, DiskFileWrapper(name, tmp_path, move=True),
+                                        allow_overwrite=True)
+            self._logger.info(f"Saved the tweaked model {name}")
+        except Exception as e:
+            self._logger.warning(f"Couldn't save the tweaked model {name}: {e}")
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _storage_folder(self, model_path):
+        """Return the folder of the model in the local storage, or the root folder if the model isn't stored there.
+        The machinecode is written to a temporary file while slicing, so its path tells nothing about the folder."""
+        storage_path = self._file_manager.path_in_storage(FileDestinations.LOCAL, model_path)
+        if os.path.normpath(self._file_manager.path_on_disk(FileDestinations.LOCAL, storage_path)) != \
+                os.path.normpath(model_path):
+            return ""
+        return os.path.dirname(storage_path)
+
     def _load_profile(self, path):
-        profile, display_name, description = Profile.from_slic3r_ini(path)
+        profile, display_name, description = self._profiles.load(path)
         return profile, display_name, description
 
     def _save_profile(self, path, profile, allow_overwrite=True, display_name=None, description=None):
         if not allow_overwrite and os.path.exists(path):
             raise IOError("Cannot overwrite {path}".format(path=path))
-        Profile.to_slic3r_ini(profile, path, display_name=display_name, description=description)
+        self._profiles.save(profile, path, display_name=display_name, description=description)
+
+
+class ServiceHealth:
+    """Run the health check of the PrePrintService periodically in a background thread and cache its result. While
+    the service is up, it is checked every HEALTH_CHECK_TTL seconds, while it is down, the checks back off
+    exponentially up to HEALTH_CHECK_MAX_BACKOFF seconds."""
+
+    def __init__(self, probe):
+        self._probe = probe
+        self._cond = threading.Condition()
+        self._ok = False
+        self._checked = False
+        self._invalidated = False
+        self._stopped = False
+        self._thread = None
+        self._backoff = HEALTH_CHECK_MIN_BACKOFF
+
+    def is_ok(self):
+        """Return the result of the last health check, only the very first call waits for the check."""
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="PrePrintService health check", daemon=True)
+                self._thread.start()
+            if not self._checked:
+                self._cond.wait_for(lambda: self._checked, timeout=HEALTH_CHECK_TIMEOUT)
+            return self._ok
+
+    def invalidate(self):
+        """Check the health again at once, e.g. after the url was changed."""
+        with self._cond:
+            self._invalidated = True
+            self._backoff = HEALTH_CHECK_MIN_BACKOFF
+            self._cond.notify_all()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            ok = self._probe()
+            with self._cond:
+                self._ok, self._checked, self._invalidated = ok, True, False
+                self._cond.notify_all()
+                if ok:
+                    delay, self._backoff = HEALTH_CHECK_TTL, HEALTH_CHECK_MIN_BACKOFF
+                else:
+                    delay, self._backoff = self._backoff, min(self._backoff * 2, HEALTH_CHECK_MAX_BACKOFF)
+                self._cond.wait_for(lambda: self._invalidated or self._stopped, timeout=delay)
+                if self._stopped:
+                    return
+
+
+def _gzip_stream(reader, level=UPLOAD_COMPRESSION_LEVEL):
+    """Yield the content of the file-like reader gzip compressed in chunks."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # with gzip header and trailer
+    for chunk in iter(lambda: reader.read(CHUNK_SIZE), b""):
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
 
 
 def _sanitize_name(name):
@@ -344,44 +729,136 @@ def get_host_ip_address():
     return ip_address
 
 
+def _parse_print_time(time_text):
+    """Return the seconds of a print time like '1d 2h 3m 4s'."""
+    printing_seconds = 0
+    for time_part in time_text.split(b" "):
+        m = PRINT_TIME_PART_PATTERN.match(time_part)
+        if m:
+            printing_seconds += float(m.group(1)) * PRINT_TIME_UNITS[m.group(2)]
+    return printing_seconds
+
+
+def _scan_analysis(block, analysis):
+    """Apply the analysis comments found in the block of G-code to the analysis, return if any was found."""
+    found = False
+    slic3r_tool = 0
+    for m in ANALYSIS_PATTERN.finditer(block):
+        found = True
+        filament = analysis["filament"]
+        if m.group("length"):
+            # Slic3r writes one line per extruder, e.g. "; filament used = 5mm (3cm3)"
+            filament["tool{}".format(slic3r_tool)] = dict(length=float(m.group("length")), volume=float(m.group("volume")))
+            slic3r_tool += 1
+        elif m.group("unit"):
+            # PrusaSlicer writes one line per unit with a value per extruder, e.g. "; filament used [mm] = 5.2, 0.0"
+            key = "length" if m.group("unit") == b"mm" else "volume"
+            values = [v for v in m.group("values").replace(b" ", b"").split(b",") if v]
+            for i, value in enumerate(values):
+                filament.setdefault("tool{}".format(i), dict(length=-1, volume=-1))[key] = float(value)
+        elif m.group("time") is not None:
+            mode = m.group("mode").decode("utf-8") if m.group("mode") else "default"
+            if m.group("first_layer"):
+                mode = "first layer ({})".format(mode)
+            analysis.setdefault("estimatedPrintTimes", dict())[mode] = _parse_print_time(m.group("time").strip())
+        elif m.group("layers"):
+            analysis["layerCount"] = int(m.group("layers"))
+    return found
+
+
+def _iter_stl_vertices(model_path):
+    """Yield the vertices of the ASCII or binary STL as lists of (x, y, z), three per facet, in chunks of about
+    STL_CHUNK_FACETS facets. The facets of ASCII STL may be split across the chunks."""
+    size = os.path.getsize(model_path)
+    with open(model_path, "rb") as f:
+        data = f.read(STL_HEADER_SIZE)
+        # binary files may start with 'solid' too, their size decides
+        if len(data) == STL_HEADER_SIZE and size == STL_HEADER_SIZE + struct.unpack_from("<I", data, 80)[0] * STL_FACET.size:
+            for chunk in iter(lambda: f.read(STL_CHUNK_FACETS * STL_FACET.size), b""):
+                yield [facet[i:i + 3] for facet in STL_FACET.iter_unpack(chunk) for i in (3, 6, 9)]
+            return
+        while data:
+            more = f.read(STL_TEXT_CHUNK_SIZE)
+            # only whole lines are parsed, the last one may continue in the next chunk
+            end = data.rfind(b"\n") + 1 if more else len(data)
+            yield [tuple(float(v) for v in m.groups()) for m in STL_VERTEX_PATTERN.finditer(data, 0, end)]
+            data = data[end:] + more
+
+
+def _read_stl_vertices(model_path):
+    """Return the vertices of the ASCII or binary STL as list of (x, y, z), three per facet."""
+    return [vertex for vertices in _iter_stl_vertices(model_path) for vertex in vertices]
+
+
+def rotate_stl(model_path, output_path, matrix):
+    """Write the STL model rotated by the matrix of the orientation of the PrePrintService as binary STL. The matrix
+    is applied to row vectors as vertices @ matrix, like the PrePrintService and Tweaker-3 do. The model is read,
+    rotated and written in chunks, so that large models don't need to fit into memory."""
+    (a, b, c), (d, e, f), (g, h, i) = matrix
+    pack = STL_FACET.pack
+    count = 0
+    vertices = list()
+    with open(output_path, "wb") as out:
+        out.write(STL_HEADER.ljust(80, b" "))
+        out.write(struct.pack("<I", 0))  # the number of facets is written once they are counted
+        for chunk in _iter_stl_vertices(model_path):
+            vertices.extend(chunk)
+            end = len(vertices) - len(vertices) % 3  # the rest of a split facet is rotated with the next chunk
+            facets = list()
+            for k in range(0, end, 3):
+                (x0, y0, z0), (x1, y1, z1), (x2, y2, z2) = vertices[k], vertices[k + 1], vertices[k + 2]
+                x0, y0, z0 = x0 * a + y0 * d + z0 * g, x0 * b + y0 * e + z0 * h, x0 * c + y0 * f + z0 * i
+                x1, y1, z1 = x1 * a + y1 * d + z1 * g, x1 * b + y1 * e + z1 * h, x1 * c + y1 * f + z1 * i
+                x2, y2, z2 = x2 * a + y2 * d + z2 * g, x2 * b + y2 * e + z2 * h, x2 * c + y2 * f + z2 * i
+                u0, u1, u2 = x1 - x0, y1 - y0, z1 - z0
+                v0, v1, v2 = x2 - x0, y2 - y0, z2 - z0
+                n0, n1, n2 = u1 * v2 - u2 * v1, u2 * v0 - u0 * v2, u0 * v1 - u1 * v0
+                length = (n0 * n0 + n1 * n1 + n2 * n2) ** 0.5 or 1.0
+                facets.append(pack(n0 / length, n1 / length, n2 / length, x0, y0, z0, x1, y1, z1, x2, y2, z2, 0))
+            out.write(b"".join(facets))
+            count += len(facets)
+            del vertices[:end]
+        if vertices or not count:
+            raise ValueError("The model {} is no valid STL".format(model_path))
+        out.seek(80)
+        out.write(struct.pack("<I", count))
+
+
 def get_analysis_from_gcode(machinecode_path):
     """Extracts the analysis data structure from the gocde.
     The analysis structure should look like this:
     http://docs.octoprint.org/en/master/modules/filemanager.html#octoprint.filemanager.analysis.GcodeAnalysisQueue
     (There is a bug in the documentation, estimatedPrintTime should be in seconds.)
-    Return None if there is no analysis information in the file and return -1 for each value if the file is empty
+    Return -1 for each value if the file is empty or has no analysis information. If the slicer wrote them, the
+    filament of further extruders, the 'layerCount' and the 'estimatedPrintTimes' per mode are added.
+    The slicers write the analysis comments at the end, so only the tail of the file is scanned. If nothing is found
+    there, the file is scanned forward up to ANALYSIS_MAX_SCAN bytes.
     """
-    dd = lambda: defaultdict(dd)
-    analysis = dd()
+    analysis = dict(filament=dict(tool0=dict(length=-1, volume=-1)), estimatedPrintTime=-1)
     try:
-        analysis['filament']['tool0']['length'] = -1
-        analysis['filament']['tool0']['volume'] = -1
-        analysis['estimatedPrintTime'] = -1
-        printing_seconds = -1
-        with open(machinecode_path, 'r') as f:
-            for gcode_line in f:
-                m = re.match('\s*;\s*filament used\s*=\s*([0-9.]+)\s*mm\s*\(([0-9.]+)cm3\)\s*', gcode_line)
-                if m:
-                    analysis['filament']['tool0']['length'] = float(m.group(1))
-                    analysis['filament']['tool0']['volume'] = float(m.group(2))
-                m = re.match('\s*;\s*estimated printing time\s*=\s(.*)\s*', gcode_line)
-                if m:
-                    time_text = m.group(1)
-                    # Now extract the days, hours, minutes, and seconds
-                    printing_seconds = 0
-                    for time_part in time_text.split(' '):
-                        for unit in [("h", 60 * 60),
-                                     ("m", 60),
-                                     ("s", 1),
-                                     ("d", 24 * 60 * 60)]:
-                            m = re.match('\s*([0-9.]+)' + re.escape(unit[0]), time_part)
-                            if m:
-                                printing_seconds += float(m.group(1)) * unit[1]
-        analysis['estimatedPrintTime'] = printing_seconds
+        with open(machinecode_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            f.seek(max(0, size - ANALYSIS_TAIL_SIZE))
+            found = _scan_analysis(f.read(ANALYSIS_TAIL_SIZE), analysis)
+            if not found and size > ANALYSIS_TAIL_SIZE:
+                f.seek(0)
+                rest = b""
+                for chunk in iter(lambda: f.read(CHUNK_SIZE * 16), b""):
+                    # scan whole lines only, the rest is prepended to the next chunk
+                    block, _, rest = (rest + chunk).rpartition(b"\n")
+                    if _scan_analysis(block, analysis) or f.tell() >= min(size - ANALYSIS_TAIL_SIZE, ANALYSIS_MAX_SCAN):
+                        break
     except (TypeError, IOError) as e:
         # empty file was uploaded
         print("Could not resolve analysis from file", machinecode_path, " (not found)")
-    return json.loads(json.dumps(analysis))  # We need to be strict about our return type, unfortunately.
+    times = analysis.get("estimatedPrintTimes", dict())
+    for mode in ["default", "normal mode"] + sorted(times):
+        if mode in times and not mode.startswith("first layer"):
+            analysis["estimatedPrintTime"] = times[mode]
+            break
+    if list(times) == ["default"]:
+        del analysis["estimatedPrintTimes"]  # nothing beyond estimatedPrintTime
+    return analysis
 
 
 # If you want your plugin to be registered within OctoPrint under a different name than what you defined in setup.py
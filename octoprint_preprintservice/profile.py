@@ -5,8 +5,12 @@ __author__ = "Javier Martínez Arrieta <martinezarrietajavier@gmail.com>, Eyal S
 __license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
 __copyright__ = "Copyright (C) 2014 The OctoPrint Project - Released under terms of the AGPLv3 License"
 
-import logging
+import io
+import os
 import re
+import hashlib
+import logging
+import threading
 
 class GcodeFlavors(object):
 	REPRAP = "reprap"
@@ -43,51 +47,62 @@ class Profile(object):
 
 	@classmethod
 	def from_slic3r_ini(cls, path):
-		import os
 		if not os.path.exists(path) or not os.path.isfile(path):
 			return None
 
+		with open(path) as f:
+			return cls.parse_slic3r_ini(f.read())
+
+	@classmethod
+	def parse_slic3r_ini(cls, text):
+		"""Return the dict of the settings, the display name and the description of the profile in text."""
 		result = dict()
 		display_name = None
 		description = None
-		with open(path) as f:
-			for line in f:
-				if "#" in line:
-					if line.startswith("# Name: "):
-						display_name = line[len("# Name: "):]
-					elif line.startswith("# Description: "):
-						description = line[len("# Description: "):]
-				split_line = line.split("=", 1)
-				if len(split_line) != 2:
-					continue
-				key, v = map(str.strip, split_line)
-				# Only strip the comment if it's really a comment.
-				# Sometimes the parameter's value includes a #,
-				# for example, color.
-				if "#" in v and str.strip(v[0:v.find("#")]):
-					v = str.strip(v[0:v.find("#")])
-
-				result[key] = v
+		for line in io.StringIO(text, newline=None):
+			if "#" in line:
+				if line.startswith("# Name: "):
+					display_name = line[len("# Name: "):]
+				elif line.startswith("# Description: "):
+					description = line[len("# Description: "):]
+			split_line = line.split("=", 1)
+			if len(split_line) != 2:
+				continue
+			key, v = map(str.strip, split_line)
+			# Only strip the comment if it's really a comment.
+			# Sometimes the parameter's value includes a #,
+			# for example, color.
+			if "#" in v and str.strip(v[0:v.find("#")]):
+				v = str.strip(v[0:v.find("#")])
+
+			result[key] = v
 
 		return result, display_name, description
 
 	@classmethod
 	def to_slic3r_ini(cls, profile, path, display_name=None, description=None):
 		with open(path, "w") as f:
-			if display_name is not None:
-				f.write("# Name: " + display_name + "\n")
-			if description is not None:
-				f.write("# Description: " + description + "\n")
-			for key in sorted(profile.keys()):
-				if key.startswith("_"):
-					continue
-
-				value = profile[key]
-				if isinstance(value, bool):
-					value = "true" if value else "false"
-				elif isinstance(value, (tuple, list)):
-					value = ",".join(map(str, value))
-				f.write(key + " = " + str(value) + "\n")
+			f.write(cls.render_slic3r_ini(profile, display_name=display_name, description=description))
+
+	@classmethod
+	def render_slic3r_ini(cls, profile, display_name=None, description=None):
+		"""Return the profile in the format of a Slic3r ini file."""
+		lines = list()
+		if display_name is not None:
+			lines.append("# Name: " + display_name + "\n")
+		if description is not None:
+			lines.append("# Description: " + description + "\n")
+		for key in sorted(profile.keys()):
+			if key.startswith("_"):
+				continue
+
+			value = profile[key]
+			if isinstance(value, bool):
+				value = "true" if value else "false"
+			elif isinstance(value, (tuple, list)):
+				value = ",".join(map(str, value))
+			lines.append(key + " = " + str(value) + "\n")
+		return "".join(lines)
 
 	def __init__(self, profile, printer_profile, posX, posY, overrides=None):
 		self._profile = profile
@@ -121,3 +136,60 @@ class Profile(object):
 				return self._profile[key]
 			else:
 				return None
+
+
+class ProfileStore(object):
+	"""Cache of the parsed Slic3r profiles by their path. An entry is valid as long as the mtime and the size of the
+	file are unchanged, profiles saved via the store are invalidated at once. Each entry holds the SHA-256 hash of the
+	content of the file, which identifies the profile on the PrePrintService."""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._entries = dict()  # path: (mtime_ns, size, sha256, (profile, display_name, description))
+
+	def _get(self, path):
+		try:
+			stat = os.stat(path)
+		except OSError:
+			stat = None
+		if stat is None or not os.path.isfile(path):
+			self.invalidate(path)
+			return None
+		with self._lock:
+			entry = self._entries.get(path)
+		if entry is not None and entry[:2] == (stat.st_mtime_ns, stat.st_size):
+			return entry
+		with open(path, "rb") as f:
+			data = f.read()
+		parsed = Profile.parse_slic3r_ini(data.decode("utf-8"))
+		entry = (stat.st_mtime_ns, stat.st_size, hashlib.sha256(data).hexdigest(), parsed)
+		with self._lock:
+			self._entries[path] = entry
+		return entry
+
+	def load(self, path):
+		"""Return the settings, the display name and the description of the profile like Profile.from_slic3r_ini,
+		the settings are a copy that may be changed."""
+		entry = self._get(path)
+		if entry is None:
+			return None
+		profile, display_name, description = entry[3]
+		return dict(profile), display_name, description
+
+	def hash(self, path):
+		"""Return the SHA-256 hash of the content of the profile, or None if it doesn't exist."""
+		entry = self._get(path)
+		return entry[2] if entry is not None else None
+
+	def save(self, profile, path, display_name=None, description=None):
+		"""Write the profile like Profile.to_slic3r_ini, an unchanged profile isn't rewritten."""
+		data = Profile.render_slic3r_ini(profile, display_name=display_name, description=description).encode("utf-8")
+		if self.hash(path) == hashlib.sha256(data).hexdigest():
+			return
+		with open(path, "wb") as f:
+			f.write(data)
+		self.invalidate(path)
+
+	def invalidate(self, path):
+		with self._lock:
+			self._entries.pop(path, None)
@@ -1,11 +1,21 @@
+import octoprint_preprintservice
 from octoprint_preprintservice import PreprintservicePlugin, get_analysis_from_gcode
+from octoprint_preprintservice.profile import Profile, ProfileStore
 import unittest
+import gzip
+import hashlib
 import json
+import time
+import itertools
+import os
+import struct
+import tracemalloc
 from unittest.mock import MagicMock, patch, PropertyMock, ANY
 import tempfile
 from requests import Response, ConnectionError as CE
+from requests_toolbelt.multipart.encoder import MultipartEncoderMonitor
 from pathlib import Path
-from octoprint.slicing import SlicingProfile
+from octoprint.slicing import SlicingProfile, SlicingCancelled
 import logging
 
 logging.basicConfig(level=logging.DEBUG)
@@ -16,9 +26,14 @@ class TestService(unittest.TestCase):
     def setUp(self):
         self.p = PreprintservicePlugin()
         self.p._settings = MagicMock()
+        self.p._settings.get.return_value = "setting"
+        self.p._settings.get_int.return_value = 0
         self.p._file_manager = MagicMock()
         self.p._slicing_manager = MagicMock()
         self.p._logger = logging.getLogger()
+        # the requests of the sessions go to the patched module requests
+        self.p._get_session = lambda url: octoprint_preprintservice.requests
+        self.addCleanup(self.p._service_health.stop)
         td = tempfile.TemporaryDirectory()
         self.addCleanup(td.cleanup)
         self.d = Path(td.name)
@@ -115,12 +130,12 @@ class TestService(unittest.TestCase):
         preq.get.side_effect = CE()
         self.assertFalse(self.p.is_slicer_configured())
 
-    @patch('octoprint_preprintservice.Profile')
-    def testGetSlicerDefaultProfile(self, prof):
+    def testGetSlicerDefaultProfile(self):
         # Also implicitly tests get_slicer_profile
         self.p._settings.get.return_value = "testpath"
-        prof.from_slic3r_ini.return_value = (dict(foo="bar"), "imported.ini", "description")
+        self.p._profiles = MagicMock(**{"load.return_value": (dict(foo="bar"), "imported.ini", "description")})
         ret = self.p.get_slicer_default_profile()
+        self.p._profiles.load.assert_called_with("testpath")
         self.assertEqual(ret.slicer, 'preprintservice')
         self.assertEqual(ret.name, 'unknown')
         self.assertEqual(ret.display_name, 'imported.ini')
@@ -139,19 +154,289 @@ class TestService(unittest.TestCase):
             with open(f.name, 'r') as f2:
                 self.assertEqual(f2.read(), "# Name: foo\n# Description: description\n")
 
+    def testProfileStoreCachesParsedProfiles(self):
+        store = ProfileStore()
+        path = str(self.d / 'cached.ini')
+        with open(path, 'w') as f:
+            f.write("# Name: cached\nlayer_height = 0.2\ncolor = #FF0000\n")
+        with patch.object(Profile, 'parse_slic3r_ini', wraps=Profile.parse_slic3r_ini) as parse:
+            profile, display_name, description = store.load(path)
+            self.assertEqual(profile, dict(layer_height="0.2", color="#FF0000"))
+            self.assertEqual((display_name, description), ("cached\n", None))
+            self.assertEqual(store.load(path), (profile, display_name, description))
+            profile["layer_height"] = "0.3"  # the cached profile is a copy
+            self.assertEqual(store.load(path)[0]["layer_height"], "0.2")
+            self.assertEqual(parse.call_count, 1)
+            with open(path, 'a') as f:
+                f.write("fill_density = 20%\n")
+            self.assertEqual(store.load(path)[0]["fill_density"], "20%")
+            self.assertEqual(parse.call_count, 2)
+        self.assertEqual(store.load(path), Profile.from_slic3r_ini(path))
+        self.assertIsNone(store.load(str(self.d / 'missing.ini')))
+
+    def testProfileStoreHashAndSave(self):
+        store = ProfileStore()
+        path = str(self.d / 'saved.ini')
+        store.save(dict(layer_height=0.2, _internal="x"), path, display_name="saved")
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.assertEqual(data, b"# Name: saved\nlayer_height = 0.2\n")
+        self.assertEqual(store.hash(path), hashlib.sha256(data).hexdigest())
+        mtime = Path(path).stat().st_mtime_ns
+        store.save(dict(layer_height=0.2), path, display_name="saved")  # unchanged, not rewritten
+        self.assertEqual(Path(path).stat().st_mtime_ns, mtime)
+        store.save(dict(layer_height=0.3), path, display_name="saved")
+        self.assertEqual(store.load(path)[0], dict(layer_height="0.3"))
+        self.assertNotEqual(store.hash(path), hashlib.sha256(data).hexdigest())
+
     @patch('octoprint_preprintservice.requests')
     def testIsSlicerConfiguredBadResponse(self, preq):
         preq.get.return_value = MagicMock(status_code=500)
         self.assertFalse(self.p.is_slicer_configured())
 
+    @patch('octoprint_preprintservice.requests')
+    def testIsSlicerConfiguredIsCached(self, preq):
+        self.p._settings.get.return_value = "http://service/tweak"
+        preq.get.return_value = MagicMock(status_code=200)
+        self.assertTrue(self.p.is_slicer_configured())
+        preq.get.return_value = MagicMock(status_code=500)
+        self.assertTrue(self.p.is_slicer_configured())
+        self.assertEqual(preq.get.call_count, 1)
+        self.assertEqual(preq.get.call_args[0][0], "http://service/connection")
+
+    @patch('octoprint_preprintservice.HEALTH_CHECK_MAX_BACKOFF', 0.04)
+    @patch('octoprint_preprintservice.HEALTH_CHECK_MIN_BACKOFF', 0.01)
+    def testServiceHealthBacksOff(self):
+        probes = list()
+        def probe():
+            probes.append(time.time())
+            return len(probes) > 5
+        health = octoprint_preprintservice.ServiceHealth(probe)
+        self.addCleanup(health.stop)
+        self.assertFalse(health.is_ok())
+        time.sleep(0.5)
+        self.assertTrue(health.is_ok())
+        self.assertEqual(len(probes), 6)
+        delays = [b - a for a, b in zip(probes, probes[1:])]
+        self.assertGreaterEqual(delays[1], 0.02)
+        self.assertGreaterEqual(delays[-1], 0.04)
+        health.invalidate()
+        time.sleep(0.1)
+        self.assertEqual(len(probes), 7)
+
+    def testSessionIsPooledPerHost(self):
+        self.p._settings.get_int.return_value = 3
+        session = PreprintservicePlugin._get_session(self.p, "http://service:2304/jobs")
+        self.assertIs(PreprintservicePlugin._get_session(self.p, "http://service:2304/jobs/1/result"), session)
+        self.assertIsNot(PreprintservicePlugin._get_session(self.p, "http://other:2304/jobs"), session)
+        self.assertFalse(session.verify)
+        retry = session.get_adapter("http://service:2304/jobs").max_retries
+        self.assertEqual(retry.total, 3)
+        self.assertNotIn("POST", retry.allowed_methods)
+        self.p._close_sessions()
+        self.assertIsNot(PreprintservicePlugin._get_session(self.p, "http://service:2304/jobs"), session)
+
+    @patch('octoprint_preprintservice.requests')
+    def testSliceUsesTimeouts(self, preq):
+        settings = dict(connect_timeout=5, read_timeout=120, stall_timeout=600)
+        self.p._settings.get_int.side_effect = lambda path: settings[path[0]]
+        self.mockJob(preq, ("finished", "slicing", 1.0))
+        self.p.do_slice(*self.slice_args)
+        self.assertEqual(preq.post.call_args[1]['timeout'], (5, 120))
+        self.assertEqual(preq.get.call_args_list[0][1]['timeout'], (5, 15))  # long-polling
+        self.assertEqual(preq.get.call_args_list[-1][1]['timeout'], (5, 120))
+
+    def mockJob(self, preq, *states, result=(b"test", b"response")):
+        preq.post.return_value = MagicMock(status_code=202, headers={"Location": "/jobs/1"})
+        responses = [MagicMock(status_code=200, **{"json.return_value": dict(
+            status=status, stage=stage, progress=progress, version=version, error=None)})
+            for version, (status, stage, progress) in enumerate(states)]
+        responses.append(MagicMock(status_code=200, headers={"Content-Length": "12"},
+                                   **{"iter_content.return_value": list(result)}))
+        preq.get.side_effect = responses
+        return responses
+
     @patch('octoprint_preprintservice.requests')
     def testSliceSuccessful(self, preq):
-        preq.post.return_value = MagicMock(status_code=200, content=b"testresponse")
+        self.p._settings.get.return_value = "http://service/tweak"
+        responses = self.mockJob(preq, ("running", "slicing", 0.5), ("finished", "slicing", 1.0))
+        ok, analysis = self.p.do_slice(*self.slice_args)
+        self.assertEqual(ok, True)
+        with open(self.d / 'dest.gcode', 'r') as f:
+            self.assertEqual(f.read(), "testresponse")
+        self.assertEqual(preq.post.call_args[0][0], "http://service/jobs")
+        self.assertEqual(preq.get.call_args_list[0][0][0], "http://service/jobs/1")
+        self.assertEqual(preq.get.call_args_list[-1][0][0], "http://service/jobs/1/result")
+        responses[-1].close.assert_called()
+
+    @patch('octoprint_preprintservice.requests')
+    def testSliceUsesAnalysisOfService(self, preq):
+        responses = self.mockJob(preq, ("finished", "slicing", 1.0))
+        analysis = {'estimatedPrintTime': 60.0, 'filament': {'tool0': {'length': 5.0, 'volume': 3.0}}, 'layerCount': 10}
+        responses[-1].headers["X-PrePrint-Analysis"] = json.dumps(analysis)
+        ok, result = self.p.do_slice(*self.slice_args)
+        self.assertEqual(result, {'analysis': analysis})
+        self.p._file_manager.set_additional_metadata.assert_called_with(
+            ANY, str(self.d / 'dest.gcode'), "preprintservice", analysis, overwrite=True)
+
+    @patch('octoprint_preprintservice.requests')
+    def testSliceReportsProgress(self, preq):
+        self.mockJob(preq, ("queued", "queued", 0.0), ("running", "orientation", 0.0),
+                     ("running", "slicing", 0.5), ("finished", "slicing", 1.0))
+        on_progress = MagicMock()
+        self.p.do_slice(*self.slice_args, on_progress=on_progress, on_progress_args=["arg"],
+                        on_progress_kwargs=dict(kwarg="kwarg"))
+        progress = [c[1]["_progress"] for c in on_progress.call_args_list]
+        self.assertEqual(progress, sorted(progress))
+        self.assertEqual(progress[-1], 1.0)
+        self.assertIn(0.675, progress)  # half of the slicing stage
+        on_progress.assert_called_with("arg", kwarg="kwarg", _progress=1.0)
+
+    @patch('octoprint_preprintservice.requests')
+    def testSliceFallsBackToSynchronousApi(self, preq):
+        self.p._settings.get.return_value = "http://service/tweak"
+        preq.post.side_effect = [MagicMock(status_code=404),
+                                 MagicMock(status_code=200, headers={},
+                                           **{"iter_content.return_value": [b"test", b"response"]})]
+        ok, analysis = self.p.do_slice(*self.slice_args)
+        self.assertEqual(ok, True)
+        self.assertEqual(preq.post.call_args[0][0], "http://service/tweak")
+        with open(self.d / 'dest.gcode', 'r') as f:
+            self.assertEqual(f.read(), "testresponse")
+
+    @patch('octoprint_preprintservice.requests')
+    def testSliceStreamsUploadAndDownload(self, preq):
+        self.mockJob(preq, ("finished", "slicing", 1.0))
+        bodies = list()
+        response = preq.post.return_value
+        def post(url, data=None, **kwargs):
+            bodies.append(b"".join(data))  # the files are read while posting
+            return response
+        preq.post.side_effect = post
+        self.p.do_slice(*self.slice_args)
+        kwargs = preq.post.call_args[1]
+        self.assertTrue(kwargs['stream'])
+        self.assertEqual(kwargs['headers']['Content-Encoding'], 'gzip')
+        self.assertTrue(kwargs['headers']['Content-Type'].startswith('multipart/form-data; boundary='))
+        body = gzip.decompress(bodies[0])
+        self.assertIn(b'filename="src.gcode"', body)
+        self.assertIn(b'testgcode', body)
+        self.assertIn(b'dest.gcode', body)
+        self.assertTrue(preq.get.call_args[1]['stream'])
+
+    @patch('octoprint_preprintservice.requests')
+    def testSliceRefersToProfileByHash(self, preq):
+        self.p._settings.get.return_value = "http://service/tweak"
+        self.mockJob(preq, ("finished", "slicing", 1.0))
+        preq.head.return_value = MagicMock(status_code=404)
+        preq.put.return_value = MagicMock(status_code=201)
+        bodies = list()
+        response = preq.post.return_value
+        def post(url, data=None, **kwargs):
+            bodies.append(gzip.decompress(b"".join(data)))
+            return response
+        preq.post.side_effect = post
+        ok, analysis = self.p.do_slice(*self.slice_args)
+        self.assertEqual(ok, True)
+        profile_hash = hashlib.sha256(b"testprofile").hexdigest()
+        self.assertEqual(preq.head.call_args[0][0], "http://service/profiles/" + profile_hash)
+        self.assertEqual(preq.put.call_args[0][0], "http://service/profiles/" + profile_hash)
+        self.assertIn(profile_hash.encode(), bodies[0])
+        self.assertNotIn(b"testprofile", bodies[0])
+
+    @patch('octoprint_preprintservice.requests')
+    def testSliceSendsProfileWithoutRegistry(self, preq):
+        self.mockJob(preq, ("finished", "slicing", 1.0))
+        preq.head.return_value = MagicMock(status_code=200)
+        self.assertIsNotNone(self.p._upload_profile(self.slice_args[3]))
+        preq.put.assert_not_called()
+        preq.head.return_value = MagicMock(status_code=404)
+        preq.put.return_value = MagicMock(status_code=405)
+        self.assertIsNone(self.p._upload_profile(self.slice_args[3]))
+        bodies = list()
+        response = preq.post.return_value
+        def post(url, data=None, **kwargs):
+            bodies.append(gzip.decompress(b"".join(data)))
+            return response
+        preq.post.side_effect = post
+        ok, analysis = self.p.do_slice(*self.slice_args)
+        self.assertEqual(ok, True)
+        self.assertIn(b"testprofile", bodies[0])
+        self.assertNotIn(b"profile_hash", bodies[0])
+
+    @patch('octoprint_preprintservice.requests')
+    def testSliceRetriesUncompressedUpload(self, preq):
+        self.mockJob(preq, ("finished", "slicing", 1.0))
+        preq.post.side_effect = [MagicMock(status_code=415), preq.post.return_value]
+        ok, analysis = self.p.do_slice(*self.slice_args)
+        self.assertEqual(ok, True)
+        self.assertEqual(preq.post.call_args_list[0][1]['headers']['Content-Encoding'], 'gzip')
+        kwargs = preq.post.call_args_list[1][1]
+        self.assertNotIn('Content-Encoding', kwargs['headers'])
+        self.assertIsInstance(kwargs['data'], MultipartEncoderMonitor)
+        self.assertEqual(kwargs['data'].encoder.fields['model'][0], 'src.gcode')
+
+    @patch('octoprint_preprintservice.requests')
+    def testSliceRetriesUploadRejectedForItsEncoding(self, preq):
+        self.mockJob(preq, ("finished", "slicing", 1.0))
+        rejected = MagicMock(status_code=400, **{"json.return_value": "Unsupported Content-Encoding 'gzip'"})
+        preq.post.side_effect = [rejected, preq.post.return_value]
         ok, analysis = self.p.do_slice(*self.slice_args)
         self.assertEqual(ok, True)
+        self.assertNotIn('Content-Encoding', preq.post.call_args_list[1][1]['headers'])
+
+    @patch('octoprint_preprintservice.requests')
+    def testSliceReportsBadRequests(self, preq):
+        self.mockJob(preq, ("finished", "slicing", 1.0))
+        preq.post.side_effect = [MagicMock(status_code=400, **{"json.return_value": "Invalid tweak_option 'tweak'"})]
+        ok, msg = self.p.do_slice(*self.slice_args)
+        self.assertEqual(ok, False)
+        self.assertIn("Invalid tweak_option 'tweak'", msg)
+        self.assertEqual(preq.post.call_count, 1)
+
+    @patch('octoprint_preprintservice.requests')
+    def testSliceReportsProgressOfCompressedDownload(self, preq):
+        responses = self.mockJob(preq, ("finished", "slicing", 1.0))
+        responses[-1].headers = {"Content-Length": "4", "Content-Encoding": "gzip"}
+        responses[-1].raw.tell.side_effect = [2, 4]  # the compressed bytes, the decompressed ones are 12
+        on_progress = MagicMock()
+        self.p.do_slice(*self.slice_args, on_progress=on_progress)
+        progress = [c[1]["_progress"] for c in on_progress.call_args_list]
+        self.assertEqual(progress[-3:], [0.95, 1.0, 1.0])
         with open(self.d / 'dest.gcode', 'r') as f:
             self.assertEqual(f.read(), "testresponse")
 
+    @patch('octoprint_preprintservice.requests')
+    def testSliceJobFailed(self, preq):
+        self.mockJob(preq, ("running", "slicing", 0.5), ("failed", "slicing", 0.5))
+        ok, msg = self.p.do_slice(*self.slice_args)
+        self.assertEqual(ok, False)
+
+    @patch('octoprint_preprintservice.requests')
+    def testSliceCancelled(self, preq):
+        self.mockJob(preq, ("running", "slicing", 0.5))
+        def cancel(*args, **kwargs):
+            self.p.cancel_slicing(self.slice_args[2])
+            return MagicMock(status_code=200, **{"json.return_value": dict(
+                status="running", stage="slicing", progress=0.5, version=0, error=None)})
+        preq.get.side_effect = cancel
+        with self.assertRaises(SlicingCancelled):
+            self.p.do_slice(*self.slice_args)
+        preq.delete.assert_called()
+
+    @patch('octoprint_preprintservice.time')
+    @patch('octoprint_preprintservice.requests')
+    def testSliceStalled(self, preq, ptime):
+        ptime.time.side_effect = itertools.count(0, 500)
+        self.p._settings.get_int.return_value = 600
+        self.mockJob(preq, ("running", "slicing", 0.5))
+        preq.get.side_effect = None
+        preq.get.return_value = MagicMock(status_code=200, **{"json.return_value": dict(
+            status="running", stage="slicing", progress=0.5, version=0, error=None)})
+        ok, msg = self.p.do_slice(*self.slice_args)
+        self.assertEqual(ok, False)
+        preq.delete.assert_called()
+
     @patch('octoprint_preprintservice.requests')
     def testSliceFailedBadResponse(self, preq):
         preq.post.return_value = MagicMock(status_code=500)
@@ -164,6 +449,128 @@ class TestService(unittest.TestCase):
         ok, analysis = self.p.do_slice(*self.slice_args)
         self.assertEqual(ok, False)
 
+    def mockLocalStorage(self):
+        """Resolve the paths of the local storage in the folder uploads like OctoPrint does."""
+        base = str(self.d / 'uploads')
+        def path_in_storage(storage, path):
+            if path.startswith(base):
+                path = path[len(base):]
+            return path.replace(os.path.sep, "/").lstrip("/")
+        self.p._file_manager.path_in_storage.side_effect = path_in_storage
+        self.p._file_manager.path_on_disk.side_effect = lambda storage, path: os.path.join(base, *path.split("/"))
+        self.p._file_manager.join_path.side_effect = lambda storage, *parts: "/".join(parts)
+
+    def sliceWithOrientation(self, preq, model_path, tweak_option="tweak_extended_volume"):
+        """Slice the model into a temporary file like OctoPrint does with return_tweaked on and return the posted
+        form and the path and the vertices of the saved tweaked model."""
+        settings = dict(tweak_option=tweak_option, return_tweaked=True)
+        self.p._settings.get.side_effect = lambda path: settings.get(path[0], "http://service/tweak")
+        self.mockLocalStorage()
+        os.makedirs(os.path.dirname(model_path), exist_ok=True)
+        with open(model_path, 'w') as f:
+            f.write("solid m\nfacet normal 0 0 1\nouter loop\nvertex 0 0 0\nvertex 1 0 0\nvertex 0 1 0\n"
+                    "endloop\nendfacet\nendsolid m\n")
+        responses = self.mockJob(preq, ("finished", "slicing", 1.0))
+        orientation = dict(matrix=[[1, 0, 0], [0, 0, 1], [0, -1, 0]], unprintability=1.5)
+        responses[-1].headers["X-PrePrint-Analysis"] = json.dumps(dict(orientation=orientation))
+        bodies = list()
+        response = preq.post.return_value
+        def post(url, data=None, **kwargs):
+            bodies.append(gzip.decompress(b"".join(data)))
+            return response
+        preq.post.side_effect = post
+        saved = dict()
+        self.p._file_manager.add_file.side_effect = lambda storage, path, wrapper, **kwargs: saved.update(
+            path=path, vertices=octoprint_preprintservice._read_stl_vertices(wrapper.path))
+        # OctoPrint slices into a temporary file outside of the storage
+        fd, machinecode_path = tempfile.mkstemp(suffix=".gco")
+        os.close(fd)
+        self.addCleanup(os.remove, machinecode_path)
+        ok, _ = self.p.do_slice(model_path, 'notused', machinecode_path, *self.slice_args[3:])
+        self.assertEqual(ok, True)
+        return bodies[0], saved.get("path"), saved.get("vertices")
+
+    @patch('octoprint_preprintservice.requests')
+    def testSliceSavesTweakedModel(self, preq):
+        body, path, vertices = self.sliceWithOrientation(preq, str(self.d / 'uploads' / 'folder' / 'model.stl'))
+        # the tweaked model isn't uploaded by the service, it is rotated from the local model instead
+        self.assertIn(b"tweak_extended_volume_returnorientation\r\n", body)
+        # the tweaked model is put next to the model, not next to the temporary machinecode
+        self.assertEqual(path, "folder/model_tweaked.stl")
+        self.assertEqual(vertices, [(0, 0, 0), (1, 0, 0), (0, 0, 1)])
+
+    @patch('octoprint_preprintservice.requests')
+    def testSliceSavesTweakedModelOfUnstoredModel(self, preq):
+        _, path, _ = self.sliceWithOrientation(preq, str(self.d / 'elsewhere' / 'model.stl'))
+        self.assertEqual(path, "model_tweaked.stl")
+
+    @patch('octoprint_preprintservice.requests')
+    def testSliceKeepingTheOrientationSavesNoTweakedModel(self, preq):
+        body, path, _ = self.sliceWithOrientation(preq, str(self.d / 'uploads' / 'model.stl'), "tweak_keep")
+        # the service rejects the orientation of models that it doesn't orient
+        self.assertIn(b"\r\n\r\ntweak_keep\r\n", body)
+        self.assertNotIn(b"_returnorientation", body)
+        self.assertIsNone(path)
+        self.p._file_manager.add_file.assert_not_called()
+
+    def testRotateStl(self):
+        with open(self.d / 'binary.stl', 'wb') as f:
+            f.write(b"solid binary".ljust(80, b" ") + (1).to_bytes(4, "little"))
+            f.write(octoprint_preprintservice.STL_FACET.pack(0, 0, 1, 1, 2, 3, 4, 5, 6, 7, 8, 9, 0))
+        octoprint_preprintservice.rotate_stl(str(self.d / 'binary.stl'), str(self.d / 'out.stl'),
+                                             [[0, 1, 0], [-1, 0, 0], [0, 0, 1]])
+        self.assertEqual(octoprint_preprintservice._read_stl_vertices(str(self.d / 'out.stl')),
+                         [(-2, 1, 3), (-5, 4, 6), (-8, 7, 9)])
+        with self.assertRaises(ValueError):
+            octoprint_preprintservice.rotate_stl(str(self.d / 'src.gcode'), str(self.d / 'out.stl'), [[1, 0, 0]] * 3)
+
+    @patch('octoprint_preprintservice.STL_TEXT_CHUNK_SIZE', 20)
+    def testRotateAsciiStlInChunks(self):
+        with open(self.d / 'ascii.stl', 'w') as f:
+            f.write("solid m\n" + "facet normal 0 0 1\nouter loop\nvertex 1 2 3\nvertex 4 5 6\nvertex 7 8 9\n"
+                                   "endloop\nendfacet\n" * 5 + "endsolid m\n")
+        octoprint_preprintservice.rotate_stl(str(self.d / 'ascii.stl'), str(self.d / 'out.stl'),
+                                             [[0, 1, 0], [-1, 0, 0], [0, 0, 1]])
+        self.assertEqual(octoprint_preprintservice._read_stl_vertices(str(self.d / 'out.stl')),
+                         [(-2, 1, 3), (-5, 4, 6), (-8, 7, 9)] * 5)
+
+    def writeStl(self, path, facets):
+        """Write a binary STL of the same facet repeated."""
+        with open(path, 'wb') as f:
+            f.write(b"large".ljust(80, b" ") + struct.pack("<I", facets))
+            facet = octoprint_preprintservice.STL_FACET.pack(0, 0, 1, 1, 2, 3, 4, 5, 6, 7, 8, 9, 0)
+            for _ in range(facets // 1000):
+                f.write(facet * 1000)
+            f.write(facet * (facets % 1000))
+
+    def testRotateLargeStl(self):
+        facets = 500000  # about the size of a detailed scan, 25 MB
+        self.writeStl(self.d / 'large.stl', facets)
+        octoprint_preprintservice.rotate_stl(str(self.d / 'large.stl'), str(self.d / 'out.stl'),
+                                             [[0, 1, 0], [-1, 0, 0], [0, 0, 1]])
+        self.assertEqual(os.path.getsize(self.d / 'out.stl'), os.path.getsize(self.d / 'large.stl'))
+        with open(self.d / 'out.stl', 'rb') as f:
+            self.assertEqual(struct.unpack_from("<I", f.read(84), 80)[0], facets)
+            first = octoprint_preprintservice.STL_FACET.unpack(f.read(octoprint_preprintservice.STL_FACET.size))
+            f.seek(-octoprint_preprintservice.STL_FACET.size, os.SEEK_END)
+            last = octoprint_preprintservice.STL_FACET.unpack(f.read())
+        self.assertEqual(first, last)
+        self.assertEqual(first[3:12], (-2, 1, 3, -5, 4, 6, -8, 7, 9))
+
+    @patch('octoprint_preprintservice.STL_CHUNK_FACETS', 100)
+    def testRotateStlInChunks(self):
+        self.writeStl(self.d / 'model.stl', 5000)
+        tracemalloc.start()
+        try:
+            octoprint_preprintservice.rotate_stl(str(self.d / 'model.stl'), str(self.d / 'out.stl'),
+                                                 [[0, 1, 0], [-1, 0, 0], [0, 0, 1]])
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        # only a chunk of the model is kept in memory, all of its vertices would take about 2 MB
+        self.assertLess(peak, 256 * 1024)
+        self.assertEqual(os.path.getsize(self.d / 'out.stl'), os.path.getsize(self.d / 'model.stl'))
+
     @patch('octoprint_preprintservice.requests')
     def testSliceOnlyTweak(self, preq):
         self.p._settings.get.side_effect = ["tweak", "tweak", "url"]
@@ -196,3 +603,30 @@ class TestAnalysis(unittest.TestCase):
             self.assertEquals(get_analysis_from_gcode(f.name), {
                 'estimatedPrintTime': 86400.0,
                 'filament': {'tool0': {'length': 5, 'volume': 3}}})
+
+    def testParsePrusaSlicerFooter(self):
+        with tempfile.NamedTemporaryFile() as f:
+            with open(f.name, 'w') as h:
+                h.write('G1 X10 Y10 E0.5\n' * 100000)
+                h.write('; filament used [mm] = 1234.5, 67.8\n')
+                h.write('; filament used [cm3] = 3.2, 0.2\n')
+                h.write('; total layers count = 120\n')
+                h.write('; estimated printing time (normal mode) = 1d 2h 3m 4s\n')
+                h.write('; estimated printing time (silent mode) = 1d 3h 3m 4s\n')
+                h.write('; estimated first layer printing time (normal mode) = 5m 2s\n')
+                h.write('; layer_height = 0.15\n' * 1000)
+            self.assertEqual(get_analysis_from_gcode(f.name), {
+                'estimatedPrintTime': 93784.0,
+                'estimatedPrintTimes': {'normal mode': 93784.0, 'silent mode': 97384.0, 'first layer (normal mode)': 302.0},
+                'layerCount': 120,
+                'filament': {'tool0': {'length': 1234.5, 'volume': 3.2}, 'tool1': {'length': 67.8, 'volume': 0.2}}})
+
+    def testParseFallsBackToForwardScan(self):
+        with tempfile.NamedTemporaryFile() as f:
+            with open(f.name, 'w') as h:
+                h.write('; filament used = 5mm (3cm3)\n')
+                h.write('; estimated printing time = 1h 30m\n')
+                h.write('G1 X10 Y10 E0.5\n' * 100000)
+            self.assertEqual(get_analysis_from_gcode(f.name), {
+                'estimatedPrintTime': 5400.0,
+                'filament': {'tool0': {'length': 5, 'volume': 3}}})
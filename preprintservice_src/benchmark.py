@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""Benchmark of the orientation and slicing pipeline of the PrePrintService.
+
+Synthetic STL models of growing triangle counts are sent through the job API with each tweak option and at several
+levels of concurrency. The latency of each stage is taken from the stage timestamps of the jobs, and the peak RSS of
+the service and its worker and slicer processes is sampled while the stage is active. The results are printed and
+written as JSON, so that they can be compared between releases.
+
+By default, a local service is started with a stubbed slicer, which makes the numbers independent of the installed
+slicer. Use --url to benchmark a running service instead, the RSS is not sampled then.
+
+    python preprintservice_src/benchmark.py --triangles 1000 10000 100000 --concurrency 1 4 --output benchmark.json
+"""
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+TWEAK_OPTIONS = ["tweak_keep", "tweak_fast_surface", "tweak_fast_volume", "tweak_extended_surface",
+				 "tweak_extended_volume"]
+STAGES = ["upload", "queued", "preparation", "preprocessing", "orientation", "callback", "slicing", "download", "total"]
+PERCENTILES = [50, 95, 99]
+
+# a slicer that reports progress like prusa-slicer and writes machine code proportional to the size of the model
+STUB_SLICER = """#!{python}
+import os, sys, time
+args = sys.argv[1:]
+if "--help" in args:
+    print("PrusaSlicer-benchmark-stub")
+    sys.exit(0)
+models = [arg for arg in args if arg.lower().endswith((".stl", ".3mf", ".obj"))]
+size = sum(os.path.getsize(model) for model in models)
+for progress in (10, 30, 70, 90):
+    time.sleep(float(os.environ.get("STUB_SLICER_DELAY", "0.05")))
+    print(f"{{progress}} => Stage {{progress}}", flush=True)
+with open(args[args.index("--output") + 1], "w") as f:
+    f.write("G1 X0 Y0 Z0.2 E0.1\\n" * (size // 50 + 1))
+    f.write("; filament used [mm] = 1000.0\\n; filament used [cm3] = 2.4\\n")
+    f.write("; estimated printing time (normal mode) = 1h 2m 3s\\n")
+"""
+
+
+def make_stl(path, triangles, seed=0):
+	"""Write a binary STL of a lumpy ellipsoid with about the given number of triangles. The shape is asymmetric,
+	so that the auto-orientation has to evaluate several candidate orientations."""
+	rng = np.random.default_rng(seed)
+	stacks = max(2, int(np.sqrt(triangles / 4)))
+	slices = max(3, triangles // (2 * stacks))
+	theta = np.linspace(0, np.pi, stacks + 1)
+	phi = np.linspace(0, 2 * np.pi, slices + 1)
+	t, p = np.meshgrid(theta, phi, indexing="ij")
+	radius = 1 + 0.1 * rng.standard_normal(t.shape)
+	radius[:, -1] = radius[:, 0]  # close the seam
+	radius[0, :], radius[-1, :] = radius[0, 0], radius[-1, 0]  # and the poles
+	vertices = np.stack([40 * radius * np.sin(t) * np.cos(p), 25 * radius * np.sin(t) * np.sin(p),
+						 15 * radius * np.cos(t) + 15], axis=-1)
+	a, b = vertices[:-1, :-1], vertices[:-1, 1:]
+	c, d = vertices[1:, :-1], vertices[1:, 1:]
+	facets = np.concatenate([np.stack([a, c, b], axis=-2), np.stack([b, c, d], axis=-2)]).reshape(-1, 3, 3)
+	normals = np.cross(facets[:, 1] - facets[:, 0], facets[:, 2] - facets[:, 0])
+	lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+	normals = np.divide(normals, lengths, out=np.zeros_like(normals), where=lengths > 0)
+	records = np.zeros(len(facets), dtype=[("normal", "<f4", 3), ("vertices", "<f4", (3, 3)), ("attr", "<u2")])
+	records["normal"], records["vertices"] = normals, facets
+	with open(path, "wb") as f:
+		f.write(b"PrePrintService benchmark".ljust(80, b"\0"))
+		f.write(np.uint32(len(records)).tobytes())
+		f.write(records.tobytes())
+	return len(records)
+
+
+def percentile(values, q):
+	"""Return the q-th percentile of the values by the nearest-rank method."""
+	if not values:
+		return None
+	values = sorted(values)
+	return values[max(0, int(np.ceil(q / 100 * len(values))) - 1)]
+
+
+def process_tree_rss(pid):
+	"""Return the resident memory in bytes of the process and all of its descendants."""
+	rss, pids = 0, [pid]
+	while pids:
+		pid = pids.pop()
+		try:
+			with open(f"/proc/{pid}/status") as f:
+				rss += next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+			for task in os.listdir(f"/proc/{pid}/task"):
+				with open(f"/proc/{pid}/task/{task}/children") as f:
+					pids.extend(int(child) for child in f.read().split())
+		except (OSError, StopIteration):
+			continue  # the process exited meanwhile
+	return rss
+
+
+class RssSampler(threading.Thread):
+	"""Sample the RSS of the process tree and attribute each sample to the stages that are active at that time."""
+
+	def __init__(self, pid, interval=0.05):
+		super().__init__(daemon=True)
+		self.pid = pid
+		self.interval = interval
+		self.active = dict()  # request: stage
+		self.peaks = dict()
+		self._lock = threading.Lock()
+		self._stopped = threading.Event()
+
+	def set_stage(self, key, stage):
+		with self._lock:
+			if stage is None:
+				self.active.pop(key, None)
+			else:
+				self.active[key] = stage
+
+	def reset(self):
+		with self._lock:
+			self.peaks = dict()
+
+	def run(self):
+		while not self._stopped.wait(self.interval):
+			rss = process_tree_rss(self.pid)
+			with self._lock:
+				for stage in set(self.active.values()) | {"total"}:
+					self.peaks[stage] = max(self.peaks.get(stage, 0), rss)
+
+	def stop(self):
+		self._stopped.set()
+
+
+def run_request(base_url, model_path, tweak_option, profile, sampler, key):
+	"""Process the model through the job API and return the duration of each stage in seconds."""
+	durations = dict()
+	start = time.time()
+	set_stage = sampler.set_stage if sampler else lambda *args: None
+	set_stage(key, "upload")
+	with open(model_path, "rb") as f:
+		# name each upload uniquely like OctoPrint does, concurrent uploads of the same name would overwrite each other
+		name = f"{key}_{os.path.basename(model_path)}"
+		r = requests.post(base_url + "/jobs", files={"model": (name, f)},
+						  data={"tweak_option": tweak_option, "profile": profile, "cache": "bypass"})
+	if r.status_code != 202:
+		set_stage(key, None)
+		raise RuntimeError(f"Creating the job failed with status code {r.status_code}: {r.text}")
+	durations["upload"] = time.time() - start
+	job_url = base_url + r.headers["Location"]
+	job = r.json()
+	while job["status"] in ["queued", "running"]:
+		set_stage(key, job["stage"])
+		job = requests.get(job_url, params=dict(wait=10, version=job["version"])).json()
+	if job["status"] != "finished":
+		set_stage(key, None)
+		raise RuntimeError(f"Job {job['status']}: {job['error']}")
+	for stage, times in job["stages"].items():
+		durations[stage] = times["finished"] - times["started"]
+	set_stage(key, "download")
+	download_start = time.time()
+	r = requests.get(job_url + "/result")
+	r.raise_for_status()
+	durations["download"] = time.time() - download_start
+	durations["total"] = time.time() - start
+	set_stage(key, None)
+	return durations
+
+
+def run_scenario(base_url, model_path, tweak_option, profile, concurrency, repeat, sampler):
+	"""Send concurrency * repeat requests with the given concurrency, return the statistics of the scenario."""
+	if sampler:
+		sampler.reset()
+	count = concurrency * repeat
+	start = time.time()
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		futures = [executor.submit(run_request, base_url, model_path, tweak_option, profile, sampler, f"{concurrency}_{i}")
+				   for i in range(count)]
+	wall_time = time.time() - start
+	durations, errors = list(), list()
+	for future in futures:
+		try:
+			durations.append(future.result())
+		except Exception as e:
+			errors.append(str(e))
+	latency = dict()
+	for stage in STAGES:
+		values = [d[stage] for d in durations if stage in d]
+		if values:
+			latency[stage] = {f"p{q}": percentile(values, q) for q in PERCENTILES}
+			latency[stage]["mean"] = float(np.mean(values))
+	return dict(requests=count, failed=len(errors), errors=sorted(set(errors)), wall_time=wall_time,
+				throughput=len(durations) / wall_time, latency=latency,
+				peak_rss=dict(sampler.peaks) if sampler else None)
+
+
+def start_service(workdir, port, slicer_delay):
+	"""Start the service with the stubbed slicer and without the caches of the results and the orientations, return
+	its process when it is ready."""
+	slicer_path = os.path.join(workdir, "prusa-slicer")
+	with open(slicer_path, "w") as f:
+		f.write(STUB_SLICER.format(python=sys.executable))
+	os.chmod(slicer_path, 0o755)
+	# the work directories of the finished jobs are kept for their results, they are removed with the workdir
+	env = dict(os.environ, SLIC3R_PATH=slicer_path, CACHE_MAX_SIZE="0", ORIENTATION_CACHE_MAX_SIZE="0",
+			   WORK_FOLDER=os.path.join(workdir, "work"), STUB_SLICER_DELAY=str(slicer_delay), LOGLEVEL="WARNING")
+	service_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "preprintservice.py")
+	process = subprocess.Popen([sys.executable, service_path, "-p", str(port)], env=env,
+							   cwd=os.path.dirname(service_path), start_new_session=True,
+							   stdout=subprocess.DEVNULL, stderr=open(os.path.join(workdir, "service.log"), "w"))
+	for _ in range(300):
+		try:
+			if requests.get(f"http://localhost:{port}/connection", timeout=1).status_code == 200:
+				return process
+		except requests.ConnectionError:
+			pass
+		if process.poll() is not None:
+			break
+		time.sleep(0.1)
+	os.killpg(process.pid, signal.SIGKILL)
+	raise RuntimeError(f"The service didn't start, see {os.path.join(workdir, 'service.log')}")
+
+
+def free_port():
+	with socket.socket() as s:
+		s.bind(("localhost", 0))
+		return s.getsockname()[1]
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark of the orientation and slicing pipeline of the PrePrintService.")
+	parser.add_argument("--url", help="url of a running service, default: start a local service with a stubbed slicer")
+	parser.add_argument("--triangles", type=int, nargs="+", default=[1000, 10000, 100000],
+						help="triangle counts of the synthetic models, default: 1000 10000 100000")
+	parser.add_argument("--tweak-options", nargs="+", default=TWEAK_OPTIONS, choices=TWEAK_OPTIONS,
+						help="tweak options to benchmark, default: all")
+	parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4],
+						help="numbers of concurrent requests, default: 1 4")
+	parser.add_argument("--repeat", type=int, default=3, help="requests per concurrent client, default: 3")
+	parser.add_argument("--profile", default="profile_015mm_none.ini", help="profile to slice with, 'no_slicing' to skip slicing")
+	parser.add_argument("--slicer-delay", type=float, default=0.05, help="seconds per progress step of the stubbed slicer")
+	parser.add_argument("--output", default="benchmark.json", help="path of the JSON output, default: benchmark.json")
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory(prefix="pps-benchmark-") as workdir:
+		process = sampler = None
+		if args.url:
+			base_url = args.url.rstrip("/").replace("/tweak", "")
+		else:
+			port = free_port()
+			process = start_service(workdir, port, args.slicer_delay)
+			base_url = f"http://localhost:{port}"
+			sampler = RssSampler(process.pid)
+			sampler.start()
+		try:
+			models = dict()
+			for triangles in args.triangles:
+				models[triangles] = os.path.join(workdir, f"model_{triangles}.stl")
+				models[triangles] = (models[triangles], make_stl(models[triangles], triangles))
+			results = list()
+			for triangles, (model_path, actual_triangles) in models.items():
+				for tweak_option in args.tweak_options:
+					for concurrency in args.concurrency:
+						stats = run_scenario(base_url, model_path, tweak_option, args.profile, concurrency,
+											 args.repeat, sampler)
+						stats.update(triangles=actual_triangles, tweak_option=tweak_option, concurrency=concurrency)
+						results.append(stats)
+						latency = stats["latency"].get("total", dict())
+						print(f"{actual_triangles:>8} triangles  {tweak_option:<22} concurrency {concurrency:>2}: "
+							  f"p50 {latency.get('p50') or 0:7.3f} s  p95 {latency.get('p95') or 0:7.3f} s  "
+							  f"p99 {latency.get('p99') or 0:7.3f} s  {stats['throughput']:6.2f} req/s"
+							  + (f"  {stats['failed']} failed" if stats["failed"] else ""))
+		finally:
+			if sampler:
+				sampler.stop()
+			if process:
+				# the service runs in its own session, stop it together with its orientation workers and slicers
+				os.killpg(process.pid, signal.SIGTERM)
+				process.wait()
+
+	meta = dict(created=time.time(), url=args.url, stubbed_slicer=not args.url, platform=platform.platform(),
+				python=platform.python_version(), cpu_count=os.cpu_count(), profile=args.profile, repeat=args.repeat)
+	with open(args.output, "w") as f:
+		json.dump(dict(meta=meta, results=results), f, indent=2)
+	print(f"Wrote the results to '{args.output}'")
+	return 1 if any(stats["failed"] for stats in results) else 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
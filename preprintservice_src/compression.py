@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Negotiated compression of the results and decompression of compressed request bodies.
+
+Machine code is text that shrinks by a factor of 4 to 10 with gzip, which matters more than the time of slicing on a
+slow network. The compressed copy of a result is written once next to the file, so that it is served with a length
+and answers conditional and range requests like the file itself. zstd is offered if the module zstandard is installed.
+Compressed request bodies are limited in their decompressed size, so that a small upload can't expand without bound.
+"""
+import os
+import gzip
+import shutil
+import tempfile
+
+from werkzeug.wsgi import get_input_stream
+from werkzeug.exceptions import RequestEntityTooLarge
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+CHUNK_SIZE = 1024 * 1024
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# results of other types, like zip archives and 3MF files, are compressed already
+COMPRESSIBLE_EXTENSIONS = {".gcode", ".stl", ".obj"}
+SUFFIXES = {"zstd": ".zst", "gzip": ".gz"}
+
+
+def available_encodings():
+	"""Return the supported content codings in the order of preference."""
+	return ["zstd", "gzip"] if zstandard else ["gzip"]
+
+
+def is_compressible(path):
+	return os.path.splitext(path)[1].lower() in COMPRESSIBLE_EXTENSIONS
+
+
+def negotiate_encoding(path, accept_encodings):
+	"""Return the content coding in which the file is sent to a client with the parsed Accept-Encoding header,
+	or None if it is sent as it is."""
+	if not is_compressible(path):
+		return None
+	return accept_encodings.best_match(available_encodings())
+
+
+def compressed_copy(path, encoding):
+	"""Return the path of the copy of the file in the content coding, it is created if it is missing or older than
+	the file. The copy is written to a temporary file first, so that concurrent readers never see a partial one."""
+	target = path + SUFFIXES[encoding]
+	try:
+		if os.path.getmtime(target) >= os.path.getmtime(path):
+			return target
+	except OSError:
+		pass
+	fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(path))
+	try:
+		with open(path, "rb") as src, os.fdopen(fd, "wb") as dst:
+			if encoding == "zstd":
+				zstandard.ZstdCompressor(level=ZSTD_LEVEL).copy_stream(src, dst, read_size=CHUNK_SIZE)
+			else:
+				with gzip.GzipFile(fileobj=dst, mode="wb", compresslevel=GZIP_LEVEL, mtime=0) as gz:
+					shutil.copyfileobj(src, gz, CHUNK_SIZE)
+		os.replace(tmp_path, target)
+	except BaseException:
+		os.remove(tmp_path)
+		raise
+	return target
+
+
+class LimitedStream:
+	"""Decompressed request body that raises RequestEntityTooLarge once more than max_size bytes are read."""
+
+	def __init__(self, stream, max_size):
+		self.stream = stream
+		self.max_size = max_size
+		self.bytes_read = 0
+
+	def _count(self, data):
+		self.bytes_read += len(data)
+		if self.bytes_read > self.max_size:
+			raise RequestEntityTooLarge(f"The decompressed request body exceeds {self.max_size} bytes")
+		return data
+
+	def _limit(self, size):
+		# reading everything is bounded as well, one byte beyond the limit suffices to detect the excess
+		remaining = self.max_size - self.bytes_read + 1
+		return remaining if size is None or size < 0 else min(size, remaining)
+
+	def read(self, size=-1):
+		return self._count(self.stream.read(self._limit(size)))
+
+	def readline(self, size=-1):
+		return self._count(self.stream.readline(self._limit(size)))
+
+
+def decompress_request_body(environ, max_size=0):
+	"""Replace the input stream of the WSGI environ by the decompressed body if the request has a Content-Encoding.
+	Reading more than max_size decompressed bytes raises RequestEntityTooLarge, 0 disables the limit. Return False
+	if the content coding is not supported."""
+	encoding = environ.get("HTTP_CONTENT_ENCODING", "identity").strip().lower()
+	if encoding == "identity":
+		return True
+	if encoding not in available_encodings():
+		return False
+	# the stream is limited to the Content-Length of the compressed body, the decompressed one is read until its end
+	stream = get_input_stream(environ)
+	if encoding == "zstd":
+		environ["wsgi.input"] = zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True)
+	else:
+		environ["wsgi.input"] = gzip.GzipFile(fileobj=stream, mode="rb")
+	if max_size:
+		environ["wsgi.input"] = LimitedStream(environ["wsgi.input"], max_size)
+	environ["wsgi.input_terminated"] = True
+	environ.pop("CONTENT_LENGTH", None)
+	environ.pop("HTTP_CONTENT_ENCODING", None)
+	return True
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""Background delivery of the tweaked models back to OctoPrint, retried with exponential backoff.
+
+The upload used to run within the job before slicing, so a slow or unreachable OctoPrint delayed every result. The
+jobs now queue the model with their own link to the file and go on with slicing, while the delivery threads upload
+it. The state of each delivery is kept for the retention time, so that clients can look it up by the id of its job.
+"""
+import os
+import re
+import time
+import heapq
+import shutil
+import logging
+import itertools
+import threading
+
+import requests
+
+# responses of OctoPrint that are retried, besides the server errors
+RETRY_STATUS_CODES = [408, 429]
+# the files of the deliveries are named by the id of their job and the extension of the model
+FILE_PATTERN = re.compile(r"[0-9a-f]{32}(\.\w+)?")
+
+logger = logging.getLogger(__name__)
+
+
+class Delivery:
+	"""Upload of a file to the OctoPrint server at url, its status is 'queued', 'sending', 'retrying', 'delivered'
+	or 'failed'."""
+
+	def __init__(self, job_id, url, apikey, name, path):
+		self.job_id = job_id
+		self.url = url
+		self.apikey = apikey
+		self.name = name
+		self.path = path
+		self.size = os.path.getsize(path)
+		self.status = "queued"
+		self.attempts = 0
+		self.created = time.time()
+		self.finished = None
+		self.next_attempt = self.created
+		self.status_code = None
+		self.error = None
+
+	@property
+	def done(self):
+		return self.status in ["delivered", "failed"]
+
+	def to_dict(self):
+		return dict(job_id=self.job_id, url=self.url, name=self.name, size=self.size, status=self.status,
+					attempts=self.attempts, created=self.created, finished=self.finished,
+					next_attempt=None if self.done else self.next_attempt, status_code=self.status_code, error=self.error)
+
+
+class DeliveryQueue:
+	"""Deliver the files on max_workers threads. Failed connections, timeouts and server errors are retried up to
+	max_attempts times in total, the backoff doubles from backoff up to max_backoff seconds. The deliveries are
+	forgotten retention seconds after they are done."""
+
+	def __init__(self, folder, sessions, timeout, max_workers, max_attempts, backoff, max_backoff, retention,
+				 on_done=None):
+		self.folder = folder
+		self.sessions = sessions
+		self.timeout = timeout
+		self.max_attempts = max_attempts
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+		self.retention = retention
+		self.on_done = on_done  # called with each delivery when it is done, e.g. to record its metrics
+		self.delivered = 0
+		self.failed = 0
+		self.retries = 0
+		self._lock = threading.Condition()
+		self._pending = list()  # heap of (next_attempt, sequence, delivery)
+		self._sequence = itertools.count()
+		self._deliveries = dict()  # job_id: delivery
+		os.makedirs(self.folder, exist_ok=True)
+		# the files of deliveries that were pending when the service stopped are orphans, other files are left alone
+		for name in os.listdir(self.folder):
+			if not FILE_PATTERN.fullmatch(name):
+				continue
+			try:
+				os.remove(os.path.join(self.folder, name))
+			except OSError as e:
+				logger.warning(f"Couldn't remove the orphaned delivery '{name}': {e}")
+		for i in range(max_workers):
+			threading.Thread(target=self._run, name=f"delivery-{i}", daemon=True).start()
+
+	def submit(self, job_id, url, apikey, name, path):
+		"""Queue the upload of the file in path as name to the OctoPrint server at url and return the delivery. The
+		file is linked or copied, so that it may be removed once this returns."""
+		copy_path = os.path.join(self.folder, job_id + os.path.splitext(name)[1])
+		try:
+			os.link(path, copy_path)
+		except OSError:  # on another file system
+			shutil.copyfile(path, copy_path)
+		delivery = Delivery(job_id, url, apikey, name, copy_path)
+		with self._lock:
+			self._prune()
+			self._deliveries[job_id] = delivery
+			self._schedule(delivery)
+		return delivery
+
+	def get(self, job_id):
+		"""Return the delivery of the job, or None if it has none or it was forgotten."""
+		with self._lock:
+			return self._deliveries.get(job_id)
+
+	def _schedule(self, delivery):
+		heapq.heappush(self._pending, (delivery.next_attempt, next(self._sequence), delivery))
+		self._lock.notify()
+
+	def _next(self):
+		"""Wait for the next delivery that is due and return it."""
+		with self._lock:
+			while True:
+				wait = self._pending[0][0] - time.time() if self._pending else None
+				if wait is not None and wait <= 0:
+					delivery = heapq.heappop(self._pending)[2]
+					delivery.status = "sending"
+					return delivery
+				self._lock.wait(wait)
+
+	def _run(self):
+		while True:
+			delivery = self._next()
+			try:
+				self._send(delivery)
+			except Exception as e:
+				logger.exception(f"Delivering '{delivery.name}' to '{delivery.url}' failed unexpectedly")
+				self._finish(delivery, "failed", str(e))
+
+	def _send(self, delivery):
+		delivery.attempts += 1
+		# find the apikey in octoprint server, settings, access control
+		url_with_key = os.path.join(delivery.url, f'api/files/local?apikey={delivery.apikey}')
+		try:
+			with open(delivery.path, 'rb') as f:
+				r = self.sessions.get(url_with_key).post(url_with_key, files={'file': (delivery.name, f)},
+														 timeout=self.timeout)
+		except requests.RequestException as e:
+			error, retry = str(e), True
+		else:
+			delivery.status_code = r.status_code
+			if r.status_code == 201:
+				self._finish(delivery, "delivered")
+				return
+			error = f"OctoPrint responded with code '{r.status_code}'"
+			retry = r.status_code >= 500 or r.status_code in RETRY_STATUS_CODES
+		if not retry or delivery.attempts >= self.max_attempts:
+			self._finish(delivery, "failed", error)
+			return
+		delay = min(self.backoff * 2 ** (delivery.attempts - 1), self.max_backoff)
+		logger.warning(f"Delivering '{delivery.name}' to '{delivery.url}' failed in attempt {delivery.attempts}, "
+					   f"retrying in {delay:g} s: {error}")
+		with self._lock:
+			delivery.status, delivery.error, delivery.next_attempt = "retrying", error, time.time() + delay
+			self.retries += 1
+			self._schedule(delivery)
+
+	def _finish(self, delivery, status, error=None):
+		with self._lock:
+			delivery.status, delivery.error, delivery.finished = status, error, time.time()
+			if status == "delivered":
+				self.delivered += 1
+			else:
+				self.failed += 1
+		if os.path.exists(delivery.path):
+			os.remove(delivery.path)
+		if status == "delivered":
+			logger.info(f"Delivered '{delivery.name}' to '{delivery.url}' in {delivery.attempts} attempts")
+		else:
+			logger.warning(f"Delivering '{delivery.name}' to '{delivery.url}' failed after {delivery.attempts} "
+						   f"attempts: {error}")
+		if self.on_done:
+			try:
+				self.on_done(delivery)
+			except Exception:
+				logger.exception(f"Handling the end of the delivery of job '{delivery.job_id}' failed")
+
+	def _prune(self):
+		"""Forget the deliveries that are done since more than the retention time."""
+		threshold = time.time() - self.retention
+		for job_id in [d.job_id for d in self._deliveries.values() if d.done and d.finished < threshold]:
+			del self._deliveries[job_id]
+
+	def stats(self):
+		with self._lock:
+			states = [delivery.status for delivery in self._deliveries.values()]
+			return dict(queued=states.count("queued"), sending=states.count("sending"),
+						retrying=states.count("retrying"), delivered=self.delivered, failed=self.failed,
+						retries=self.retries, max_attempts=self.max_attempts)
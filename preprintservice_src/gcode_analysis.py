@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""Analysis of sliced machine code in the structure of OctoPrint's G-code analysis.
+
+The analysis is computed once after slicing and sent along with the machine code, so that the OctoPrint plugin
+doesn't need to parse the file on the printer node. See
+http://docs.octoprint.org/en/master/modules/filemanager.html#octoprint.filemanager.analysis.GcodeAnalysisQueue
+"""
+import re
+
+import numpy as np
+
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# comments with the filament usage, the print time and the layer count of Slic3r and PrusaSlicer
+COMMENT_PATTERN = re.compile(
+	rb"^[ \t]*;[ \t]*(?:"
+	rb"filament used[ \t]*=[ \t]*(?P<length>[0-9.]+)[ \t]*mm[ \t]*\((?P<volume>[0-9.]+)cm3\)"
+	rb"|filament used \[(?P<unit>mm|cm3)\][ \t]*=[ \t]*(?P<values>[0-9., \t]+)"
+	rb"|estimated (?P<first_layer>first layer )?printing time[ \t]*(?:\((?P<mode>[^)\r\n]*)\))?[ \t]*=[ \t](?P<time>[^\r\n]*)"
+	rb"|total layers count[ \t]*=[ \t]*(?P<layers>[0-9]+)"
+	rb")", re.MULTILINE)
+PRINT_TIME_PART_PATTERN = re.compile(rb"\s*([0-9.]+)([dhms])")
+PRINT_TIME_UNITS = {b"d": 24 * 60 * 60, b"h": 60 * 60, b"m": 60, b"s": 1}
+# commands that move the head or change the interpretation of the coordinates, with the values of the axes
+COMMAND_PATTERN = re.compile(
+	rb"^[ \t]*(G[01]|G9[0-2]|M8[23])(?![0-9])"
+	rb"(?:[ \t]*(?:X(-?[0-9.]+)|Y(-?[0-9.]+)|Z(-?[0-9.]+)|E(-?[0-9.]+)|[A-DF-W]-?[0-9.]*))*", re.MULTILINE)
+AXES = "XYZE"
+
+
+def parse_print_time(time_text):
+	"""Return the seconds of a print time like '1d 2h 3m 4s'."""
+	printing_seconds = 0
+	for time_part in time_text.split(b" "):
+		m = PRINT_TIME_PART_PATTERN.match(time_part)
+		if m:
+			printing_seconds += float(m.group(1)) * PRINT_TIME_UNITS[m.group(2)]
+	return printing_seconds
+
+
+def _forward_fill(values, initial):
+	"""Replace each NaN by the last preceding value, or by initial at the start."""
+	values = np.concatenate([[initial], values])
+	index = np.where(np.isnan(values), 0, np.arange(len(values)))
+	np.maximum.accumulate(index, out=index)
+	return values[index][1:]
+
+
+class _PrintingArea:
+	"""Follows the moves of the machine code and keeps the bounding box of the end points of the extruding moves.
+	The moves are evaluated vectorized per block, moves in relative positioning (G91) are ignored, as slicers use
+	it only for the lifts and retractions of the start and end code."""
+
+	def __init__(self):
+		self.position = dict(X=np.nan, Y=np.nan, Z=np.nan, E=0.0)
+		self.absolute = True
+		self.absolute_extrusion = True
+		self.minimum = np.full(3, np.inf)
+		self.maximum = np.full(3, -np.inf)
+
+	def scan(self, block):
+		rows = COMMAND_PATTERN.findall(block)
+		if not rows:
+			return
+		table = np.array(rows, dtype="S24")  # columns: command, X, Y, Z, E
+		commands = table[:, 0]
+		is_move = (commands == b"G0") | (commands == b"G1")
+		is_reset = commands == b"G92"
+
+		# the positioning and extrusion mode that is active in each row
+		positioning = np.select([commands == b"G90", commands == b"G91"], [1.0, 0.0], np.nan)
+		absolute = _forward_fill(positioning, float(self.absolute)) == 1.0
+		extrusion = np.select([commands == b"M82", commands == b"M83"], [1.0, 0.0], np.nan)
+		absolute_extrusion = _forward_fill(extrusion, float(self.absolute_extrusion)) == 1.0
+
+		# the values of the axes, NaN if not given or if the coordinates are relative
+		columns = table[:, 1:]
+		numbers = np.where(columns == b"", b"nan", columns).astype(float)
+		numbers[~(is_move & absolute | is_reset)] = np.nan
+		values = {axis: numbers[:, i] for i, axis in enumerate(AXES)}
+		positions = {axis: _forward_fill(values[axis], self.position[axis]) for axis in AXES}
+
+		# a move extrudes if E grows in absolute extrusion or is positive in relative extrusion
+		previous_e = np.concatenate([[self.position["E"]], positions["E"][:-1]])
+		extruding = is_move & absolute & ~np.isnan(values["E"]) & \
+			np.where(absolute_extrusion, values["E"] > previous_e, values["E"] > 0) & \
+			(~np.isnan(values["X"]) | ~np.isnan(values["Y"]) | ~np.isnan(values["Z"]))
+		if extruding.any():
+			points = np.stack([positions[axis][extruding] for axis in "XYZ"], axis=1)
+			self.minimum = np.fmin(self.minimum, np.nanmin(points, axis=0))
+			self.maximum = np.fmax(self.maximum, np.nanmax(points, axis=0))
+
+		self.position = {axis: positions[axis][-1] for axis in AXES}
+		self.absolute, self.absolute_extrusion = bool(absolute[-1]), bool(absolute_extrusion[-1])
+
+	def to_dict(self):
+		if not np.isfinite(self.minimum).all() or not np.isfinite(self.maximum).all():
+			return None
+		return {f"{bound}{axis}": round(float(value), 4) for bound, values in (("min", self.minimum), ("max", self.maximum))
+				for axis, value in zip("XYZ", values)}
+
+
+def _scan_comments(block, analysis):
+	slic3r_tool = 0
+	for m in COMMENT_PATTERN.finditer(block):
+		filament = analysis["filament"]
+		if m.group("length"):
+			# Slic3r writes one line per extruder, e.g. "; filament used = 5mm (3cm3)"
+			filament[f"tool{slic3r_tool}"] = dict(length=float(m.group("length")), volume=float(m.group("volume")))
+			slic3r_tool += 1
+		elif m.group("unit"):
+			# PrusaSlicer writes one line per unit with a value per extruder, e.g. "; filament used [mm] = 5.2, 0.0"
+			key = "length" if m.group("unit") == b"mm" else "volume"
+			values = [v for v in m.group("values").replace(b" ", b"").split(b",") if v]
+			for i, value in enumerate(values):
+				filament.setdefault(f"tool{i}", dict(length=-1, volume=-1))[key] = float(value)
+		elif m.group("time") is not None:
+			mode = m.group("mode").decode("utf-8") if m.group("mode") else "default"
+			if m.group("first_layer"):
+				mode = f"first layer ({mode})"
+			analysis.setdefault("estimatedPrintTimes", dict())[mode] = parse_print_time(m.group("time").strip())
+		elif m.group("layers"):
+			analysis["layerCount"] = int(m.group("layers"))
+
+
+def analyse_gcode(gcode_path):
+	"""Return the analysis of the machine code: the filament per tool, the estimated print time, the layer count
+	and the printing area and dimensions of the extruding moves. Values that can't be found are -1 or left out."""
+	analysis = dict(filament=dict(tool0=dict(length=-1, volume=-1)), estimatedPrintTime=-1)
+	area = _PrintingArea()
+	with open(gcode_path, "rb") as f:
+		rest = b""
+		for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+			# analyse whole lines only, the rest is prepended to the next chunk
+			block, _, rest = (rest + chunk).rpartition(b"\n")
+			_scan_comments(block, analysis)
+			area.scan(block)
+		_scan_comments(rest, analysis)
+		area.scan(rest)
+	times = analysis.get("estimatedPrintTimes", dict())
+	for mode in ["default", "normal mode"] + sorted(times):
+		if mode in times and not mode.startswith("first layer"):
+			analysis["estimatedPrintTime"] = times[mode]
+			break
+	if list(times) == ["default"]:
+		del analysis["estimatedPrintTimes"]
+	printing_area = area.to_dict()
+	if printing_area:
+		analysis["printingArea"] = printing_area
+		analysis["dimensions"] = dict(width=round(printing_area["maxX"] - printing_area["minX"], 4),
+									  depth=round(printing_area["maxY"] - printing_area["minY"], 4),
+									  height=round(printing_area["maxZ"] - printing_area["minZ"], 4))
+	return analysis
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""Asynchronous execution of preprocessing jobs on a bounded pool of worker threads."""
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+	"""Raised if a job is submitted while all workers are busy and the queue is full."""
+
+
+class JobError(Exception):
+	"""Raised within a job for expected failures, such as a nonzero returncode of a subprocess."""
+
+
+class JobCancelled(JobError):
+	"""Raised within a job when it reports progress after it was cancelled."""
+
+
+class Job:
+	"""A single unit of work, its state goes from 'queued' over 'running' to 'finished', 'failed' or 'cancelled'.
+	While running, the job publishes its current stage and the progress of that stage between 0 and 1."""
+
+	def __init__(self, name):
+		self.id = uuid.uuid4().hex
+		self.name = name
+		self.status = "queued"
+		self.created = time.time()
+		self.started = None
+		self.finished = None
+		self.result = None
+		self.error = None
+		self.stage = "queued"
+		self.progress = 0.0
+		self.message = None
+		self.stages = dict(queued=dict(started=self.created, finished=None))
+		self.version = 0  # increased on each change, used for long-polling
+		self._changed = threading.Condition()
+		self._cancelled = threading.Event()
+		self._done = threading.Event()
+
+	@property
+	def done(self):
+		return self._done.is_set()
+
+	@property
+	def cancelled(self):
+		return self._cancelled.is_set()
+
+	def wait(self, timeout=None):
+		"""Block until the job is done or the timeout in seconds elapsed, return if the job is done."""
+		return self._done.wait(timeout)
+
+	def wait_for_change(self, version, timeout):
+		"""Block until the job has changed since the given version or the timeout in seconds elapsed."""
+		with self._changed:
+			self._changed.wait_for(lambda: self.version > version, timeout)
+
+	def cancel(self):
+		"""Request the cancellation, the job stops at the next report of its progress."""
+		self._cancelled.set()
+
+	def child(self, name):
+		"""Return a job for a part of this job, e.g. a model of a batch, which is cancelled together with it."""
+		child = Job(name)
+		child._cancelled = self._cancelled
+		return child
+
+	def check_cancelled(self):
+		if self.cancelled:
+			raise JobCancelled(f"Job '{self.id}' was cancelled")
+
+	def set_progress(self, stage, progress=0.0, message=None):
+		"""Publish the progress of the current stage and raise JobCancelled if the job was cancelled meanwhile."""
+		self.check_cancelled()
+		with self._changed:
+			if (stage, progress, message) == (self.stage, self.progress, self.message):
+				return
+			if stage != self.stage:
+				now = time.time()
+				self.stages[self.stage]["finished"] = now
+				self.stages[stage] = dict(started=now, finished=None)
+			self.stage, self.progress, self.message = stage, progress, message
+			self.version += 1
+			self._changed.notify_all()
+
+	def _set_status(self, status):
+		with self._changed:
+			now = time.time()
+			if status == "running":
+				self.started = now
+			else:
+				self.finished = now
+				self.stages[self.stage]["finished"] = now
+			self.status = status
+			self.version += 1
+			self._changed.notify_all()
+
+	def to_dict(self):
+		return dict(id=self.id, name=self.name, status=self.status, created=self.created,
+					started=self.started, finished=self.finished, error=self.error, version=self.version,
+					stage=self.stage, progress=self.progress, message=self.message, stages=self.stages)
+
+
+class JobManager:
+	"""Run jobs on max_workers threads and accept at most max_queued jobs that wait for a free worker.
+	Finished jobs are kept for retention seconds, so that their state and result can be fetched."""
+
+	def __init__(self, max_workers, max_queued, retention, on_done=None):
+		self.max_workers = max_workers
+		self.max_queued = max_queued
+		self.retention = retention
+		self.on_done = on_done  # called with each job when it is done, e.g. to record its metrics
+		self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+		self._lock = threading.Lock()
+		self._jobs = dict()
+
+	def _count(self, status):
+		return sum(1 for job in self._jobs.values() if job.status == status)
+
+	@property
+	def active(self):
+		with self._lock:
+			return self._count("running")
+
+	@property
+	def queued(self):
+		with self._lock:
+			return self._count("queued")
+
+	def submit(self, name, func, *args, cleanup=None, **kwargs):
+		"""Enqueue func(*args, job=job, **kwargs) as job, its return value becomes the result of the job.
+		cleanup is called with the job once it is done, before it is reported as done, even if it never started."""
+		with self._lock:
+			self._prune()
+			if self._count("queued") >= self.max_queued:
+				raise JobQueueFull(f"Too many queued jobs, the limit is {self.max_queued}")
+			job = Job(name)
+			self._jobs[job.id] = job
+		self._executor.submit(self._run, job, func, args, kwargs, cleanup)
+		logger.info(f"Queued job '{job.id}' for '{name}'")
+		return job
+
+	def get(self, job_id):
+		with self._lock:
+			return self._jobs.get(job_id)
+
+	def _run(self, job, func, args, kwargs, cleanup=None):
+		if job.cancelled:
+			job._set_status("cancelled")
+			self._cleanup(job, cleanup)
+			job._done.set()
+			logger.info(f"Job '{job.id}' was cancelled before it started")
+			self._notify_done(job)
+			return
+		job._set_status("running")
+		logger.info(f"Started job '{job.id}' after waiting {job.started - job.created:.2f} s")
+		try:
+			result = func(*args, job=job, **kwargs)
+			job.result = result
+			status = "finished"
+		except JobCancelled as e:
+			job.error = str(e)
+			status = "cancelled"
+		except Exception as e:
+			if not isinstance(e, JobError):
+				logger.exception(f"Job '{job.id}' failed unexpectedly")
+			job.error = str(e)
+			status = "failed"
+		job._set_status(status)
+		self._cleanup(job, cleanup)
+		job._done.set()
+		logger.info(f"Job '{job.id}' {job.status} after {job.finished - job.started:.2f} s")
+		self._notify_done(job)
+
+	def _cleanup(self, job, cleanup):
+		if cleanup:
+			try:
+				cleanup(job)
+			except Exception:
+				logger.exception(f"Cleaning up after job '{job.id}' failed")
+
+	def _notify_done(self, job):
+		if self.on_done:
+			try:
+				self.on_done(job)
+			except Exception:
+				logger.exception(f"Handling the end of job '{job.id}' failed")
+
+	def _prune(self):
+		"""Forget the jobs that are done since more than the retention time."""
+		threshold = time.time() - self.retention
+		for job_id in [job.id for job in self._jobs.values() if job.done and job.finished < threshold]:
+			del self._jobs[job_id]
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""Conversion of the uploaded models to compact binary STL, before they are auto-oriented and sliced.
+
+ASCII STL is 4 to 5 times larger than binary STL and much slower to parse, and Tweaker-3, the slicer and the upload
+back to OctoPrint would each read the upload again. The models are therefore parsed once with vectorised NumPy,
+identical vertices are merged, degenerate triangles are dropped and the mesh is written as binary STL.
+"""
+import os
+import re
+import zipfile
+import tempfile
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+STL_HEADER_SIZE = 84
+STL_HEADER = b"binary STL written by the PrePrintService"
+STL_DTYPE = np.dtype([("normal", "<f4", (3,)), ("vertices", "<f4", (3, 3)), ("attribute", "<u2")])
+# triangles with twice their area below this value in mm^2 are considered degenerate
+MIN_DOUBLE_AREA = 1e-12
+# attempts to shrink a mesh to its triangle budget by coarser cells
+DECIMATION_ATTEMPTS = 8
+# the coordinates of the vertices of ASCII STL files, and the vertex and face lines of OBJ files
+STL_VERTEX_PATTERN = re.compile(rb"\bvertex\s+(\S+\s+\S+\s+\S+)")
+OBJ_VERTEX_PATTERN = re.compile(rb"^v[ \t]+(\S+[ \t]+\S+[ \t]+\S+)", re.M)
+OBJ_FACE_PATTERN = re.compile(rb"^f[ \t]+([^\r\n]*)", re.M)
+# the texture and normal indices of the corners of OBJ faces, 'v/vt/vn' refers to the vertex v
+OBJ_INDEX_SUFFIX_PATTERN = re.compile(rb"/\S*")
+# text models are parsed in chunks of whole lines of about this size, which bounds the memory of the parser
+TEXT_CHUNK_SIZE = 16 * 2**20
+# scale of the units of 3MF files to mm
+UNITS_3MF = {"micron": 0.001, "millimeter": 1.0, "centimeter": 10.0, "inch": 25.4, "foot": 304.8, "meter": 1000.0}
+
+
+def _chunks(data):
+	"""Yield the data in chunks of whole lines of about TEXT_CHUNK_SIZE bytes."""
+	start = 0
+	while start < len(data):
+		end = data.find(b"\n", start + TEXT_CHUNK_SIZE)
+		end = len(data) if end < 0 else end + 1
+		yield data[start:end]
+		start = end
+
+
+def _parse_numbers(fields, dtype, count):
+	"""Return the whitespace-separated numbers in the list of byte strings as flat array, raise a ValueError if
+	they aren't count numbers."""
+	numbers = np.fromstring(b" ".join(fields), dtype, sep=" ") if fields else np.empty(0, dtype)
+	if len(numbers) != count:
+		raise ValueError("The model holds invalid numbers")
+	return numbers
+
+
+def _read_stl(data):
+	"""Return the triangles of an ASCII or binary STL as array of shape (n, 3, 3)."""
+	if len(data) >= STL_HEADER_SIZE:
+		n = int(np.frombuffer(data, "<u4", count=1, offset=80)[0])
+		# binary files may start with 'solid' too, their size decides
+		if len(data) == STL_HEADER_SIZE + n * STL_DTYPE.itemsize:
+			return np.frombuffer(data, STL_DTYPE, count=n, offset=STL_HEADER_SIZE)["vertices"]
+	if not data.lstrip().startswith(b"solid"):
+		raise ValueError("The STL file is neither binary nor ASCII")
+	coordinates = list()
+	for chunk in _chunks(data):
+		fields = STL_VERTEX_PATTERN.findall(chunk)
+		coordinates.append(_parse_numbers(fields, np.float32, 3 * len(fields)))
+	coordinates = np.concatenate(coordinates) if coordinates else np.empty(0, np.float32)
+	if len(coordinates) % 9:
+		raise ValueError("The ASCII STL file has incomplete facets")
+	return coordinates.reshape(-1, 3, 3)
+
+
+def _read_obj(data):
+	"""Return the triangles of a Wavefront OBJ as array of shape (n, 3, 3), polygons are triangulated as fans."""
+	vertices = list()
+	faces = list()
+	count = 0  # of the vertices in the previous chunks
+	for chunk in _chunks(data):
+		vertex_matches = list(OBJ_VERTEX_PATTERN.finditer(chunk))
+		face_matches = list(OBJ_FACE_PATTERN.finditer(chunk))
+		vertices.append(_parse_numbers([m.group(1) for m in vertex_matches], np.float32, 3 * len(vertex_matches)))
+		if face_matches:
+			# negative indices count back from the last vertex before the face
+			before = count + np.searchsorted([m.start() for m in vertex_matches], [m.start() for m in face_matches])
+			faces.append(_triangulate([OBJ_INDEX_SUFFIX_PATTERN.sub(b"", m.group(1)) for m in face_matches], before))
+		count += len(vertex_matches)
+	if not faces:
+		return np.empty((0, 3, 3), np.float32)
+	faces = np.concatenate(faces)
+	if len(faces) and faces.min() < 0:
+		raise ValueError("The OBJ file refers to invalid vertices")
+	return np.concatenate(vertices).reshape(-1, 3)[faces]
+
+
+def _triangulate(fields, before):
+	"""Return the triangles of the OBJ faces with the 1-based vertex indices in fields as array of shape (n, 3) of
+	0-based indices, polygons are triangulated as fans. before is the number of vertices before each face."""
+	lengths = np.array([len(field.split()) for field in fields])
+	indices = _parse_numbers(fields, np.int64, lengths.sum())
+	face_of_index = np.repeat(np.arange(len(fields)), lengths)
+	indices = np.where(indices < 0, before[face_of_index] + indices, indices - 1)
+	# the fan of a face with k corners has the triangles (0, i, i + 1) for i from 1 to k - 2
+	fan_sizes = np.maximum(lengths - 2, 0)
+	first = np.repeat(np.cumsum(lengths) - lengths, fan_sizes)
+	i = np.arange(fan_sizes.sum()) - np.repeat(np.cumsum(fan_sizes) - fan_sizes, fan_sizes) + 1
+	return np.stack([indices[first], indices[first + i], indices[first + i + 1]], axis=1)
+
+
+def _read_3mf(path):
+	"""Return the triangles of the objects on the build plate of a 3MF as array of shape (n, 3, 3), the objects are
+	placed with their transforms and merged into one mesh."""
+	with zipfile.ZipFile(path) as archive:
+		name = next((n for n in archive.namelist() if n.lower().endswith(".model")), None)
+		if name is None:
+			raise ValueError("The 3MF file holds no model")
+		root = ET.fromstring(archive.read(name))
+	ns = {"m": root.tag[1:].split("}")[0] if root.tag.startswith("{") else ""}
+	scale = UNITS_3MF.get(root.get("unit", "millimeter"), 1.0)
+	objects = {obj.get("id"): obj for obj in root.iterfind("m:resources/m:object", ns)}
+
+	def transform(element):
+		values = element.get("transform")
+		matrix = np.identity(4)
+		if values:
+			matrix[:, :3] = np.array(values.split(), dtype=np.float64).reshape(4, 3)
+		return matrix
+
+	def triangles(object_id, matrix, depth=0):
+		obj = objects.get(object_id)
+		if obj is None or depth > 16:
+			raise ValueError(f"The 3MF file refers to the invalid object '{object_id}'")
+		mesh = obj.find("m:mesh", ns)
+		if mesh is None:
+			return [t for c in obj.iterfind("m:components/m:component", ns)
+					for t in triangles(c.get("objectid"), transform(c) @ matrix, depth + 1)]
+		vertices = np.array([(v.get("x"), v.get("y"), v.get("z")) for v in mesh.iterfind("m:vertices/m:vertex", ns)],
+							dtype=np.float64).reshape(-1, 3)
+		faces = np.array([(t.get("v1"), t.get("v2"), t.get("v3")) for t in mesh.iterfind("m:triangles/m:triangle", ns)],
+						 dtype=np.int64).reshape(-1, 3)
+		# 3MF uses row vectors, the last row of the matrix is the translation
+		vertices = vertices @ matrix[:3, :3] + matrix[3, :3]
+		return [vertices[faces]]
+
+	parts = [t for item in root.iterfind("m:build/m:item", ns) for t in triangles(item.get("objectid"), transform(item))]
+	return (np.concatenate(parts) * scale).astype(np.float32) if parts else np.empty((0, 3, 3), np.float32)
+
+
+def load_triangles(path):
+	"""Return the triangles of the STL, OBJ or 3MF model as array of shape (n, 3, 3)."""
+	extension = os.path.splitext(path)[1].lower()
+	if extension == ".3mf":
+		return _read_3mf(path)
+	with open(path, "rb") as f:
+		data = f.read()
+	if extension == ".obj":
+		return _read_obj(data)
+	return _read_stl(data)
+
+
+def clean_mesh(triangles):
+	"""Merge identical vertices and drop degenerate triangles, return the vertices and the faces as indices into them."""
+	# the vertices are compared by their bytes, which is faster than np.unique along an axis, -0.0 becomes 0.0
+	points = np.ascontiguousarray(triangles.reshape(-1, 3), dtype=np.float32) + np.float32(0.0)
+	_, first, faces = np.unique(points.view(np.dtype((np.void, points.itemsize * 3))).ravel(),
+								return_index=True, return_inverse=True)
+	vertices = points[first]
+	faces = faces.reshape(-1, 3)
+	# triangles that collapsed to a line or a point, by sharing a vertex or by having no area
+	distinct = (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])
+	corners = vertices[faces].astype(np.float64)
+	double_area = np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1)
+	return vertices, faces[distinct & (double_area > MIN_DOUBLE_AREA)]
+
+
+def _cluster(points, origin, cell_size):
+	"""Merge the points within each cubic cell into their mean, return the triangles of the merged points without
+	the ones that collapsed, flipped or that occur twice."""
+	cells = np.floor((points - origin) / cell_size).astype(np.int64)
+	dims = cells.max(axis=0) + 1
+	_, inverse, counts = np.unique((cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2],
+								   return_inverse=True, return_counts=True)
+	inverse = inverse.ravel()
+	means = np.stack([np.bincount(inverse, weights=points[:, i]) for i in range(3)], axis=1) / counts[:, None]
+	faces = inverse.reshape(-1, 3)
+	corners = points.reshape(-1, 3, 3)
+	merged = means[faces]
+	# thin parts fold over when their sides fall into the same cells, the faces that turned around are dropped
+	normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+	merged_normals = np.cross(merged[:, 1] - merged[:, 0], merged[:, 2] - merged[:, 0])
+	valid = (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])
+	valid &= np.einsum("ij,ij->i", normals, merged_normals) > 0
+	faces = faces[valid]
+	_, first = np.unique(np.sort(faces, axis=1), axis=0, return_index=True)
+	return means[faces[np.sort(first)]]
+
+
+def decimate(triangles, max_triangles):
+	"""Return a proxy of the triangles of shape (n, 3, 3) with about max_triangles triangles by vertex clustering,
+	and the edge length of the clustering cells, which bounds the deviation of the proxy from the mesh."""
+	points = np.asarray(triangles, dtype=np.float64).reshape(-1, 3)
+	if len(points) <= 3 * max_triangles:
+		return points.reshape(-1, 3, 3), 0.0
+	corners = points.reshape(-1, 3, 3)
+	area = np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1).sum() / 2
+	# a surface meshed by cells of this size has about the number of triangles of the budget
+	cell_size = np.sqrt(2 * area / max_triangles)
+	origin = points.min(axis=0)
+	best = None
+	for _ in range(DECIMATION_ATTEMPTS):
+		proxy = _cluster(points, origin, cell_size)
+		if len(proxy) <= max_triangles and (best is None or len(proxy) > len(best[0])):
+			best = proxy, float(cell_size)
+		if len(proxy) > max_triangles:
+			cell_size *= 1.05 * np.sqrt(len(proxy) / max_triangles)
+		elif len(proxy) < max_triangles / 4:  # meshes of few large triangles collapse, try finer cells
+			cell_size /= 2
+		else:
+			break
+	return best if best is not None else (proxy, float(cell_size))
+
+
+def count_triangles(path):
+	"""Return the number of triangles of a binary STL from its header, or None if the file is no binary STL."""
+	with open(path, "rb") as f:
+		header = f.read(STL_HEADER_SIZE)
+	if len(header) < STL_HEADER_SIZE:
+		return None
+	n = int(np.frombuffer(header, "<u4", count=1, offset=80)[0])
+	return n if os.path.getsize(path) == STL_HEADER_SIZE + n * STL_DTYPE.itemsize else None
+
+
+def write_binary_stl(path, triangles):
+	"""Write the triangles of shape (n, 3, 3) as binary STL with the normals of the faces."""
+	stl = np.zeros(len(triangles), STL_DTYPE)
+	stl["vertices"] = triangles
+	normals = np.cross(stl["vertices"][:, 1] - stl["vertices"][:, 0], stl["vertices"][:, 2] - stl["vertices"][:, 0])
+	# tiny triangles may have no normal in single precision, it is left zero
+	stl["normal"] = normals / np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), np.finfo(np.float32).tiny)
+	with open(path, "wb") as f:
+		f.write(STL_HEADER.ljust(80, b" "))
+		f.write(np.uint32(len(triangles)).tobytes())
+		stl.tofile(f)
+
+
+def rotate_model(input_path, output_path, matrix):
+	"""Write the model rotated by the matrix as binary STL, the matrix is applied to row vectors like the ones of
+	Tweaker-3."""
+	triangles = load_triangles(input_path)
+	write_binary_stl(output_path, (triangles @ np.asarray(matrix, dtype=np.float64)).astype(np.float32))
+
+
+def normalise_model(input_path, output_path):
+	"""Convert the model to a clean binary STL in output_path, which may be the input_path. Return the number of
+	triangles that were read and that were written. Raise a ValueError if the model can't be read or is empty."""
+	try:
+		triangles = load_triangles(input_path)
+	except (OSError, ValueError, zipfile.BadZipFile, ET.ParseError, IndexError, TypeError) as e:
+		raise ValueError(f"The model '{os.path.basename(input_path)}' couldn't be read: {e}")
+	vertices, faces = clean_mesh(triangles)
+	if len(faces) == 0:
+		raise ValueError(f"The model '{os.path.basename(input_path)}' has no valid triangles")
+	# write to a temporary file first, so that the input is intact if writing fails
+	fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", suffix=".stl", dir=os.path.dirname(output_path))
+	os.close(fd)
+	try:
+		write_binary_stl(tmp_path, vertices[faces])
+		os.replace(tmp_path, output_path)
+	except BaseException:
+		os.remove(tmp_path)
+		raise
+	return len(triangles), len(faces)
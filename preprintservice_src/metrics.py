@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Metrics in the text exposition format of Prometheus, without further dependencies.
+
+Counters and histograms are updated where things happen, values that are kept elsewhere, like the size of the cache,
+are read by collectors at the time of the scrape.
+"""
+import math
+import threading
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _format_value(value):
+	if math.isinf(value):
+		return "+Inf" if value > 0 else "-Inf"
+	return repr(float(value))
+
+
+def _format_labels(labels):
+	if not labels:
+		return ""
+	escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for v in labels.values())
+	return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels.keys(), escaped)) + "}"
+
+
+class Metric:
+	"""Base of the metrics, holding one value per combination of label values."""
+	kind = None
+
+	def __init__(self, name, documentation, labelnames=()):
+		self.name = name
+		self.documentation = documentation
+		self.labelnames = tuple(labelnames)
+		self._values = dict()
+		self._lock = threading.Lock()
+
+	def _key(self, labels):
+		if set(labels) != set(self.labelnames):
+			raise ValueError(f"Metric '{self.name}' expects the labels {self.labelnames}, got {tuple(labels)}")
+		return tuple(str(labels[name]) for name in self.labelnames)
+
+	def samples(self):
+		"""Return the list of (name, labels, value) of this metric."""
+		with self._lock:
+			return [(self.name, dict(zip(self.labelnames, key)), value) for key, value in self._values.items()]
+
+	def render(self):
+		lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+		lines += [f"{name}{_format_labels(labels)} {_format_value(value)}" for name, labels, value in self.samples()]
+		return "\n".join(lines)
+
+
+class Counter(Metric):
+	kind = "counter"
+
+	def inc(self, amount=1, **labels):
+		key = self._key(labels)
+		with self._lock:
+			self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+	kind = "gauge"
+
+	def set(self, value, **labels):
+		key = self._key(labels)
+		with self._lock:
+			self._values[key] = value
+
+
+class Histogram(Metric):
+	kind = "histogram"
+
+	def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+		super().__init__(name, documentation, labelnames)
+		self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+	def observe(self, value, **labels):
+		key = self._key(labels)
+		with self._lock:
+			counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+			for i, bound in enumerate(self.buckets):
+				if value <= bound:
+					counts[i] += 1
+			self._values[key] = (counts, total + value)
+
+	def samples(self):
+		samples = list()
+		with self._lock:
+			for key, (counts, total) in self._values.items():
+				labels = dict(zip(self.labelnames, key))
+				for bound, count in zip(self.buckets, counts):
+					samples.append((self.name + "_bucket", dict(labels, le=_format_value(bound)), count))
+				samples.append((self.name + "_sum", labels, total))
+				samples.append((self.name + "_count", labels, counts[-1]))
+		return samples
+
+
+class Registry:
+	"""Holds the metrics and the collectors, which return further metrics at the time of the scrape."""
+
+	def __init__(self):
+		self._metrics = list()
+		self._collectors = list()
+
+	def register(self, metric):
+		self._metrics.append(metric)
+		return metric
+
+	def counter(self, name, documentation, labelnames=()):
+		return self.register(Counter(name, documentation, labelnames))
+
+	def histogram(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+		return self.register(Histogram(name, documentation, labelnames, buckets))
+
+	def add_collector(self, collector):
+		"""Add a function that returns a list of metrics, it is called on each scrape."""
+		self._collectors.append(collector)
+		return collector
+
+	def render(self):
+		metrics = list(self._metrics)
+		for collector in self._collectors:
+			metrics += collector()
+		return "\n".join(metric.render() for metric in metrics) + "\n"
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""Auto-orientation with Tweaker-3, which is imported once in each process of a pool of warm workers.
+
+Running Tweaker.py as a subprocess for each request costs the startup of the interpreter and the import of NumPy,
+the workers instead keep Tweaker-3 loaded and orient the models by function calls. Huge meshes can be oriented on a
+decimated proxy, so that the time of Tweaker-3 is bounded by the size of the proxy instead of the one of the model.
+"""
+import os
+import sys
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from jobs import JobError, JobCancelled
+from mesh import count_triangles, load_triangles, write_binary_stl, decimate
+
+logger = logging.getLogger(__name__)
+
+# modules of Tweaker-3, imported by the initializer of each worker
+MeshTweaker = None
+FileHandler = None
+
+
+def _init_worker(tweaker_path):
+	global MeshTweaker, FileHandler
+	sys.path.insert(0, tweaker_path)
+	import MeshTweaker
+	import FileHandler
+
+
+def _warm_up():
+	return os.getpid()
+
+
+def _orient(input_path, output_path, extended_mode, min_volume):
+	"""Auto-orient the model in input_path and write it as binary STL to output_path, this runs within a worker.
+	Return the rotation matrix and the metrics of the best orientation of the largest part."""
+	cpu_start = time.process_time()
+	file_handler = FileHandler.FileHandler()
+	objs = file_handler.load_mesh(input_path)
+	if objs is None:
+		raise ValueError(f"The model '{os.path.basename(input_path)}' couldn't be loaded")
+	info = dict()
+	for part, content in objs.items():
+		x = MeshTweaker.Tweak(content["mesh"], extended_mode, False, False, None, min_volume)
+		info[part] = dict(matrix=x.matrix, tweaker_stats=x, size=len(content["mesh"]))
+	file_handler.write_mesh(objs, info, output_path, "binarystl")
+	# binary STL holds only the largest part, report the orientation of that one
+	stats = max(info.values(), key=lambda i: i["size"])["tweaker_stats"]
+	# the attributes of Tweaker-3 are read without defaults, so that a renamed one fails instead of reporting zeros
+	return dict(matrix=[[float(v) for v in row] for row in stats.matrix],
+				unprintability=float(stats.unprintability),
+				bottom_area=float(stats.bottom_area),
+				overhang=float(stats.overhang_area),
+				contour=float(stats.contour),
+				cpu_time=time.process_time() - cpu_start)
+
+
+class OrientationPool:
+	"""Pool of max_workers processes that keep Tweaker-3 loaded. The processes are forked and warmed up at
+	creation, and the pool is recreated if a worker dies, e.g. because it ran out of memory. Meshes of more than
+	proxy_triangles triangles are oriented on a proxy decimated to about this size, 0 orients all meshes in full."""
+
+	def __init__(self, tweaker_path, max_workers, proxy_triangles=0):
+		self.tweaker_path = tweaker_path
+		self.max_workers = max_workers
+		self.proxy_triangles = proxy_triangles
+		self.orientations = 0
+		self.failures = 0
+		self.restarts = 0
+		self.cpu_time = 0.0  # of the workers, in seconds
+		self._lock = threading.Lock()
+		self._executor = None
+		self._start()
+
+	def _start(self):
+		self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+											 mp_context=multiprocessing.get_context("fork"),
+											 initializer=_init_worker, initargs=(self.tweaker_path,))
+		for _ in range(self.max_workers):
+			self._executor.submit(_warm_up)
+		logger.info(f"Started {self.max_workers} workers for the auto-orientation")
+
+	def _restart(self, broken_executor):
+		with self._lock:
+			if self._executor is broken_executor:  # it might have been restarted by another job already
+				logger.error("A worker of the auto-orientation died, restarting the pool")
+				broken_executor.shutdown(wait=False)
+				self._start()
+				self.restarts += 1
+
+	def orient(self, input_path, output_path, extended_mode, min_volume, job, poll_interval=1.0):
+		"""Auto-orient the model on a worker and wait for the result. If the job is cancelled, it stops waiting,
+		the worker finishes the orientation in the background as it can't be interrupted."""
+		triangles = count_triangles(input_path)
+		if self.proxy_triangles and triangles and triangles > self.proxy_triangles:
+			return self._orient_proxy(input_path, output_path, extended_mode, min_volume, job, poll_interval)
+		result, = self._run([(_orient, input_path, output_path, extended_mode, min_volume)], job, poll_interval)
+		self._count(cpu_time=result["cpu_time"])
+		return result
+
+	def _orient_proxy(self, input_path, output_path, extended_mode, min_volume, job, poll_interval):
+		"""Orient a proxy of the model with Tweaker-3 and apply its rotation to the full mesh. The metrics are the
+		ones of the proxy, the result reports its size and the cell size of the decimation, which bounds the
+		deviation of the proxy from the mesh."""
+		cpu_start = time.thread_time()
+		try:
+			triangles = load_triangles(input_path)
+			proxy, cell_size = decimate(triangles, self.proxy_triangles)
+		except ValueError as e:
+			self._count(failed=True)
+			raise JobError(f"Tweaking failed: {e}")
+		if len(proxy) < 4:  # the mesh collapsed, e.g. as it consists of thin parts only
+			logger.warning(f"The proxy of the model collapsed to {len(proxy)} triangles, orienting the full mesh")
+			result, = self._run([(_orient, input_path, output_path, extended_mode, min_volume)], job, poll_interval)
+			self._count(cpu_time=result["cpu_time"])
+			return result
+		proxy_path = f"{output_path}.proxy.stl"
+		tweaked_proxy_path = f"{output_path}.tweaked-proxy.stl"
+		try:
+			write_binary_stl(proxy_path, proxy.astype(np.float32))
+			result, = self._run([(_orient, proxy_path, tweaked_proxy_path, extended_mode, min_volume)], job,
+								poll_interval)
+			write_binary_stl(output_path, (triangles @ np.asarray(result["matrix"], np.float64)).astype(np.float32))
+		finally:
+			for path in [proxy_path, tweaked_proxy_path]:
+				if os.path.exists(path):
+					os.remove(path)
+		result["cpu_time"] += time.thread_time() - cpu_start
+		result["proxy"] = dict(triangles=len(proxy), cell_size=cell_size)
+		logger.info(f"Oriented a proxy of {len(proxy)} of {len(triangles)} triangles with cells of {cell_size:.3g} mm")
+		self._count(cpu_time=result["cpu_time"])
+		return result
+
+	def _run(self, calls, job, poll_interval):
+		"""Submit the calls given as tuples of the function and its arguments to the workers and return their
+		results, the cancellation of the job is checked while waiting."""
+		executor = self._executor
+		try:
+			futures = [executor.submit(*call) for call in calls]
+			results = list()
+			for future in futures:
+				while True:
+					try:
+						results.append(future.result(timeout=poll_interval))
+						break
+					except TimeoutError:
+						job.check_cancelled()
+			return results
+		except JobCancelled:
+			raise
+		except BrokenProcessPool:
+			self._restart(executor)
+			self._count(failed=True)
+			raise JobError("Tweaking failed, as the worker process died unexpectedly")
+		except Exception as e:
+			self._count(failed=True)
+			raise JobError(f"Tweaking failed: {e}")
+
+	def _count(self, failed=False, cpu_time=0.0):
+		with self._lock:
+			self.orientations += 1
+			self.failures += failed
+			self.cpu_time += cpu_time
+
+	def stats(self):
+		with self._lock:
+			return dict(workers=self.max_workers, orientations=self.orientations, failures=self.failures,
+						restarts=self.restarts, cpu_time=self.cpu_time)
@@ -1,22 +1,45 @@
 #!/usr/bin/env python3
 import os
-import sys
 import urllib3
 import requests
 import logging
+import re
+import json
+import time
+import hashlib
+import shutil
+import zipfile
 import argparse
 import subprocess as sp
 
-from flask import Flask, flash, request, redirect, url_for, Response, render_template, send_from_directory, make_response, jsonify
+from flask import Flask, flash, request, redirect, url_for, Response, render_template, send_file, send_from_directory, make_response, jsonify
 from flask_swagger_ui import get_swaggerui_blueprint
 from werkzeug.utils import secure_filename
 from werkzeug.exceptions import abort, RequestEntityTooLarge
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from compression import is_compressible, negotiate_encoding, compressed_copy, decompress_request_body
+from delivery import DeliveryQueue
+from gcode_analysis import analyse_gcode
+from jobs import JobManager, JobQueueFull, JobError, JobCancelled
+from mesh import normalise_model, rotate_model
+from metrics import Registry, Counter, Gauge, CONTENT_TYPE
+from orientation import OrientationPool
+from profile_registry import ProfileRegistry
+from result_cache import ResultCache, make_cache_key, make_orientation_key
+from sessions import SessionPool
+from slicer import SlicerPool, parse_cpu_list
+from workspace import Workspace, WorkspaceFull
 
 
 # If the file size is over 100MB, tweaking would lack due to performance issues.
 # MAX_CONTENT_LENGTH = 100 * 1024 * 1024
 ALLOWED_EXTENSIONS = {'stl', '3mf', 'obj'}
+# progress lines of the slicer, e.g. "30 => Generating perimeters"
+SLICER_PROGRESS_PATTERN = re.compile(rb"^\s*(\d+) => (.*?)\s*$")
 LOCAL_SLIC3R_PATH = "/home/cschranz/software/Slic3r/slic3r-dist/bin/prusa-slicer"
+MAX_LONG_POLL = 30  # in seconds
+ANALYSIS_HEADER = "X-PrePrint-Analysis"
 SWAGGER_URL = '/api'
 API_URL = '/static/swagger.yaml'  # the main directory of the app
 
@@ -46,9 +69,48 @@ if len(CURPATH) <= 2:
 app.config['UPLOAD_FOLDER'] = os.path.join(CURPATH, "uploads")
 app.config['PROFILE_FOLDER'] = os.path.join(CURPATH, "profiles")
 app.config['DEFAULT_PROFILE'] = os.path.join(app.config['PROFILE_FOLDER'], "profile_015mm_none.ini")
+# profiles uploaded by their SHA-256 hash, the folder is separate so that they aren't listed with the named profiles
+app.config['PROFILE_REGISTRY_FOLDER'] = os.environ.get("PROFILE_REGISTRY_FOLDER", os.path.join(CURPATH, "profile_registry"))
+app.config['CACHE_FOLDER'] = os.environ.get("CACHE_FOLDER", os.path.join(CURPATH, "cache"))
+app.config['CACHE_MAX_SIZE'] = int(os.environ.get("CACHE_MAX_SIZE", 1024 * 1024 * 1024))  # in bytes, 0 disables the cache
+# limit of compressed request bodies after decompression, in bytes, 0 disables the limit
+app.config['MAX_DECOMPRESSED_SIZE'] = int(os.environ.get("MAX_DECOMPRESSED_SIZE", 1024 * 1024 * 1024))
+# orientations are cached separately, so that they are reused when the same model is sliced with other profiles
+app.config['ORIENTATION_CACHE_FOLDER'] = os.environ.get("ORIENTATION_CACHE_FOLDER", os.path.join(CURPATH, "orientation_cache"))
+app.config['ORIENTATION_CACHE_MAX_SIZE'] = int(os.environ.get("ORIENTATION_CACHE_MAX_SIZE", 16 * 1024 * 1024))
+app.config['JOB_WORKERS'] = int(os.environ.get("JOB_WORKERS", os.cpu_count() or 1))
+app.config['JOB_QUEUE_SIZE'] = int(os.environ.get("JOB_QUEUE_SIZE", 4 * app.config['JOB_WORKERS']))
+app.config['JOB_RETENTION'] = int(os.environ.get("JOB_RETENTION", 60 * 60))  # in seconds
+app.config['TWEAKER_PATH'] = os.environ.get("TWEAKER_PATH", os.path.join(CURPATH, "Tweaker-3"))
+app.config['ORIENTATION_WORKERS'] = int(os.environ.get("ORIENTATION_WORKERS", os.cpu_count() or 1))
+# larger meshes are oriented by Tweaker-3 on a proxy decimated to about this size, 0 orients all meshes in full
+app.config['ORIENTATION_PROXY_TRIANGLES'] = int(os.environ.get("ORIENTATION_PROXY_TRIANGLES", 0))
+app.config['SLICER_WORKERS'] = int(os.environ.get("SLICER_WORKERS", os.cpu_count() or 1))
+app.config['SLICER_CPUS'] = parse_cpu_list(os.environ.get("SLICER_CPUS", ""))  # e.g. "2-7", empty disables pinning
+app.config['SLICER_NICE'] = int(os.environ.get("SLICER_NICE", 0))
+app.config['BATCH_MAX_MODELS'] = int(os.environ.get("BATCH_MAX_MODELS", 100))
+# timeouts to connect to OctoPrint and to wait for its response when sending back the tweaked model, in seconds
+app.config['OCTOPRINT_TIMEOUT'] = (float(os.environ.get("OCTOPRINT_CONNECT_TIMEOUT", 5)),
+								   float(os.environ.get("OCTOPRINT_READ_TIMEOUT", 60)))
+app.config['OCTOPRINT_RETRIES'] = int(os.environ.get("OCTOPRINT_RETRIES", 3))
+# the tweaked models are delivered to OctoPrint in the background, failed deliveries are retried with a backoff that
+# doubles from DELIVERY_BACKOFF up to DELIVERY_MAX_BACKOFF seconds
+app.config['DELIVERY_WORKERS'] = int(os.environ.get("DELIVERY_WORKERS", 2))
+app.config['DELIVERY_ATTEMPTS'] = int(os.environ.get("DELIVERY_ATTEMPTS", 5))
+app.config['DELIVERY_BACKOFF'] = float(os.environ.get("DELIVERY_BACKOFF", 2))
+app.config['DELIVERY_MAX_BACKOFF'] = float(os.environ.get("DELIVERY_MAX_BACKOFF", 60))
+# each request gets its own work directory, small ones on a tmpfs like /dev/shm if WORK_TMPFS_FOLDER is set
+app.config['WORK_FOLDER'] = os.environ.get("WORK_FOLDER", app.config['UPLOAD_FOLDER'])
+app.config['WORK_TMPFS_FOLDER'] = os.environ.get("WORK_TMPFS_FOLDER") or None
+app.config['WORK_TMPFS_MAX_SIZE'] = int(os.environ.get("WORK_TMPFS_MAX_SIZE", 16 * 1024 * 1024))  # in bytes
+app.config['WORK_MAX_AGE'] = int(os.environ.get("WORK_MAX_AGE", app.config['JOB_RETENTION']))  # in seconds
+app.config['WORK_QUOTA'] = int(os.environ.get("WORK_QUOTA", 5 * 1024 * 1024 * 1024))  # in bytes, 0 disables the quota
+# the models that wait for their delivery to OctoPrint, they outlive the work directories of their jobs
+app.config['DELIVERY_FOLDER'] = os.environ.get("DELIVERY_FOLDER", os.path.join(app.config['WORK_FOLDER'], "deliveries"))
+app.config['WORK_CLEAN_INTERVAL'] = int(os.environ.get("WORK_CLEAN_INTERVAL", 60))  # in seconds
 
 # search and select the appropriate slic3r path
-for path in  ["/Slic3r/slic3r-dist/bin/prusa-slicer", LOCAL_SLIC3R_PATH]:
+for path in  [os.environ.get("SLIC3R_PATH", ""), "/Slic3r/slic3r-dist/bin/prusa-slicer", LOCAL_SLIC3R_PATH]:
 	if os.path.isfile(path):
 		app.config['SLIC3R_PATH'] = path
 		app.logger.info(f"Slic3r was loaded from '{path}'")
@@ -59,190 +121,821 @@ if 'SLIC3R_PATH' not in app.config:
 	app.logger.warning("The slicing functionality can't be used.")
 
 
+def get_slicer_version(slicer_path):
+	"""Return the version string of the slicer, that is the first line of its help text."""
+	if not slicer_path:
+		return "none"
+	try:
+		pipe = sp.run([slicer_path, "--help"], stdout=sp.PIPE, stderr=sp.PIPE, timeout=30)
+		version = pipe.stdout.decode("utf-8", errors="replace").strip().split("\n")[0]
+	except (OSError, sp.SubprocessError) as e:
+		app.logger.warning(f"Can't get the version of the slicer: {e}")
+		version = ""
+	# fall back to the path and the modification time of the binary, which changes with each update
+	return version or f"{slicer_path}@{os.path.getmtime(slicer_path)}"
+
+
+app.config['SLIC3R_VERSION'] = get_slicer_version(app.config.get('SLIC3R_PATH'))
+app.logger.info(f"Using slicer version '{app.config['SLIC3R_VERSION']}'")
+
+
+def get_tweaker_version(tweaker_path):
+	"""Return the version of Tweaker-3, that is the hash of its modules, which changes with each update."""
+	h = hashlib.sha256()
+	for name in ["MeshTweaker.py", "FileHandler.py"]:
+		try:
+			with open(os.path.join(tweaker_path, name), "rb") as f:
+				h.update(f.read())
+		except OSError:
+			return "none"
+	return h.hexdigest()[:16]
+
+
+app.config['TWEAKER_VERSION'] = get_tweaker_version(app.config['TWEAKER_PATH'])
+# the orientations depend on the version of Tweaker-3 and on the size of the proxy, they are part of the keys of the caches
+app.config['ORIENTATION_VERSION'] = (f"tweaker {app.config['TWEAKER_VERSION']}, "
+									 f"proxy {app.config['ORIENTATION_PROXY_TRIANGLES']}")
+app.logger.info(f"Using orientation version '{app.config['ORIENTATION_VERSION']}'")
+
+# create the metrics of the service, which are exposed on /metrics
+metrics = Registry()
+stage_duration = metrics.histogram("preprintservice_stage_duration_seconds",
+								   "Duration of the stages of processing a model.", ["stage"])
+http_requests = metrics.counter("preprintservice_http_requests_total", "Handled HTTP requests.",
+								["endpoint", "method", "code"])
+received_bytes = metrics.counter("preprintservice_received_bytes_total", "Bytes received in the bodies of requests.")
+sent_bytes = metrics.counter("preprintservice_sent_bytes_total", "Bytes sent to the clients and back to OctoPrint.",
+							 ["destination"])
+jobs_done = metrics.counter("preprintservice_jobs_done_total", "Jobs that are done, by their final status.", ["status"])
+deliveries_done = metrics.counter("preprintservice_deliveries_done_total",
+								  "Deliveries of tweaked models to OctoPrint that are done, by their final status.", ["status"])
+
+
+def record_job(job):
+	"""Record the final status of the job and the durations of its stages."""
+	jobs_done.inc(status=job.status)
+	for stage, times in job.stages.items():
+		if times["finished"] is not None:
+			stage_duration.observe(times["finished"] - times["started"], stage=stage)
+
+
+def record_delivery(delivery):
+	"""Record the final status of the delivery, its duration including the retries and the sent bytes."""
+	deliveries_done.inc(status=delivery.status)
+	stage_duration.observe(delivery.finished - delivery.created, stage="delivery")
+	if delivery.status == "delivered":
+		sent_bytes.inc(delivery.size, destination="octoprint")
+
+
+# create the store of the profiles that are referred to by their hash
+profile_registry = ProfileRegistry(app.config['PROFILE_REGISTRY_FOLDER'])
+# create the cache for tweaked models and machine code
+result_cache = ResultCache(app.config['CACHE_FOLDER'], app.config['CACHE_MAX_SIZE'])
+# create the cache for the orientations of the models, independent of the profile
+orientation_cache = ResultCache(app.config['ORIENTATION_CACHE_FOLDER'], app.config['ORIENTATION_CACHE_MAX_SIZE'])
+# create the bounded pool of workers that process the models
+job_manager = JobManager(app.config['JOB_WORKERS'], app.config['JOB_QUEUE_SIZE'], app.config['JOB_RETENTION'],
+						 on_done=record_job)
+# create the warm workers that keep Tweaker-3 loaded, before any other thread is started
+if not os.path.isfile(os.path.join(app.config['TWEAKER_PATH'], "MeshTweaker.py")):
+	app.logger.warning(f"Tweaker-3 can't be found in '{app.config['TWEAKER_PATH']}', the auto-orientation can't be used.")
+orientation_pool = OrientationPool(app.config['TWEAKER_PATH'], app.config['ORIENTATION_WORKERS'],
+								   proxy_triangles=app.config['ORIENTATION_PROXY_TRIANGLES'])
+# limit the number of concurrent slicers, further slicing requests wait in a FIFO queue
+slicer_pool = SlicerPool(app.config.get('SLIC3R_PATH'), app.config['SLICER_WORKERS'],
+						 cpus=app.config['SLICER_CPUS'], nice=app.config['SLICER_NICE'])
+# keep the connections to the OctoPrint servers alive, one session per host
+octoprint_sessions = SessionPool(app.config['OCTOPRINT_RETRIES'])
+# upload the tweaked models to OctoPrint in the background, while the jobs go on with slicing
+delivery_queue = DeliveryQueue(app.config['DELIVERY_FOLDER'], octoprint_sessions, app.config['OCTOPRINT_TIMEOUT'],
+							   app.config['DELIVERY_WORKERS'], app.config['DELIVERY_ATTEMPTS'], app.config['DELIVERY_BACKOFF'],
+							   app.config['DELIVERY_MAX_BACKOFF'], app.config['JOB_RETENTION'], on_done=record_delivery)
+# isolate the files of each request and remove the retained results once they expire or exceed the quota
+workspace = Workspace(app.config['WORK_FOLDER'], app.config['WORK_QUOTA'], app.config['WORK_MAX_AGE'],
+					  tmpfs_folder=app.config['WORK_TMPFS_FOLDER'], tmpfs_max_size=app.config['WORK_TMPFS_MAX_SIZE'])
+workspace.start_janitor(app.config['WORK_CLEAN_INTERVAL'])
+
+
 def allowed_file(filename):
 	"""Return if the filename has an allowed extension."""
 	return '.' in filename and filename.split('.')[-1].lower() in ALLOWED_EXTENSIONS
 
 
+class InvalidRequest(Exception):
+	"""Raised if the model or the profile of a request is missing or invalid."""
+
+
+def parse_tweak_option(default):
+	"""Return the tweak_option of the request, or the default. Raise an InvalidRequest if the orientation should be
+	returned without auto-orienting the model, as there would be nothing to return."""
+	tweak_option = request.form.get("tweak_option", default)
+	if tweak_option.endswith("_returnorientation") and (not tweak_option.startswith("tweak_") or "_keep" in tweak_option):
+		raise InvalidRequest(f"Invalid tweak_option '{tweak_option}', '_returnorientation' requires an auto-orientation")
+	app.logger.info(f"Using Tweaker options: '{tweak_option}'")
+	return tweak_option
+
+
+def save_model(uploaded_file, work_dir, filename=None):
+	"""Check the uploaded model file and save it in the work directory, return the filename it was saved as."""
+	# if no file was selected, submit an empty one
+	if uploaded_file.filename == '':
+		raise InvalidRequest('No selected model')
+	if not (uploaded_file and allowed_file(uploaded_file.filename)):
+		raise InvalidRequest('Invalid model extension')
+	filename = filename or secure_filename(uploaded_file.filename)
+	app.logger.info(f"Uploaded new model: {filename}")
+	uploaded_file.save(os.path.join(work_dir, filename))
+	app.logger.info(f"Saved model to '{os.path.join(work_dir, filename)}'")
+	return filename
+
+
+def parse_profile(work_dir):
+	"""Return the path of the profile of the current request, which is uploaded into the work directory, referred to
+	by its hash in the field 'profile_hash' or selected by name, or None if the model shouldn't be sliced."""
+	if request.form.get("profile_hash"):
+		profile_path = profile_registry.get(request.form.get("profile_hash"))
+		if profile_path is None:
+			raise InvalidRequest(f"Unknown profile '{request.form.get('profile_hash')}', upload it with PUT /profiles/<sha256>")
+	elif 'profile' in request.files:
+		# in webUI, there is always this option available, no slicing is called 'no_slicing'
+		profile = request.files["profile"]
+		if profile.filename == '':
+			raise InvalidRequest('No selected profile')
+		elif profile == "no_slicing":
+			profile_path = None
+		else:
+			profilename = secure_filename(profile.filename)
+			app.logger.info("Uploaded new profile: {}".format(profilename))
+			profile_path = os.path.join(work_dir, profilename)
+			profile.save(profile_path)
+	else:
+		if request.form.get("profile"):
+			profile = request.form.get("profile")
+			if profile == "no_slicing":
+				profile_path = None
+			else:
+				profile_path = os.path.join(app.config["PROFILE_FOLDER"], profile)
+				if not os.path.exists(profile_path):
+					profile_path = app.config['DEFAULT_PROFILE']
+		else:
+			profile_path = None
+	app.logger.info("Using profile: '{}'".format(profile_path))
+	return profile_path
+
+
+def parse_tweak_request(work_dir):
+	"""Save the uploaded files of the current request into the work directory and return the parameters for
+	process_model."""
+	app.logger.debug("request on: %s", request)
+	upload_start = time.time()  # the body of the request is received at the first access of the form
+	# available keys in request.forms: 'machinecode_name', 'tweak_option', 'request_source' 'octoprint_url', 'apikey'
+
+	# 0) Get url on which to upload the requested file
+	if request.form.get("octoprint_url") is not None:
+		app.logger.info(f'Getting request from octoprint server: {request.form.get("octoprint_url")}')
+	else:
+		app.logger.info("Getting request from user interface")
+	app.logger.info(f"Request with payload: {dict(request.form).items()}")
+
+	# 1) Check if the input is correct
+	# 1.1) Get the model file and check for correctness
+	if 'model' not in request.files:
+		raise InvalidRequest('No model file in request')
+	filename = save_model(request.files['model'], work_dir)
+
+	# 1.2) Get the profile
+	profile_path = parse_profile(work_dir)
+
+	# 1.3) Get the tweak actions
+	# Get the tweak option and use extended_volume as default
+	# of the form: "tweak_extended_volume_returntweaked")
+	tweak_option = parse_tweak_option("tweak_extended_volume_returntweaked")
+	stage_duration.observe(time.time() - upload_start, stage="upload")
+
+	return dict(filename=filename,
+				work_dir=work_dir,
+				profile_path=profile_path,
+				tweak_option=tweak_option,
+				machinecode_name=request.form.get("machinecode_name"),
+				request_source=request.form.get("request_source"),
+				octoprint_url=request.form.get("octoprint_url"),
+				apikey=request.form.get("apikey"),
+				bypass_cache=request.form.get("cache") == "bypass" or "no-cache" in request.headers.get("Cache-Control", ""))
+
+
+def parse_batch_request(work_dir):
+	"""Save the models of a batch, uploaded as multiple files in 'model' or as zip archive in 'models', into the work
+	directory and return the parameters for process_batch. All models of a batch share the profile and the tweak_option."""
+	upload_start = time.time()
+	app.logger.info(f"Batch request with payload: {dict(request.form).items()}")
+	filenames = list()
+
+	def unique_name(name):
+		# models of a batch may have the same name, e.g. in different folders of the archive, the names must differ
+		# without their extension too, as all models are converted to STL
+		stem, extension = os.path.splitext(name)
+		stems = {os.path.splitext(filename)[0] for filename in filenames}
+		n = 1
+		while os.path.splitext(name)[0] in stems:
+			name, n = f"{stem}_{n}{extension}", n + 1
+		return name
+
+	# 1.1) Get the model files, either uploaded separately or within a zip archive
+	for uploaded_file in request.files.getlist('model'):
+		filenames.append(save_model(uploaded_file, work_dir, unique_name(secure_filename(uploaded_file.filename))))
+	if 'models' in request.files:
+		try:
+			with zipfile.ZipFile(request.files['models'].stream) as archive:
+				for info in archive.infolist():
+					name = secure_filename(os.path.basename(info.filename))
+					if info.is_dir() or info.filename.startswith("__MACOSX") or not allowed_file(name):
+						continue
+					name = unique_name(name)
+					with archive.open(info) as src, open(os.path.join(work_dir, name), "wb") as dst:
+						shutil.copyfileobj(src, dst)
+					filenames.append(name)
+		except zipfile.BadZipFile:
+			raise InvalidRequest('Invalid zip archive of models')
+	if not filenames:
+		raise InvalidRequest('No model files in request')
+	if len(filenames) > app.config['BATCH_MAX_MODELS']:
+		raise InvalidRequest(f"Too many models in batch, the limit is {app.config['BATCH_MAX_MODELS']}")
+	app.logger.info(f"Saved {len(filenames)} models of the batch")
+
+	# 1.2) Get the profile and the tweak actions, once for all models
+	profile_path = parse_profile(work_dir)
+	tweak_option = parse_tweak_option("tweak_extended_volume")
+	params = dict(filenames=filenames,
+				  work_dir=work_dir,
+				  profile_path=profile_path,
+				  tweak_option=tweak_option,
+				  bypass_cache=request.form.get("cache") == "bypass" or "no-cache" in request.headers.get("Cache-Control", ""))
+
+	# 1.3) Get the bed, if the models are arranged on a single plate
+	if request.form.get("arrange") == "plate":
+		if not profile_path:
+			raise InvalidRequest('Arranging the models on a plate requires a profile')
+		params["machinecode_name"] = request.form.get("machinecode_name")
+		if request.form.get("bed_width") or request.form.get("bed_depth"):
+			try:
+				width, depth = float(request.form["bed_width"]), float(request.form["bed_depth"])
+			except (KeyError, ValueError):
+				raise InvalidRequest('Invalid bed size, both bed_width and bed_depth in mm are required')
+			params["bed_shape"] = f"0x0,{width:g}x0,{width:g}x{depth:g},0x{depth:g}"
+	stage_duration.observe(time.time() - upload_start, stage="upload")
+	return params
+
+
+def slice_models(model_paths, profile_path, gcode_path, job, bed_shape=None):
+	"""Slice the models with the profile into gcode_path and publish the progress in the stage 'slicing'. Multiple
+	models are arranged on a single plate, the bed_shape of the profile can be overridden, e.g. '0x0,200x0,200x200,0x200'."""
+	def report_slicing_progress(line):
+		m = SLICER_PROGRESS_PATTERN.match(line)
+		if m:
+			job.set_progress("slicing", min(int(m.group(1)), 100) / 100, m.group(2).decode("utf-8", errors="replace"))
+
+	# execute as subprocess once a slicer is free and handle the response
+	job.set_progress("slicing", message="Waiting for a free slicer")
+	try:
+		returncode, response = slicer_pool.slice(model_paths, profile_path, gcode_path, job,
+												 on_line=report_slicing_progress, bed_shape=bed_shape)
+	except OSError as e:  # the slicer is not executable, report it like the shell did
+		returncode, response = 127, (b"", str(e).encode("utf-8"))
+	if returncode == 0:
+		app.logger.info("Slicing was successful")
+	else:
+		msg = f"Slicing was executed with a nonzero returncode: {returncode}.\n"
+		msg += f"Response: {response[0]}, error message: {response[1].decode('utf-8').strip()}."
+		if returncode in [126, 127] or "Exec format error" in response[1].decode('utf-8').strip():
+			msg += "\nYour Slicer version can't be found. Make sure the provided path works in command line."
+			msg += "\nSearch an appropriate version for your cpu architecture in https://github.com/prusa3d/PrusaSlicer/releases"
+		app.logger.error(msg)
+		raise JobError(msg)
+
+
+def replay_orientation(orientation):
+	"""Return the orientation taken from a cache for this request, no cpu time and no proxy were spent on it."""
+	if orientation is None:
+		return None
+	orientation = {key: value for key, value in orientation.items() if key != "proxy"}
+	orientation.update(cpu_time=0.0, cached=True)
+	return orientation
+
+
+def orient_model(input_path, output_path, extended_mode, min_volume, orientation_key, bypass_cache, job):
+	"""Auto-orient the model into output_path and return the orientation. If the model was oriented in the same mode
+	before, e.g. for another profile, the cached rotation is applied instead of searching it again."""
+	if bypass_cache:
+		orientation_cache.bypass()
+		cached = None
+	else:
+		cached = orientation_cache.get(orientation_key)
+	if cached:
+		with open(cached["orientation"]) as f:
+			orientation = json.load(f)
+		rotate_model(input_path, output_path, orientation["matrix"])
+		app.logger.info(f"Applied the cached orientation '{orientation_key}': {orientation}")
+		return replay_orientation(orientation)
+
+	app.logger.info(f"Running Tweaker on '{input_path}' with extended_mode={extended_mode} and min_volume={min_volume}")
+	orientation = orientation_pool.orient(input_path, output_path, extended_mode, min_volume, job)
+	app.logger.info(f"Tweaking was successful: {orientation}")
+	if orientation_cache.enabled:
+		orientation_path = os.path.join(os.path.dirname(output_path), f"{job.id}.orientation.json")
+		with open(orientation_path, "w") as f:
+			json.dump(orientation, f)
+		orientation_cache.put(orientation_key, dict(orientation=orientation_path))
+		os.remove(orientation_path)
+	return dict(orientation, cached=False)
+
+
+def process_model(filename, work_dir, profile_path, tweak_option, machinecode_name=None, request_source=None,
+				  octoprint_url=None, apikey=None, bypass_cache=False, job=None):
+	"""Auto-orient and slice the model uploaded into the work directory, return the path and name of the resulting
+	file and the messages for the user. This runs within a job and must not access the request, failures are raised
+	as JobError. Intermediate files are written to the work directory, which is released once the job is done.
+	The progress is published on the job in the stages 'preparation', 'preprocessing', 'orientation', 'callback' and
+	'slicing', the tweaked model is delivered to OctoPrint in the background."""
+	do_tweak = tweak_option.startswith("tweak_") and "_keep" not in tweak_option
+	# the client rotates the model itself, only the orientation is returned instead of the tweaked model
+	return_orientation = tweak_option.endswith("_returnorientation")
+	extended_mode = "extended_" in tweak_option
+	min_volume = "_surface" not in tweak_option
+	messages = list()
+	orientation = None
+	job.set_progress("preparation")
+
+	# 1.4) Look up the result cache, the cache can be bypassed with the field 'cache' or the header 'Cache-Control'
+	model_path = os.path.join(work_dir, filename)
+	cache_key = make_cache_key(model_path, profile_path, tweak_option, app.config['SLIC3R_VERSION'],
+							   app.config['ORIENTATION_VERSION'] if do_tweak else "")
+	cached = None
+	if bypass_cache:
+		app.logger.info("Bypassing the result cache as requested")
+		result_cache.bypass()
+	elif do_tweak or profile_path:
+		cached = result_cache.get(cache_key)
+		app.logger.info(f"Result cache {'hit' if cached else 'miss'} for key '{cache_key}'")
+	# the orientation is independent of the profile, its key is taken from the upload before it is converted
+	orientation_key = None
+	if do_tweak and not cached:
+		orientation_key = make_orientation_key(model_path, extended_mode, min_volume, app.config['ORIENTATION_VERSION'])
+
+	# 1.5) Convert the model once to a clean binary STL, which Tweaker, the slicer and OctoPrint read much faster
+	if not cached:
+		job.set_progress("preprocessing")
+		stl_path = os.path.join(work_dir, os.path.splitext(filename)[0] + ".stl")
+		try:
+			read, written = normalise_model(model_path, stl_path)
+		except ValueError as e:
+			raise JobError(str(e))
+		app.logger.info(f"Converted '{filename}' to binary STL, {read - written} of {read} triangles were degenerate")
+		if stl_path != model_path:
+			os.remove(model_path)
+		model_path, filename = stl_path, os.path.basename(stl_path)
+	filename_extension = "." + filename.split(".")[-1]
+
+	# 2.1) retrieve the model file and perform the tweaking, Tweaker writes binary STL
+	if do_tweak:
+		tweaked_filename = filename.replace(filename_extension, "_tweaked.stl")
+		if request_source == "octoprint":  # rename if requested from octoprint
+			tweaked_filename = tweaked_filename.split(".tmp.")[0] + "_tweaked.stl"
+		filename = tweaked_filename
+	if do_tweak and cached:
+		model_path = cached["model"]
+		app.logger.info("Tweaking was skipped, using the cached model")
+	elif do_tweak:
+		input_path, model_path = model_path, os.path.join(work_dir, tweaked_filename)
+		job.set_progress("orientation")
+		orientation = orient_model(input_path, model_path, extended_mode, min_volume, orientation_key, bypass_cache, job)
+	else:
+		app.logger.info("Tweaking was skipped as expected.")
+
+	# 2.2) Send back tweaked file to requester in the background, the slicing doesn't wait for the upload
+	if octoprint_url and not return_orientation and (tweak_option.endswith("_returntweaked") or profile_path is not None):
+		job.set_progress("callback")
+		delivery_queue.submit(job.id, octoprint_url, apikey, filename, model_path)
+		app.logger.info(f"Queued the tweaked model '{filename}' for the delivery to '{octoprint_url}'")
+		messages.append((f"Sending back tweaked stl to server {octoprint_url}, see /jobs/{job.id}/delivery", "message"))
+	else:
+		app.logger.info("Sending back file was skipped as expected.")
+
+	# 3) Slice the tweaked model using Slic3r
+	# 3.1) Get the machinecode_name, if slicing was chosen
+	if profile_path:
+		if not machinecode_name:
+			machinecode_name = filename.replace(filename_extension, "_withPPS.gcode")
+		# if not tweak_option.startswith("tweak_keep"):
+		# 	machinecode_name = machinecode_name.replace(".gcode", "_tweaked.gcode")
+		gcode_path = os.path.join(work_dir, secure_filename(machinecode_name))
+		app.logger.info(f"Machinecode will have the name '{machinecode_name}'")
+
+	# 3.2) Slice the file if it is set, else set gcode_path to None
+	if profile_path and cached:
+		gcode_path = cached["machinecode"]
+		app.logger.info("Slicing was skipped, using the cached machinecode")
+	elif profile_path:
+		slice_models([model_path], profile_path, gcode_path, job)
+	else:
+		gcode_path = None
+
+	# 3.3) Analyse the machinecode once, so that the clients don't need to parse it, and keep the orientation with it
+	if cached and "analysis" in cached:
+		with open(cached["analysis"]) as f:
+			analysis = json.load(f)
+		orientation = replay_orientation(analysis.get("orientation"))
+		analysis["orientation"] = orientation
+	elif gcode_path or orientation:
+		analysis = analyse_gcode(gcode_path) if gcode_path else dict()
+		analysis["orientation"] = orientation
+		app.logger.info(f"Analysis of the result: {analysis}")
+	else:
+		analysis = None
+
+	# 3.4) Store the results in the cache
+	if (do_tweak or profile_path) and not cached:
+		results = dict(model=model_path)
+		if gcode_path:
+			results["machinecode"] = gcode_path
+		if analysis is not None and result_cache.enabled:
+			results["analysis"] = os.path.join(work_dir, f"{job.id}.analysis.json")
+			with open(results["analysis"], "w") as f:
+				json.dump(analysis, f)
+		# serve the cached copy, so that the ETag of the response is the same for subsequent hits
+		cached = result_cache.put(cache_key, results)
+		if "analysis" in results:
+			os.remove(results["analysis"])
+		if cached:
+			model_path = cached["model"]
+			gcode_path = cached.get("machinecode")
+
+	if gcode_path:  # model was sliced, return gcode
+		return dict(path=gcode_path, name=machinecode_name, messages=messages, orientation=orientation, analysis=analysis)
+	elif return_orientation:  # model was not sliced, return the rotation matrix and the metrics of the orientation
+		stem = filename[:-len("_tweaked.stl")] if filename.endswith("_tweaked.stl") else os.path.splitext(filename)[0]
+		orientation_path = os.path.join(work_dir, stem + "_orientation.json")
+		with open(orientation_path, "w") as f:
+			json.dump(orientation, f)
+		return dict(path=orientation_path, name=os.path.basename(orientation_path), messages=messages,
+					orientation=orientation, analysis=analysis)
+	else:  # model was not sliced, return tweaked model
+		return dict(path=model_path, name=filename, messages=messages, orientation=orientation, analysis=analysis)
+
+
+def process_batch(filenames, work_dir, profile_path, tweak_option, bypass_cache=False, job=None):
+	"""Process the models of a batch in parallel with process_model and return the path of a zip archive with the
+	results, and the manifest with the status of each model. A failing model doesn't fail the batch."""
+	job.set_progress("batch", 0.0, f"0 of {len(filenames)} models processed")
+	results = dict()
+	with ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'], thread_name_prefix="batch") as executor:
+		# the models are processed within child jobs, which are cancelled together with the batch
+		futures = {executor.submit(process_model, filename, work_dir, profile_path, tweak_option, bypass_cache=bypass_cache,
+								   job=job.child(filename)): filename for filename in filenames}
+		for future in as_completed(futures):
+			filename = futures[future]
+			try:
+				results[filename] = future.result()
+			except JobCancelled:
+				raise
+			except Exception as e:
+				if not isinstance(e, JobError):
+					app.logger.exception(f"Processing '{filename}' of the batch failed unexpectedly")
+				results[filename] = e
+			job.set_progress("batch", len(results) / len(filenames), f"{len(results)} of {len(filenames)} models processed")
+
+	# 4) Pack the results together with the manifest into a zip archive
+	manifest = list()
+	zip_path = os.path.join(work_dir, f"batch_{job.id}.zip")
+	with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+		for filename in filenames:
+			result = results[filename]
+			if isinstance(result, Exception):
+				manifest.append(dict(model=filename, status="failed", error=str(result)))
+				continue
+			name = result["name"]
+			stem, extension = os.path.splitext(name)
+			n = 1
+			while name in archive.namelist():
+				name, n = f"{stem}_{n}{extension}", n + 1
+			archive.write(result["path"], name)
+			manifest.append(dict(model=filename, status="finished", result=name, orientation=result["orientation"]))
+		archive.writestr("manifest.json", json.dumps(manifest, indent=2))
+	failed = sum(1 for entry in manifest if entry["status"] == "failed")
+	app.logger.info(f"Processed batch of {len(filenames)} models, {failed} failed")
+	return dict(path=zip_path, name="results.zip", messages=list(), manifest=manifest)
+
+
+def process_plate(filenames, work_dir, profile_path, tweak_option, machinecode_name=None, bed_shape=None,
+				  bypass_cache=False, job=None):
+	"""Auto-orient the models of a batch in parallel, arrange them on the bed and slice them into a single machine
+	code. The bed is taken from the profile unless bed_shape is given. Unlike process_batch, a failing model fails
+	the whole plate."""
+	# the tweaked models are needed for slicing, even if the client rotates the models itself
+	if tweak_option.endswith("_returnorientation"):
+		tweak_option = tweak_option[:-len("_returnorientation")]
+	job.set_progress("orientation", 0.0, f"0 of {len(filenames)} models oriented")
+	results = dict()
+	with ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'], thread_name_prefix="batch") as executor:
+		# orient only, the models are sliced together afterwards
+		futures = {executor.submit(process_model, filename, work_dir, None, tweak_option, bypass_cache=bypass_cache,
+								   job=job.child(filename)): filename for filename in filenames}
+		for future in as_completed(futures):
+			filename = futures[future]
+			try:
+				results[filename] = future.result()
+			except JobCancelled:
+				raise
+			except Exception as e:
+				raise JobError(f"Auto-orientation of '{filename}' failed, the plate can't be sliced: {e}")
+			job.set_progress("orientation", len(results) / len(filenames), f"{len(results)} of {len(filenames)} models oriented")
+
+	machinecode_name = machinecode_name or "plate_withPPS.gcode"
+	gcode_path = os.path.join(work_dir, f"plate_{job.id}.gcode")
+	app.logger.info(f"Arranging {len(filenames)} models on a single plate")
+	slice_models([results[filename]["path"] for filename in filenames], profile_path, gcode_path, job, bed_shape=bed_shape)
+	manifest = [dict(model=filename, status="finished", result=machinecode_name, orientation=results[filename]["orientation"])
+				for filename in filenames]
+	analysis = analyse_gcode(gcode_path)
+	analysis["orientations"] = {filename: results[filename]["orientation"] for filename in filenames}
+	return dict(path=gcode_path, name=machinecode_name, messages=list(), manifest=manifest, analysis=analysis)
+
+
+def submit_job(name, func, params):
+	"""Queue func with the parameters of a parsed request as job. Once the job is done, its work directory is
+	released, only the file of the result is kept until the janitor removes it."""
+	work_dir = params["work_dir"]
+	return job_manager.submit(name, func, **params,
+							  cleanup=lambda job: workspace.release(work_dir, keep=job.result["path"] if job.result else None))
+
+
+def send_result(result):
+	"""Return the response with the gcode or tweaked model file of a finished job. The file is streamed from disk
+	in chunks, and conditional and range requests are answered based on its ETag and size."""
+	app.logger.debug("Handling the download of '{}'.".format(result["path"]))
+	start = time.time()
+	if request.headers.get('Accept') == "text/plain":
+		mimetype = "text/plain"
+	elif result["name"].endswith(".json"):
+		mimetype = "application/json"
+	else:
+		mimetype = "application/octet-stream"
+	# machine code and models are sent compressed if the client accepts it, the ETag is the one of the compressed copy
+	encoding = negotiate_encoding(result["path"], request.accept_encodings)
+	path = compressed_copy(result["path"], encoding) if encoding else result["path"]
+	# the compressed copies within the entries of the cache count towards its size
+	if encoding and not result_cache.update_size(path):
+		encoding, path = None, result["path"]
+	response = send_file(path, mimetype=mimetype, download_name=result["name"], conditional=True, etag=True)
+	response.headers['Access-Control-Allow-Origin'] = "*"
+	if encoding:
+		response.headers['Content-Encoding'] = encoding
+	if is_compressible(result["path"]):
+		response.vary.add("Accept-Encoding")
+	if result.get("analysis") is not None:
+		# the analysis of the machinecode and the orientation, so that clients don't need to parse the file
+		response.headers[ANALYSIS_HEADER] = json.dumps(result["analysis"], separators=(",", ":"))
+		response.headers['Access-Control-Expose-Headers'] = ANALYSIS_HEADER
+	# the file is streamed after returning, measure until the response is closed
+	response.call_on_close(lambda: stage_duration.observe(time.time() - start, stage="response"))
+	return response
+
+
 @app.route("/", methods=['GET', 'POST'])
 @app.route("/tweak", methods=['GET', 'POST'])
 @app.route("/tweak/", methods=['GET', 'POST'])
 def tweak_slice_file():
 	"""Routine for Auto-Orientation and Slicing the object."""
-	# try:
 	if request.method == 'POST':
-		app.logger.debug("request on: %s", request)
-		# available keys in request.forms: 'machinecode_name', 'tweak_option', 'request_source' 'octoprint_url', 'apikey'
-		
-		# 0) Get url on which to upload the requested file
-		if request.form.get("octoprint_url") is not None:
-			app.logger.info(f'Getting request from octoprint server: {request.form.get("octoprint_url")}')
-		else:
-			app.logger.info("Getting request from user interface")
-		app.logger.info(f"Request with payload: {dict(request.form).items()}")
-
-		# 1) Check if the input is correct
-		# 1.1) Get the model file and check for correctness
 		if 'model' not in request.files:
 			return jsonify('No model file in request')
-		# load the file
-		uploaded_file = request.files['model']
-		# if no file was selected, submit an empty one
-		if uploaded_file.filename == '':
-			flash('No selected model', 'warning')
+		job = work_dir = None
+		try:
+			work_dir = workspace.create(request.content_length)
+			params = parse_tweak_request(work_dir)
+			# the job runs on the worker pool as well, this request waits for it to be done
+			job = submit_job(params["filename"], process_model, params)
+		except InvalidRequest as e:
+			if request.form.get("tweak_option", "").endswith("_returnorientation"):
+				# only API clients request the orientation, they get the error instead of the page
+				return jsonify(str(e)), 400
+			flash(str(e), 'warning')
 			return redirect(request.url)
-		if not (uploaded_file and allowed_file(uploaded_file.filename)):
-			flash('Invalid model extension', 'warning')
+		except JobQueueFull as e:
+			return jsonify(str(e)), 503
+		except WorkspaceFull as e:
+			return jsonify(str(e)), 507
+		finally:
+			if job is None and work_dir:
+				workspace.remove(work_dir)
+		job.wait()
+		if job.status != "finished":
+			flash(job.error, "error")
 			return redirect(request.url)
-		filename = secure_filename(uploaded_file.filename)
-		filename_extension = "." + filename.split(".")[-1]
-		app.logger.info(f"Uploaded new model: {filename}")
-		uploaded_file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-		app.logger.info(f"Saved model to '{os.path.join(app.config['UPLOAD_FOLDER'], filename)}'")
-
-		# 1.2) Get the profile
-		if 'profile' in request.files:
-			# in webUI, there is always this option available, no slicing is called 'no_slicing'
-			profile = request.files["profile"]
-			if profile.filename == '':
-				flash('No selected profile', 'warning')
-				return redirect(request.url)
-			elif profile == "no_slicing":
-				profile_path = None
-			else:
-				profilename = secure_filename(profile.filename)
-				app.logger.info("Uploaded new profile: {}".format(profilename))
-				profile.save(os.path.join(app.config['PROFILE_FOLDER'], profilename))
-				profile_path = os.path.join(app.config['PROFILE_FOLDER'], profilename)
-		else:
-			if request.form.get("profile"):
-				profile = request.form.get("profile")
-				if profile == "no_slicing":
-					profile_path = None
-				else:
-					profile_path = os.path.join(app.config["PROFILE_FOLDER"], profile)
-					if not os.path.exists(profile_path):
-						profile_path = app.config['DEFAULT_PROFILE']
-			else:
-				profile_path = None
-		app.logger.info("Using profile: '{}'".format(profile_path))
-
-		# 1.3) Get the tweak actions
-		# Get the tweak option and use extended_volume as default
-                # of the form: "tweak_extended_volume_returntweaked")
-		tweak_option = request.form.get("tweak_option", "tweak_extended_volume_returntweaked")  
-		app.logger.info(f"Using Tweaker options: '{tweak_option}'")
-
-		# 2.1) retrieve the model file and perform the tweaking
-		if tweak_option.startswith("tweak_") and "_keep" not in tweak_option:
-			tweaked_filename = filename.replace(filename_extension, f"_tweaked{filename_extension}")
-			if request.form.get("request_source") == "octoprint":  # rename if requested from octoprint
-				tweaked_filename = tweaked_filename.split(".tmp.")[0] + f"_tweaked{filename_extension}"
-			tweak_cmd = f"{sys.executable} {os.path.join(CURPATH, 'Tweaker-3', 'Tweaker.py')}"
-			tweak_cmd += f" -i {os.path.join(app.config['UPLOAD_FOLDER'], filename)}"
-			# if "_keep" in tweak_option:  # convert to binary
-			# 	tweak_cmd += " -c"
-			if "extended_" in tweak_option:
-				tweak_cmd += " --extended"
-			if "_surface" in tweak_option:
-				tweak_cmd += " --minimize surface"
-			tweak_cmd += f" -o {os.path.join(app.config['UPLOAD_FOLDER'], tweaked_filename)}"
-			app.logger.info("Running Tweaker with command: '{}'".format(tweak_cmd))
-
-			# execute as subprocess and handle the response
-			pipe = sp.Popen(tweak_cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE)
-			response = pipe.communicate()
-			filename = tweaked_filename
-			if pipe.returncode == 0 and len(response[0]) == 0:
-				app.logger.info("Tweaking was successful")
-			else:
-				msg = f"Tweaking was executed with the returncode {pipe.returncode} and the warning:\n"
-				msg += f"Response: {response[0]}, error: {response[1].decode('utf-8').strip()}"
-				app.logger.error(msg)
-				flash(msg, "error")
-				return redirect(request.url)
-		else:
-			app.logger.info("Tweaking was skipped as expected.")
-
-		# 2.2) Send back tweaked file to requester, currently not supported as we can't send back the STL in an extra API call
-		if request.form.get("octoprint_url") and (tweak_option.endswith("_returntweaked") or profile_path is not None):
-			app.logger.info("Sending back tweaked model file")
-			# Upload the tweaked model via API to octoprint
-			# find the apikey in octoprint server, settings, access control
-			outfile = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-			app.logger.info("Sending file '{}' to URL '{}'".format(outfile, request.form.get("octoprint_url")))
-			files = {'file': open(outfile, 'rb')}
-			url_with_key = os.path.join(request.form.get("octoprint_url"), f'api/files/local?apikey={request.form.get("apikey")}')
-			r = requests.post(url_with_key, files=files, verify=False)
-			if r.status_code == 201:
-				app.logger.info(f"Sended back tweaked stl to server {request.form.get('octoprint_url')} with code '{r.status_code}'")
-				flash(f"Sended back tweaked stl to server {request.form.get('octoprint_url')} with code '{r.status_code}'", "success")
-			else:
-				app.logger.warning(f"Problem while loading tweaked stl to Octoprint server '{request.form.get('octoprint_url')}' with code '{r.status_code}'")
-				# app.logger.warning(r.text)
-				flash(f"Problem while loading tweaked stl back to server with code '{r.status_code}'")
-		else:
-			app.logger.info("Sending back file was skipped as expected.")
-
-		# 3) Slice the tweaked model using Slic3r
-		# 3.1) Get the machinecode_name, if slicing was chosen
-		if profile_path:
-			machinecode_name = request.form.get("machinecode_name", 
-				filename.replace(filename_extension, "_withPPS.gcode"))
-			# if not tweak_option.startswith("tweak_keep"):
-			# 	machinecode_name = machinecode_name.replace(".gcode", "_tweaked.gcode")
-			gcode_path = os.path.join(app.config["UPLOAD_FOLDER"], machinecode_name)
-			app.logger.info(f"Machinecode will have the name '{machinecode_name}'")
-
-		# 3.2) Slice the file if it is set, else set gcode_path to None
-		if profile_path:
-			slice_cmd = f"{app.config['SLIC3R_PATH']} --export-gcode --repair {os.path.join(app.config['UPLOAD_FOLDER'], filename)} "
-			slice_cmd += f" --load {profile_path} --output {gcode_path}"
-			app.logger.info(f"Slicing the model with the command: '{slice_cmd}'")
-			
-			# execute as subprocess and handle the response
-			pipe = sp.Popen(slice_cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE)
-			response = pipe.communicate()
-			if pipe.returncode == 0:
-				app.logger.info("Slicing was successful")
-			else:
-				msg = f"Slicing was executed with a nonzero returncode: {pipe.returncode}.\n"
-				msg += f"Response: {response[0]}, error message: {response[1].decode('utf-8').strip()}."
-				if pipe.returncode in [126, 127] or "Exec format error" in response[1].decode('utf-8').strip():
-					msg += "\nYour Slicer version can't be found. Make sure the provided path works in command line."
-					msg += "\nSearch an appropriate version for your cpu architecture in https://github.com/prusa3d/PrusaSlicer/releases"
-				app.logger.error(msg)
-				flash(msg, "error")
-				return redirect(request.url)
-			
-			if profile_path.split(os.sep)[-1].startswith("slicing-profile-temp") and profile_path.endswith(".profile"):
-				os.remove(profile_path)
-		else:
-			gcode_path = None
+		for message in job.result["messages"]:
+			flash(*message)
 
 		# 4) Redirect the ready gcode or tweaked model file from UI or direct API call
-		if gcode_path:  # model was sliced, return gcode
-			app.logger.debug("Handling the download of '{}'.".format(gcode_path))
-			if request.headers.get('Accept') == "text/plain":
-				response = Response(open(gcode_path, 'rb').read())
-			else:
-				response = Response(open(gcode_path, 'rb').read(), mimetype='application/octet-stream')
-				response.headers['Content-Disposition'] = "inline; filename=" + machinecode_name
-			response.headers['Access-Control-Allow-Origin'] = "*"
-		else:  # model was not sliced, return tweaked model
-			tweaked_file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-			app.logger.debug("Handling the download of '{}'.".format(tweaked_file_path))
-			if request.headers.get('Accept') == "text/plain":
-				response = Response(open(tweaked_file_path, 'rb').read())
-			else:
-				response = Response(open(tweaked_file_path, 'rb').read(), mimetype='application/octet-stream')
-				response.headers['Content-Disposition'] = "inline; filename=" + filename
-			response.headers['Access-Control-Allow-Origin'] = "*"
-		return response
+		return send_result(job.result)
 	else:
 		return render_template('tweak_slice.html', profiles=os.listdir(app.config['PROFILE_FOLDER']))
-	# except RequestEntityTooLarge:
-	# 	abort(413)
+
+
+@app.route("/batch", methods=['POST'])
+def process_batch_request():
+	"""Auto-orient and slice many models with the same profile and return a zip archive of the results with the
+	manifest 'manifest.json'. If the field 'arrange' is 'plate', the models are arranged on the bed and sliced into a
+	single machine code instead. If the field 'response' is 'manifest', only the manifest is returned."""
+	job = work_dir = None
+	try:
+		work_dir = workspace.create(request.content_length)
+		params = parse_batch_request(work_dir)
+		if request.form.get("arrange") == "plate":
+			job = submit_job(f"plate of {len(params['filenames'])} models", process_plate, params)
+		else:
+			job = submit_job(f"batch of {len(params['filenames'])} models", process_batch, params)
+	except InvalidRequest as e:
+		return jsonify(str(e)), 400
+	except JobQueueFull as e:
+		return jsonify(str(e)), 503
+	except WorkspaceFull as e:
+		return jsonify(str(e)), 507
+	finally:
+		if job is None and work_dir:
+			workspace.remove(work_dir)
+	job.wait()
+	if job.status != "finished":
+		return jsonify(job.to_dict()), 500
+	if request.form.get("response") == "manifest":
+		return jsonify(job.result["manifest"]), 200
+	return send_result(job.result)
+
+
+@app.route("/jobs", methods=['POST'])
+def create_job():
+	"""Queue a model for Auto-Orientation and Slicing and return the id of the job at once."""
+	job = work_dir = None
+	try:
+		work_dir = workspace.create(request.content_length)
+		params = parse_tweak_request(work_dir)
+		job = submit_job(params["filename"], process_model, params)
+	except InvalidRequest as e:
+		return jsonify(str(e)), 400
+	except JobQueueFull as e:
+		return jsonify(str(e)), 503
+	except WorkspaceFull as e:
+		return jsonify(str(e)), 507
+	finally:
+		if job is None and work_dir:
+			workspace.remove(work_dir)
+	response = jsonify(job.to_dict())
+	response.status_code = 202
+	response.headers['Location'] = url_for("get_job", job_id=job.id)
+	return response
+
+
+@app.route("/jobs/<job_id>", methods=['GET', 'DELETE'])
+def get_job(job_id):
+	"""Return the status and progress of a job. For long-polling, pass the last seen 'version' and the seconds to
+	'wait' for a change of the job. DELETE cancels the job."""
+	job = job_manager.get(job_id)
+	if job is None:
+		return jsonify(f"Job '{job_id}' not found"), 404
+	if request.method == 'DELETE':
+		job.cancel()
+		app.logger.info(f"Cancellation of job '{job_id}' was requested")
+		return jsonify(job.to_dict()), 202
+	if request.args.get("wait"):
+		timeout = min(request.args.get("wait", type=float, default=0), MAX_LONG_POLL)
+		job.wait_for_change(request.args.get("version", type=int, default=-1), timeout)
+	return jsonify(job.to_dict()), 200
+
+
+@app.route("/jobs/<job_id>/result")
+def get_job_result(job_id):
+	job = job_manager.get(job_id)
+	if job is None:
+		return jsonify(f"Job '{job_id}' not found"), 404
+	if job.status == "failed":
+		return jsonify(job.to_dict()), 500
+	if job.status == "cancelled":
+		return jsonify(job.to_dict()), 410
+	if job.status != "finished":
+		return jsonify(job.to_dict()), 409
+	if not os.path.isfile(job.result["path"]):  # removed by the janitor or evicted from the cache
+		return jsonify(f"The result of job '{job_id}' has expired"), 410
+	return send_result(job.result)
+
+
+@app.route("/jobs/<job_id>/delivery")
+def get_job_delivery(job_id):
+	"""Return the status of the delivery of the tweaked model of a job to OctoPrint."""
+	delivery = delivery_queue.get(job_id)
+	if delivery is None:
+		return jsonify(f"No delivery of job '{job_id}' found"), 404
+	return jsonify(delivery.to_dict()), 200
+
+
+@app.before_request
+def decompress_request():
+	"""Decompress the bodies of requests that are sent with a Content-Encoding, like the models from OctoPrint."""
+	if not decompress_request_body(request.environ, app.config['MAX_DECOMPRESSED_SIZE']):
+		return jsonify(f"Unsupported Content-Encoding '{request.headers.get('Content-Encoding')}'"), 415
+
+
+@app.after_request
+def record_request(response):
+	http_requests.inc(endpoint=request.endpoint or "none", method=request.method, code=response.status_code)
+	received_bytes.inc(request.content_length or 0)
+	sent_bytes.inc(response.content_length or 0, destination="client")
+	return response
+
+
+@metrics.add_collector
+def collect_state():
+	"""Return the metrics of the jobs, the cache, the auto-orientation, the slicers and the work directories at the
+	time of the scrape."""
+	jobs = Gauge("preprintservice_jobs", "Jobs by their current status.", ["status"])
+	jobs.set(job_manager.active, status="running")
+	jobs.set(job_manager.queued, status="queued")
+
+	cache = result_cache.stats()
+	lookups = Counter("preprintservice_cache_lookups_total", "Lookups of the result cache by their result.", ["result"])
+	for result, key in [("hit", "hits"), ("miss", "misses"), ("bypass", "bypasses")]:
+		lookups.inc(cache[key], result=result)
+	evictions = Counter("preprintservice_cache_evictions_total", "Entries evicted from the result cache.")
+	evictions.inc(cache["evictions"])
+	cache_size = Gauge("preprintservice_cache_size_bytes", "Size of the result cache.")
+	cache_size.set(cache["size"])
+	hit_ratio = Gauge("preprintservice_cache_hit_ratio", "Share of the cache lookups that were hits.")
+	if cache["hit_rate"] is not None:
+		hit_ratio.set(cache["hit_rate"])
+	orientation_cached = orientation_cache.stats()
+	orientation_lookups = Counter("preprintservice_orientation_cache_lookups_total",
+								  "Lookups of the cached orientations by their result.", ["result"])
+	for result, key in [("hit", "hits"), ("miss", "misses"), ("bypass", "bypasses")]:
+		orientation_lookups.inc(orientation_cached[key], result=result)
+
+	orientation = orientation_pool.stats()
+	orientations = Counter("preprintservice_orientations_total", "Auto-orientations by their result.", ["result"])
+	orientations.inc(orientation["orientations"] - orientation["failures"], result="success")
+	orientations.inc(orientation["failures"], result="failure")
+	restarts = Counter("preprintservice_orientation_restarts_total", "Restarts of the auto-orientation workers.")
+	restarts.inc(orientation["restarts"])
+
+	slicer = slicer_pool.stats()
+	slicers = Gauge("preprintservice_slicers", "Slicers by their state.", ["state"])
+	slicers.set(slicer["running"], state="running")
+	slicers.set(slicer["queued"], state="queued")
+	slicer_wait = Counter("preprintservice_slicer_wait_seconds_total", "Time the slicing jobs waited for a free slicer.")
+	slicer_wait.inc(slicer["total_wait_time"])
+	exits = Counter("preprintservice_subprocess_exits_total", "Exits of subprocesses by their returncode.",
+					["process", "code"])
+	for code, count in slicer["exit_codes"].items():
+		exits.inc(count, process="slicer", code=code)
+	cpu_time = Counter("preprintservice_cpu_seconds_total", "CPU time of the slicers and the auto-orientation.",
+					   ["process"])
+	cpu_time.inc(slicer["cpu_time"], process="slicer")
+	cpu_time.inc(orientation["cpu_time"], process="tweaker")
+
+	delivery = delivery_queue.stats()
+	deliveries = Gauge("preprintservice_deliveries", "Pending deliveries of tweaked models to OctoPrint by their state.",
+					   ["state"])
+	for state in ["queued", "sending", "retrying"]:
+		deliveries.set(delivery[state], state=state)
+	delivery_retries = Counter("preprintservice_delivery_retries_total", "Retried deliveries to OctoPrint.")
+	delivery_retries.inc(delivery["retries"])
+
+	work = workspace.stats()
+	work_dirs = Gauge("preprintservice_work_directories", "Work directories of the running jobs.")
+	work_dirs.set(work["active"])
+	work_size = Gauge("preprintservice_work_size_bytes", "Size of all work directories at the last cleaning.")
+	work_size.set(work["size"])
+	work_removed = Counter("preprintservice_work_removed_total", "Work directories removed by the janitor.")
+	work_removed.inc(work["removed"])
+	return [jobs, lookups, evictions, cache_size, hit_ratio, orientation_lookups, orientations, restarts, slicers, slicer_wait,
+			exits, cpu_time, deliveries, delivery_retries, work_dirs, work_size, work_removed]
+
+
+@app.route("/metrics")
+def get_metrics():
+	return Response(metrics.render(), content_type=CONTENT_TYPE)
+
+
+@app.route("/profiles/<digest>", methods=['GET', 'PUT'])
+def profile_by_hash(digest):
+	"""Store the profile in the request body under the SHA-256 hash of its content, so that slicing requests can refer
+	to it in the field 'profile_hash' instead of uploading it each time. GET and HEAD return the profile if it is known."""
+	if request.method == 'PUT':
+		try:
+			created = profile_registry.put(digest, request.stream)
+		except ValueError as e:
+			return jsonify(str(e)), 400
+		return jsonify(digest), 201 if created else 200
+	profile_path = profile_registry.get(digest)
+	if profile_path is None:
+		return jsonify(f"Profile '{digest}' not found"), 404
+	return send_file(profile_path, mimetype="text/plain", conditional=True, etag=digest)
+
 
 @app.route('/favicon.ico')
 def favicon():
@@ -253,6 +946,22 @@ def favicon():
 def connection():
 	return jsonify({"value": "ok"}), 200
 
+@app.route("/cache")
+def cache_stats():
+	return jsonify(result_cache.stats()), 200
+
+@app.route("/slicer")
+def slicer_stats():
+	return jsonify(slicer_pool.stats()), 200
+
+@app.route("/deliveries")
+def delivery_stats():
+	return jsonify(delivery_queue.stats()), 200
+
+@app.route("/workspace")
+def workspace_stats():
+	return jsonify(workspace.stats()), 200
+
 @app.route("/about")
 def about():
 	return render_template("about.html")
@@ -271,4 +980,5 @@ if __name__ == "__main__":
 
 	app.secret_key = '3Dprint4life'
 	# app.config['SESSION_TYPE'] = 'filesystem'
-	app.run(host="0.0.0.0", port=int(args.port), debug=True)
+	# the reloader would run this module in a second process, with its own workers and janitor
+	app.run(host="0.0.0.0", port=int(args.port), debug=True, use_reloader=False)
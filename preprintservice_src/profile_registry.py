@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""Content-addressed store of slicer profiles.
+
+Clients upload a profile once with PUT /profiles/<sha256> and refer to it by its hash in their requests. The profile
+isn't sent along with each model then, and concurrent clients can't overwrite each other's profiles of the same name.
+"""
+import os
+import re
+import hashlib
+import logging
+import tempfile
+
+CHUNK_SIZE = 64 * 1024
+MAX_PROFILE_SIZE = 1024 * 1024
+DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileRegistry:
+	"""Profiles stored as files named by the SHA-256 hash of their content."""
+
+	def __init__(self, folder):
+		self.folder = folder
+		os.makedirs(self.folder, exist_ok=True)
+
+	def get(self, digest):
+		"""Return the path of the profile with the hash, or None if it is unknown."""
+		if not DIGEST_PATTERN.match(digest or ""):
+			return None
+		path = os.path.join(self.folder, digest + ".ini")
+		return path if os.path.isfile(path) else None
+
+	def put(self, digest, stream):
+		"""Store the profile read from the stream under its hash, return False if it was known already. Raise a
+		ValueError if the hash is invalid, doesn't match the content or the profile is too large."""
+		if not DIGEST_PATTERN.match(digest or ""):
+			raise ValueError(f"Invalid SHA-256 hash '{digest}', expected 64 lowercase hex digits")
+		# the content is written to a temporary file while it is hashed and moved into place if it matches
+		h = hashlib.sha256()
+		size = 0
+		fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=self.folder)
+		try:
+			with os.fdopen(fd, "wb") as f:
+				for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+					size += len(chunk)
+					if size > MAX_PROFILE_SIZE:
+						raise ValueError(f"The profile exceeds the maximal size of {MAX_PROFILE_SIZE} bytes")
+					h.update(chunk)
+					f.write(chunk)
+			if h.hexdigest() != digest:
+				raise ValueError(f"The content of the profile doesn't match its hash '{digest}'")
+			if self.get(digest):
+				return False
+			os.replace(tmp_path, os.path.join(self.folder, digest + ".ini"))
+			logger.info(f"Stored profile '{digest}' with {size} bytes")
+			return True
+		finally:
+			if os.path.exists(tmp_path):
+				os.remove(tmp_path)
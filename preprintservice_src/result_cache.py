@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""Content-addressed on-disk cache for tweaked models and sliced machine code.
+
+Each entry is a folder named by the SHA-256 key of a request, holding the produced files and an index
+'entry.json' mapping the role of each file (e.g. 'model' or 'machinecode') to its filename.
+"""
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+CHUNK_SIZE = 1024 * 1024
+ENTRY_INDEX = "entry.json"
+
+logger = logging.getLogger(__name__)
+
+
+def update_hash_from_file(h, path):
+	"""Feed the content of the file into the hash object h in chunks."""
+	with open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+			h.update(chunk)
+	return h
+
+
+def _folder_size(path):
+	return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def make_cache_key(model_path, profile_path, tweak_option, slicer_version, orientation_version=""):
+	"""Return the SHA-256 key of a request, based on the model bytes, the profile contents, the tweak_option,
+	the version of the slicer and the one of the auto-orientation. Each part is prefixed by a tag so that the parts
+	can't be shifted."""
+	h = hashlib.sha256()
+	h.update(b"model\0")
+	update_hash_from_file(h, model_path)
+	if profile_path:
+		h.update(b"\0profile\0")
+		update_hash_from_file(h, profile_path)
+	else:
+		h.update(b"\0no_slicing\0")
+	h.update(f"\0tweak_option\0{tweak_option}\0slicer\0{slicer_version}"
+			 f"\0orientation\0{orientation_version}".encode("utf-8"))
+	return h.hexdigest()
+
+
+def make_orientation_key(model_path, extended_mode, min_volume, orientation_version):
+	"""Return the SHA-256 key of the orientation of a model, which depends only on the model bytes, the mode of the
+	auto-orientation and the orientation_version, i.e. the version of Tweaker-3 and the size of the proxy, not
+	on the profile or the slicer."""
+	h = hashlib.sha256()
+	h.update(b"model\0")
+	update_hash_from_file(h, model_path)
+	h.update(f"\0extended_mode\0{extended_mode}\0min_volume\0{min_volume}"
+			 f"\0orientation\0{orientation_version}".encode("utf-8"))
+	return h.hexdigest()
+
+
+class ResultCache:
+	"""Size-limited cache with LRU eviction, the recency of an entry is persisted as the mtime of its folder."""
+
+	def __init__(self, folder, max_size):
+		self.folder = folder
+		self.max_size = max_size  # in bytes, 0 disables the cache
+		self.hits = 0
+		self.misses = 0
+		self.bypasses = 0
+		self.evictions = 0
+		self._lock = threading.Lock()
+		self._entries = OrderedDict()  # key: size in bytes, ordered from least to most recently used
+		if self.enabled:
+			os.makedirs(self.folder, exist_ok=True)
+			self._load()
+
+	@property
+	def enabled(self):
+		return self.max_size > 0
+
+	@property
+	def size(self):
+		return sum(self._entries.values())
+
+	def _entry_path(self, key):
+		return os.path.join(self.folder, key)
+
+	def _load(self):
+		"""Restore the index of the cache from disk in the order of the last usage."""
+		entries = list()
+		for key in os.listdir(self.folder):
+			path = self._entry_path(key)
+			if key.startswith(".tmp-") or not os.path.isfile(os.path.join(path, ENTRY_INDEX)):
+				# leftovers of an interrupted store
+				shutil.rmtree(path, ignore_errors=True)
+				continue
+			size = _folder_size(path)
+			entries.append((os.path.getmtime(path), key, size))
+		for _, key, size in sorted(entries):
+			self._entries[key] = size
+		self._evict()
+		logger.info(f"Loaded result cache with {len(self._entries)} entries and {self.size} bytes from '{self.folder}'")
+
+	def get(self, key):
+		"""Return a dict that maps the roles to the cached files, or None if the key is not cached."""
+		if not self.enabled:
+			return None
+		with self._lock:
+			if key not in self._entries:
+				self.misses += 1
+				return None
+			path = self._entry_path(key)
+			try:
+				with open(os.path.join(path, ENTRY_INDEX)) as f:
+					index = json.load(f)
+				os.utime(path)
+			except (IOError, ValueError) as e:
+				logger.warning(f"Dropping broken cache entry '{key}': {e}")
+				self._remove(key)
+				self.misses += 1
+				return None
+			self._entries.move_to_end(key)
+			self.hits += 1
+		return {role: os.path.join(path, name) for role, name in index.items()}
+
+	def bypass(self):
+		"""Count a request that skipped the lookup."""
+		with self._lock:
+			self.bypasses += 1
+
+	def put(self, key, files):
+		"""Store the files given as dict of role: path under the key, the given files are left untouched.
+		Return the dict of the cached files like get, or None if the files weren't cached."""
+		if not self.enabled:
+			return None
+		# the size of an entry includes its index, like the sizes of the entries that are loaded from disk
+		size = sum(os.path.getsize(path) for path in files.values())
+		if size > self.max_size:
+			logger.info(f"Result of size {size} bytes exceeds the cache size, it won't be cached")
+			return None
+		# copy into a temporary folder first and move it into place, so that readers never see partial entries
+		tmp_path = tempfile.mkdtemp(prefix=".tmp-", dir=self.folder)
+		index = dict()
+		for role, path in files.items():
+			name = role + os.path.splitext(path)[1]
+			shutil.copyfile(path, os.path.join(tmp_path, name))
+			index[role] = name
+		with open(os.path.join(tmp_path, ENTRY_INDEX), "w") as f:
+			json.dump(index, f)
+		size = _folder_size(tmp_path)
+		with self._lock:
+			if key in self._entries:
+				self._remove(key)
+			os.rename(tmp_path, self._entry_path(key))
+			self._entries[key] = size
+			self._evict()
+		logger.info(f"Cached result '{key}' with {size} bytes")
+		return {role: os.path.join(self._entry_path(key), name) for role, name in index.items()}
+
+	def update_size(self, path):
+		"""Recount the size of the entry that holds the file in path, e.g. a compressed copy that was added to it, and
+		evict other entries if the cache exceeds its limit. If the entry doesn't fit into the cache with the file, the
+		file is removed and False is returned. Files outside of the cache are ignored."""
+		entry_path = os.path.dirname(os.path.abspath(path))
+		if os.path.dirname(entry_path) != os.path.abspath(self.folder):
+			return True
+		key = os.path.basename(entry_path)
+		with self._lock:
+			if key not in self._entries:
+				return True
+			size = _folder_size(entry_path)
+			if size > self.max_size:
+				os.remove(path)
+				return False
+			self._entries[key] = size
+			self._entries.move_to_end(key)
+			self._evict()
+		return True
+
+	def _remove(self, key):
+		shutil.rmtree(self._entry_path(key), ignore_errors=True)
+		self._entries.pop(key, None)
+
+	def _evict(self):
+		"""Remove the least recently used entries until the size limit is met."""
+		while self._entries and self.size > self.max_size:
+			key = next(iter(self._entries))
+			self._remove(key)
+			self.evictions += 1
+			logger.info(f"Evicted cache entry '{key}'")
+
+	def stats(self):
+		with self._lock:
+			lookups = self.hits + self.misses
+			return dict(enabled=self.enabled, entries=len(self._entries), size=self.size, max_size=self.max_size,
+						hits=self.hits, misses=self.misses, bypasses=self.bypasses, evictions=self.evictions,
+						hit_rate=self.hits / lookups if lookups else None)
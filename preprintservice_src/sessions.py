@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""Pooled HTTP sessions for the requests of the service to other hosts, like the upload of tweaked models to OctoPrint.
+
+Each host gets one session, which keeps its connections alive, so that subsequent requests skip the TCP and TLS
+handshakes. Failed connections and idempotent requests that got a server error are retried with exponential backoff.
+"""
+import threading
+
+import requests
+import urllib3
+from urllib3.util.retry import Retry
+
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = [502, 503, 504]
+
+
+class SessionPool:
+	"""Hold one requests session per scheme and host."""
+
+	def __init__(self, retries, verify=False):
+		self.retries = retries
+		self.verify = verify
+		self._lock = threading.Lock()
+		self._sessions = dict()
+
+	def get(self, url):
+		"""Return the session for the host of the url."""
+		url = urllib3.util.parse_url(url)
+		key = (url.scheme, url.netloc)
+		with self._lock:
+			if key not in self._sessions:
+				retry = Retry(total=self.retries, backoff_factor=RETRY_BACKOFF_FACTOR, status_forcelist=RETRY_STATUS_CODES,
+							  allowed_methods=["HEAD", "GET", "PUT", "DELETE"], raise_on_status=False)
+				session = requests.Session()
+				session.verify = self.verify
+				session.mount("http://", requests.adapters.HTTPAdapter(max_retries=retry))
+				session.mount("https://", requests.adapters.HTTPAdapter(max_retries=retry))
+				self._sessions[key] = session
+			return self._sessions[key]
+
+	def close(self):
+		with self._lock:
+			sessions, self._sessions = list(self._sessions.values()), dict()
+		for session in sessions:
+			session.close()
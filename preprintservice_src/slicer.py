@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""Execution of the slicer with a limited number of concurrent processes, which wait in a FIFO queue.
+
+Each running slicer occupies a slot, which can be pinned to a subset of the cpus and run with a nice level, so that
+concurrent slicers don't oversubscribe the cores and the HTTP layer stays responsive.
+"""
+import os
+import time
+import queue
+import signal
+import logging
+import threading
+import collections
+import subprocess as sp
+from contextlib import contextmanager
+
+from jobs import JobError
+
+logger = logging.getLogger(__name__)
+
+
+def parse_cpu_list(text):
+	"""Return the cpus of a list like '0-3,6' as sorted list, 'all' selects the cpus available to this process."""
+	if not text:
+		return None
+	if text.strip() == "all":
+		return sorted(os.sched_getaffinity(0))
+	cpus = set()
+	for part in text.split(","):
+		start, _, end = part.strip().partition("-")
+		cpus.update(range(int(start), int(end or start) + 1))
+	return sorted(cpus)
+
+
+def run_process(cmd, job, on_line=None, poll_interval=1.0, cpus=None, nice=0):
+	"""Run the command given as list and return its returncode, the tuple of stdout and stderr and its resource
+	usage. Each line of stdout is passed to on_line as soon as it is written. The process is killed if the job is
+	cancelled meanwhile."""
+	# start a new session, so that the process and its children can be killed at once
+	pipe = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE, start_new_session=True)
+	if cpus:
+		os.sched_setaffinity(pipe.pid, cpus)
+	if nice:
+		os.setpriority(os.PRIO_PROCESS, pipe.pid, nice)
+	lines = queue.Queue()
+	stdout, stderr = list(), list()
+
+	def read_stdout():
+		for line in pipe.stdout:
+			lines.put(line)
+		lines.put(None)
+
+	readers = [threading.Thread(target=read_stdout, daemon=True),
+			   threading.Thread(target=lambda: stderr.append(pipe.stderr.read()), daemon=True)]
+	for reader in readers:
+		reader.start()
+	try:
+		while True:
+			try:
+				line = lines.get(timeout=poll_interval)
+			except queue.Empty:
+				job.check_cancelled()
+				continue
+			if line is None:
+				break
+			stdout.append(line)
+			if on_line:
+				on_line(line)
+		# reap the process by hand to get its resource usage, e.g. the cpu time
+		_, status, rusage = os.wait4(pipe.pid, 0)
+		pipe.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+	except BaseException:
+		os.killpg(pipe.pid, signal.SIGKILL)
+		pipe.wait()
+		raise
+	finally:
+		for reader in readers:
+			reader.join()
+	return pipe.returncode, (b"".join(stdout), b"".join(stderr)), rusage
+
+
+class SlicerPool:
+	"""Run at most max_workers slicers at once, further requests wait in FIFO order for a free slot."""
+
+	def __init__(self, slicer_path, max_workers, cpus=None, nice=0):
+		self.slicer_path = slicer_path
+		self.max_workers = max_workers
+		self.cpus = cpus
+		self.nice = nice
+		self._cond = threading.Condition()
+		self._queue = collections.deque()
+		self._free_slots = list(range(max_workers))
+		self.slices = 0
+		self.total_wait_time = 0.0
+		self.max_wait_time = 0.0
+		self.last_wait_time = 0.0
+		self.cpu_time = 0.0  # of the finished slicers, in seconds
+		self.exit_codes = dict()  # returncode: count
+
+	def _cpus_of_slot(self, slot):
+		"""Distribute the cpus round-robin on the slots, each slot gets at least one cpu."""
+		if not self.cpus:
+			return None
+		return [cpu for i, cpu in enumerate(self.cpus) if i % self.max_workers == slot] or \
+			[self.cpus[slot % len(self.cpus)]]
+
+	@contextmanager
+	def _slot(self, job):
+		ticket = object()
+		enqueued = time.time()
+		with self._cond:
+			self._queue.append(ticket)
+			try:
+				while self._queue[0] is not ticket or not self._free_slots:
+					self._cond.wait(timeout=1.0)
+					job.check_cancelled()
+			except BaseException:
+				self._queue.remove(ticket)
+				self._cond.notify_all()
+				raise
+			self._queue.popleft()
+			slot = self._free_slots.pop(0)
+			wait_time = time.time() - enqueued
+			self.slices += 1
+			self.total_wait_time += wait_time
+			self.max_wait_time = max(self.max_wait_time, wait_time)
+			self.last_wait_time = wait_time
+			# the next one in the queue might get a slot as well
+			self._cond.notify_all()
+		logger.info(f"Got slicer slot {slot} after waiting {wait_time:.2f} s")
+		try:
+			yield slot
+		finally:
+			with self._cond:
+				self._free_slots.append(slot)
+				self._cond.notify_all()
+
+	def slice(self, model_paths, profile_path, gcode_path, job, on_line=None, bed_shape=None):
+		"""Slice the models with the profile into gcode_path once a slot is free, see run_process for the return.
+		Multiple models are arranged on the bed and merged, so that they are sliced into a single machine code."""
+		if not self.slicer_path:
+			raise JobError("The slicer can't be found, the slicing functionality can't be used")
+		cmd = [self.slicer_path, "--export-gcode", "--repair", *model_paths, "--load", profile_path]
+		if len(model_paths) > 1:
+			cmd.append("--merge")
+		if bed_shape:
+			cmd += ["--bed-shape", bed_shape]
+		cmd += ["--output", gcode_path]
+		with self._slot(job) as slot:
+			logger.info(f"Slicing the model with the command: '{' '.join(cmd)}'")
+			returncode, response, rusage = run_process(cmd, job, on_line=on_line, cpus=self._cpus_of_slot(slot), nice=self.nice)
+		with self._cond:
+			self.cpu_time += rusage.ru_utime + rusage.ru_stime
+			self.exit_codes[returncode] = self.exit_codes.get(returncode, 0) + 1
+		return returncode, response
+
+	def stats(self):
+		with self._cond:
+			return dict(workers=self.max_workers, running=self.max_workers - len(self._free_slots),
+						queued=len(self._queue), slices=self.slices, last_wait_time=self.last_wait_time,
+						max_wait_time=self.max_wait_time, total_wait_time=self.total_wait_time,
+						mean_wait_time=self.total_wait_time / self.slices if self.slices else None,
+						cpus=self.cpus, nice=self.nice, cpu_time=self.cpu_time, exit_codes=dict(self.exit_codes))
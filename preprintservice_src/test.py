@@ -0,0 +1,647 @@
+#!/usr/bin/env python3
+"""Unit tests of the modules of the PrePrintService, run with: python3 -m unittest discover -p '*test.py'"""
+import io
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+import zipfile
+import threading
+import unittest
+import unittest.mock
+from types import SimpleNamespace
+
+import numpy as np
+import requests
+
+# the modules of the service import each other as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from compression import compressed_copy, decompress_request_body
+from delivery import DeliveryQueue
+from result_cache import ResultCache, make_cache_key, make_orientation_key
+from jobs import JobManager, JobQueueFull, JobError
+import mesh
+from workspace import Workspace
+import orientation
+
+
+def _folder_size(path):
+	return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+class TempDirTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self.d = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.d, ignore_errors=True)
+
+	def write(self, name, content):
+		path = os.path.join(self.d, name)
+		with open(path, "wb") as f:
+			f.write(content)
+		return path
+
+
+class TestResultCache(TempDirTestCase):
+
+	def testKeyDependsOnAllParts(self):
+		model = self.write("model.stl", b"model")
+		profile = self.write("profile.ini", b"profile")
+		key = make_cache_key(model, profile, "tweak_extended_volume", "2.6")
+		self.assertEqual(key, make_cache_key(model, profile, "tweak_extended_volume", "2.6"))
+		self.assertNotEqual(key, make_cache_key(model, None, "tweak_extended_volume", "2.6"))
+		self.assertNotEqual(key, make_cache_key(model, profile, "tweak_fast_volume", "2.6"))
+		self.assertNotEqual(key, make_cache_key(model, profile, "tweak_extended_volume", "2.7"))
+		self.assertNotEqual(key, make_cache_key(model, profile, "tweak_extended_volume", "2.6", "tweaker 1"))
+
+	def testOrientationKeyDependsOnAllParts(self):
+		model = self.write("model.stl", b"model")
+		key = make_orientation_key(model, True, False, "tweaker 1")
+		self.assertEqual(key, make_orientation_key(model, True, False, "tweaker 1"))
+		self.assertNotEqual(key, make_orientation_key(self.write("other.stl", b"other"), True, False, "tweaker 1"))
+		self.assertNotEqual(key, make_orientation_key(model, False, False, "tweaker 1"))
+		self.assertNotEqual(key, make_orientation_key(model, True, True, "tweaker 1"))
+		self.assertNotEqual(key, make_orientation_key(model, True, False, "tweaker 2"))
+		self.assertNotEqual(key, make_orientation_key(model, True, False, "tweaker 1, proxy 50000"))
+
+	def testPutAndGet(self):
+		cache = ResultCache(os.path.join(self.d, "cache"), 1000)
+		model = self.write("model.stl", b"x" * 10)
+		self.assertIsNone(cache.get("a"))
+		cached = cache.put("a", dict(model=model))
+		self.assertEqual(cache.get("a"), cached)
+		with open(cached["model"], "rb") as f:
+			self.assertEqual(f.read(), b"x" * 10)
+		self.assertTrue(os.path.exists(model))  # the given files are left untouched
+		self.assertEqual(cache.size, _folder_size(os.path.dirname(cached["model"])))
+		self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+	def testEvictsLeastRecentlyUsed(self):
+		cache = ResultCache(os.path.join(self.d, "cache"), 75)
+		model = self.write("model.stl", b"x" * 10)
+		cache.put("a", dict(model=model))
+		cache.put("b", dict(model=model))
+		cache.get("a")  # b is the least recently used now
+		cache.put("c", dict(model=model))
+		self.assertIsNotNone(cache.get("a"))
+		self.assertIsNone(cache.get("b"))
+		self.assertIsNotNone(cache.get("c"))
+		self.assertEqual(cache.size, sum(_folder_size(os.path.join(self.d, "cache", key)) for key in "ac"))
+		self.assertEqual(cache.evictions, 1)
+		self.assertFalse(os.path.exists(os.path.join(self.d, "cache", "b")))
+
+	def testRejectsTooLargeResults(self):
+		cache = ResultCache(os.path.join(self.d, "cache"), 5)
+		self.assertIsNone(cache.put("a", dict(model=self.write("model.stl", b"x" * 10))))
+		self.assertEqual(cache.size, 0)
+
+	def testReloadsFromDisk(self):
+		folder = os.path.join(self.d, "cache")
+		cache = ResultCache(folder, 1000)
+		cache.put("a", dict(model=self.write("model.stl", b"x" * 10)))
+		os.makedirs(os.path.join(folder, ".tmp-interrupted"))
+		size = cache.size
+		cache = ResultCache(folder, 1000)
+		self.assertIsNotNone(cache.get("a"))
+		self.assertEqual(cache.size, size)
+		self.assertFalse(os.path.exists(os.path.join(folder, ".tmp-interrupted")))
+
+	def testCountsCompressedCopies(self):
+		cache = ResultCache(os.path.join(self.d, "cache"), 10000)
+		cached = cache.put("a", dict(model=self.write("model.stl", b"solid x\n" * 100)))
+		size = cache.size
+		copy = compressed_copy(cached["model"], "gzip")
+		self.assertTrue(cache.update_size(copy))
+		self.assertEqual(cache.size, size + os.path.getsize(copy))
+		self.assertTrue(cache.update_size(self.write("outside.gz", b"x")))
+
+	def testDropsCompressedCopiesThatDontFit(self):
+		cache = ResultCache(os.path.join(self.d, "cache"), 1000)
+		cached = cache.put("a", dict(model=self.write("model.stl", b"x")))
+		cache.max_size = cache.size  # the entry fits exactly, its compressed copy doesn't
+		copy = compressed_copy(cached["model"], "gzip")
+		self.assertFalse(cache.update_size(copy))
+		self.assertFalse(os.path.exists(copy))
+		self.assertIsNotNone(cache.get("a"))
+
+	def testDisabled(self):
+		cache = ResultCache(os.path.join(self.d, "cache"), 0)
+		self.assertIsNone(cache.put("a", dict(model=self.write("model.stl", b"x"))))
+		self.assertIsNone(cache.get("a"))
+		self.assertFalse(os.path.exists(os.path.join(self.d, "cache")))
+
+
+class TestDecompression(unittest.TestCase):
+
+	def environ(self, body):
+		data = gzip.compress(body)
+		return {"HTTP_CONTENT_ENCODING": "gzip", "CONTENT_LENGTH": str(len(data)), "wsgi.input": io.BytesIO(data)}
+
+	def testDecompressesWithinTheLimit(self):
+		environ = self.environ(b"x" * 1000)
+		self.assertTrue(decompress_request_body(environ, 1000))
+		self.assertEqual(environ["wsgi.input"].read(), b"x" * 1000)
+
+	def testLimitsTheDecompressedSize(self):
+		environ = self.environ(b"\0" * 1000000)  # about 1 kB compressed
+		self.assertTrue(decompress_request_body(environ, 100000))
+		with self.assertRaises(RequestEntityTooLarge):
+			while environ["wsgi.input"].read(64 * 1024):
+				pass
+
+	def testRejectsUnknownEncodings(self):
+		self.assertFalse(decompress_request_body({"HTTP_CONTENT_ENCODING": "br", "wsgi.input": io.BytesIO()}, 10))
+
+
+# a tetrahedron with the corners (0, 0, 0), (10, 0, 0), (0, 10, 0) and (0, 0, 10)
+TETRAHEDRON = np.array([[[0, 0, 0], [0, 10, 0], [10, 0, 0]], [[0, 0, 0], [10, 0, 0], [0, 0, 10]],
+						[[0, 0, 0], [0, 0, 10], [0, 10, 0]], [[10, 0, 0], [0, 10, 0], [0, 0, 10]]], np.float32)
+
+ASCII_STL = b"""solid tetrahedron
+  facet normal 0 0 -1
+    outer loop
+      vertex 0 0 0
+      vertex 0 1e1 0
+      vertex 10.0 0 0
+    endloop
+  endfacet
+  facet normal 0 -1 0
+    outer loop
+      vertex 0 0 0
+      vertex 10 0 0
+      vertex 0 0 10
+    endloop
+  endfacet
+  facet normal -1 0 0
+    outer loop
+      vertex 0 0 0
+      vertex 0 0 10
+      vertex 0 10 0
+    endloop
+  endfacet
+  facet normal 0.577 0.577 0.577
+    outer loop
+      vertex 10 0 0
+      vertex 0 10 0
+      vertex 0 0 10
+    endloop
+  endfacet
+endsolid tetrahedron
+"""
+
+# the same tetrahedron with a texture, normals and negative indices, its base is a quad of two triangles
+OBJ = b"""# tetrahedron
+v 0 0 0
+v 10 0 0
+vt 0 0
+vn 0 0 1
+v 0 10 0 1.0
+f 1/1/1 3/1/1 2/1/1
+v 0 0 10
+f -4 -3 -1
+f 1//1 4//1 3//1
+f 2 3 4
+"""
+
+MODEL_3MF = b"""<?xml version="1.0" encoding="UTF-8"?>
+<model unit="centimeter" xmlns="http://schemas.microsoft.com/3dmanufacturing/core/2015/02">
+  <resources>
+    <object id="1" type="model">
+      <mesh>
+        <vertices>
+          <vertex x="0" y="0" z="0"/><vertex x="1" y="0" z="0"/><vertex x="0" y="1" z="0"/><vertex x="0" y="0" z="1"/>
+        </vertices>
+        <triangles>
+          <triangle v1="0" v2="2" v3="1"/><triangle v1="0" v2="1" v3="3"/><triangle v1="0" v2="3" v3="2"/>
+          <triangle v1="1" v2="2" v3="3"/>
+        </triangles>
+      </mesh>
+    </object>
+    <object id="2" type="model">
+      <components><component objectid="1" transform="1 0 0 0 1 0 0 0 1 2 0 0"/></components>
+    </object>
+  </resources>
+  <build><item objectid="2" transform="1 0 0 0 1 0 0 0 1 0 3 0"/></build>
+</model>
+"""
+
+
+def _sphere(n, radius):
+	"""Return the triangles of a sphere tessellated by n rings, many of them are degenerate at the poles."""
+	u, v = np.meshgrid(np.linspace(0, np.pi, n), np.linspace(0, 2 * np.pi, 2 * n))
+	points = np.stack([np.sin(u) * np.cos(v), np.sin(u) * np.sin(v), np.cos(u)], axis=-1) * radius
+	a, b, c, d = points[:-1, :-1], points[1:, :-1], points[1:, 1:], points[:-1, 1:]
+	return np.concatenate([np.stack([a, b, c], axis=-2), np.stack([a, c, d], axis=-2)]).reshape(-1, 3, 3)
+
+
+class TestMesh(TempDirTestCase):
+
+	def testReadsAsciiStl(self):
+		np.testing.assert_array_equal(mesh._read_stl(ASCII_STL), TETRAHEDRON)
+
+	def testReadsAsciiStlInChunks(self):
+		with unittest.mock.patch.object(mesh, "TEXT_CHUNK_SIZE", 10):
+			np.testing.assert_array_equal(mesh._read_stl(ASCII_STL), TETRAHEDRON)
+
+	def testRejectsInvalidAsciiStl(self):
+		with self.assertRaises(ValueError):
+			mesh._read_stl(ASCII_STL.replace(b"vertex 10 0 0", b"vertex 1O 0 0"))
+		with self.assertRaises(ValueError):
+			mesh._read_stl(ASCII_STL.replace(b"vertex 0 0 10\n", b"", 1))
+
+	def testReadsBinaryStl(self):
+		path = os.path.join(self.d, "model.stl")
+		mesh.write_binary_stl(path, TETRAHEDRON)
+		self.assertEqual(mesh.count_triangles(path), 4)
+		np.testing.assert_array_equal(mesh.load_triangles(path), TETRAHEDRON)
+
+	def testReadsObj(self):
+		for chunk_size in [mesh.TEXT_CHUNK_SIZE, 10]:
+			with unittest.mock.patch.object(mesh, "TEXT_CHUNK_SIZE", chunk_size):
+				np.testing.assert_array_equal(mesh._read_obj(OBJ), TETRAHEDRON)
+
+	def testTriangulatesPolygonsOfObj(self):
+		triangles = mesh._read_obj(b"v 0 0 0\nv 1 0 0\nv 1 1 0\nv 0 1 0\nf 1 2 3 4\n")
+		np.testing.assert_array_equal(triangles, [[[0, 0, 0], [1, 0, 0], [1, 1, 0]], [[0, 0, 0], [1, 1, 0], [0, 1, 0]]])
+
+	def testRejectsInvalidObjIndices(self):
+		with self.assertRaises(ValueError):
+			mesh._read_obj(b"v 0 0 0\nf 0 1 1\n")
+
+	def testReads3mf(self):
+		path = os.path.join(self.d, "model.3mf")
+		with zipfile.ZipFile(path, "w") as archive:
+			archive.writestr("3D/3dmodel.model", MODEL_3MF)
+		# the tetrahedron is scaled from cm to mm and moved by both transforms
+		np.testing.assert_allclose(mesh.load_triangles(path), TETRAHEDRON + [20, 30, 0])
+
+	def testMergesVerticesAndDropsDegenerateTriangles(self):
+		triangles = np.concatenate([TETRAHEDRON, [[[0, 0, 0], [5, 0, 0], [10, 0, 0]],  # no area
+												  [[0, 0, 0], [0, 0, 0], [0, 10, 0]],  # a shared vertex
+												  [[-0.0, 0, 0], [10, 0, 0], [0, 0, 10]]]]).astype(np.float32)
+		vertices, faces = mesh.clean_mesh(triangles)
+		self.assertEqual(len(vertices), 5)  # the corners, the center of an edge and -0.0 is 0.0
+		np.testing.assert_array_equal(vertices[faces], np.concatenate([TETRAHEDRON, TETRAHEDRON[1:2]]))
+
+	def testDecimationStaysWithinTheBudget(self):
+		sphere = _sphere(50, 20)
+		for max_triangles in [50, 500, 2000]:
+			proxy, cell_size = mesh.decimate(sphere, max_triangles)
+			self.assertLessEqual(len(proxy), max_triangles)
+			self.assertGreater(len(proxy), max_triangles / 4)
+			self.assertGreater(cell_size, 0)
+			# the merged vertices stay within their cells, which deviate by at most the diagonal from the surface
+			radii = np.linalg.norm(proxy.reshape(-1, 3), axis=1)
+			self.assertLessEqual(np.abs(radii - 20).max(), np.sqrt(3) * cell_size)
+
+	def testDecimationKeepsSmallMeshes(self):
+		proxy, cell_size = mesh.decimate(TETRAHEDRON, 4)
+		np.testing.assert_array_equal(proxy, TETRAHEDRON)
+		self.assertEqual(cell_size, 0)
+
+	def testNormalisesModels(self):
+		path = self.write("model.stl", ASCII_STL)
+		self.assertEqual(mesh.normalise_model(path, path), (4, 4))
+		np.testing.assert_array_equal(mesh.load_triangles(path), TETRAHEDRON)
+		with self.assertRaises(ValueError):
+			mesh.normalise_model(self.write("empty.obj", b"v 0 0 0\n"), path)
+
+
+class TestJobManager(unittest.TestCase):
+
+	def setUp(self):
+		self.done = list()
+		self.notified = threading.Event()
+		self.manager = JobManager(1, 1, 60, on_done=lambda job: (self.done.append(job), self.notified.set()))
+
+	def testLifecycle(self):
+		def work(value, job=None):
+			job.set_progress("slicing", 0.5, "half")
+			return value * 2
+		job = self.manager.submit("double", work, 21)
+		self.assertTrue(job.wait(5))
+		self.assertEqual((job.status, job.result, job.error), ("finished", 42, None))
+		self.assertIn("slicing", job.stages)
+		self.assertGreater(job.version, 0)
+		self.assertIs(self.manager.get(job.id), job)
+		self.assertTrue(self.notified.wait(5))  # right after the job is done
+		self.assertEqual(self.done, [job])
+
+	def testFailure(self):
+		def fail(job=None):
+			raise JobError("slicer failed")
+		job = self.manager.submit("fail", fail)
+		job.wait(5)
+		self.assertEqual((job.status, job.error), ("failed", "slicer failed"))
+
+	def testCancelRunningJob(self):
+		started, proceed = threading.Event(), threading.Event()
+		def work(job=None):
+			started.set()
+			proceed.wait(5)
+			job.set_progress("slicing")  # raises as the job was cancelled
+			return "never"
+		job = self.manager.submit("cancel", work)
+		started.wait(5)
+		job.cancel()
+		proceed.set()
+		job.wait(5)
+		self.assertEqual((job.status, job.result), ("cancelled", None))
+
+	def testQueueIsBoundedAndCleanupRunsForCancelledJobs(self):
+		proceed = threading.Event()
+		cleaned = list()
+		running = self.manager.submit("block", lambda job=None: proceed.wait(5))
+		queued = self.manager.submit("queued", lambda job=None: "never", cleanup=cleaned.append)
+		with self.assertRaises(JobQueueFull):
+			self.manager.submit("too many", lambda job=None: None)
+		queued.cancel()
+		proceed.set()
+		self.assertTrue(queued.wait(5))
+		self.assertEqual(queued.status, "cancelled")
+		self.assertEqual(cleaned, [queued])  # before the job is reported as done
+		running.wait(5)
+
+	def testWaitForChange(self):
+		job = self.manager.submit("quick", lambda job=None: None)
+		job.wait(5)
+		version = job.version
+		job.wait_for_change(version, 0.01)  # returns after the timeout without a change
+		self.assertEqual(job.version, version)
+
+class TestWorkspace(TempDirTestCase):
+
+	def setUp(self):
+		super().setUp()
+		self.workspace = Workspace(os.path.join(self.d, "work"), 0, -1)  # every released directory is expired
+
+	def create(self):
+		path = self.workspace.create()
+		self.addCleanup(self.workspace.remove, path)
+		return path
+
+	def testJanitorSkipsActiveDirectories(self):
+		active, released = self.create(), self.create()
+		result = os.path.join(released, "result.gcode")
+		with open(result, "w") as f:
+			f.write("G28")
+		self.workspace.release(released, keep=result)
+		self.assertEqual(os.listdir(released), ["result.gcode"])
+		self.workspace.clean()
+		self.assertTrue(os.path.isdir(active))
+		self.assertFalse(os.path.exists(released))
+		self.assertEqual(self.workspace.removed, 1)
+
+	def testJanitorOfAnotherProcessSkipsActiveDirectories(self):
+		active = self.create()
+		other = Workspace(os.path.join(self.d, "work"), 0, -1)  # knows nothing about the directories of the first
+		other.clean()
+		self.assertTrue(os.path.isdir(active))
+		self.workspace.release(active)
+		self.assertFalse(os.path.exists(active))
+
+	def testJanitorEnforcesTheQuota(self):
+		self.workspace.max_age, self.workspace.quota = 3600, 10
+		paths = list()
+		for i in range(3):
+			path = self.create()
+			result = os.path.join(path, "result.gcode")
+			with open(result, "w") as f:
+				f.write("x" * 6)
+			os.utime(path, (i, i))  # the first one is the oldest
+			paths.append(path)
+		self.workspace.release(paths[0], keep=os.path.join(paths[0], "result.gcode"))
+		os.utime(paths[0], (0, 0))
+		with self.assertLogs("workspace", "WARNING"):
+			self.assertEqual(self.workspace.clean(), 12)  # the active ones exceed the quota, but are kept
+		self.assertEqual([os.path.exists(path) for path in paths], [False, True, True])
+
+
+
+class FakeSession:
+	"""Session that answers the posts with the given status codes in turn, exceptions are raised instead."""
+
+	def __init__(self, responses):
+		self.responses = list(responses)
+		self.posts = list()
+
+	def post(self, url, files=None, timeout=None):
+		name, f = files["file"]
+		self.posts.append((url, name, f.read()))
+		response = self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+		if isinstance(response, Exception):
+			raise response
+		return SimpleNamespace(status_code=response)
+
+
+class TestDeliveryQueue(TempDirTestCase):
+
+	def deliver(self, *responses):
+		"""Deliver a model to a fake OctoPrint with the responses and return the delivery once it is done."""
+		self.session = FakeSession(responses)
+		done = threading.Event()
+		self.queue = DeliveryQueue(os.path.join(self.d, "deliveries"), SimpleNamespace(get=lambda url: self.session),
+								   1, 1, 3, 0.01, 0.02, 60, on_done=lambda delivery: done.set())
+		model = self.write("model.stl", b"solid model")
+		delivery = self.queue.submit("0" * 32, "http://octoprint/", "key", "model_tweaked.stl", model)
+		self.assertTrue(done.wait(5))
+		self.assertIs(self.queue.get("0" * 32), delivery)
+		self.assertFalse(os.path.exists(delivery.path))
+		return delivery
+
+	def testDelivers(self):
+		delivery = self.deliver(201)
+		self.assertEqual((delivery.status, delivery.attempts, delivery.error), ("delivered", 1, None))
+		self.assertEqual(self.session.posts, [("http://octoprint/api/files/local?apikey=key", "model_tweaked.stl",
+											   b"solid model")])
+
+	def testRetriesFailedConnectionsAndServerErrors(self):
+		delivery = self.deliver(requests.ConnectionError("refused"), 503, 201)
+		self.assertEqual((delivery.status, delivery.attempts), ("delivered", 3))
+		self.assertEqual(self.queue.stats()["retries"], 2)
+
+	def testGivesUpAfterMaxAttempts(self):
+		delivery = self.deliver(503)
+		self.assertEqual((delivery.status, delivery.attempts, delivery.status_code), ("failed", 3, 503))
+		self.assertIn("503", delivery.error)
+		self.assertEqual(self.queue.stats()["failed"], 1)
+
+	def testDoesNotRetryClientErrors(self):
+		delivery = self.deliver(401)
+		self.assertEqual((delivery.status, delivery.attempts), ("failed", 1))
+
+	def testRemovesOnlyItsOwnOrphans(self):
+		folder = os.path.join(self.d, "deliveries")
+		os.makedirs(os.path.join(folder, "1" * 32))
+		for name in ["2" * 32 + ".stl", "3" * 32, "notes.txt"]:
+			self.write(os.path.join("deliveries", name), b"x")
+		with self.assertLogs("delivery", "WARNING"):  # the directory can't be removed like a file
+			DeliveryQueue(folder, None, 1, 0, 3, 0.01, 0.02, 60)
+		self.assertEqual(sorted(os.listdir(folder)), ["1" * 32, "notes.txt"])
+
+
+class TestTweakerWorker(unittest.TestCase):
+
+	def setUp(self):
+		self.written = list()
+		file_handler = SimpleNamespace(load_mesh=lambda path: {0: dict(mesh=[[0, 0, 0]] * 3)},
+									   write_mesh=lambda *args: self.written.append(args))
+		self.stats = SimpleNamespace(matrix=[[1, 0, 0], [0, 1, 0], [0, 0, 1]], unprintability=1.5, bottom_area=2.0,
+									 overhang_area=0.5, contour=1.0)
+		patcher = unittest.mock.patch.multiple(orientation, create=True,
+											   FileHandler=SimpleNamespace(FileHandler=lambda: file_handler),
+											   MeshTweaker=SimpleNamespace(Tweak=lambda *args: self.stats))
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def testReportsTheMetricsOfTweaker(self):
+		result = orientation._orient("in.stl", "out.stl", True, True)
+		self.assertEqual((result["unprintability"], result["bottom_area"], result["overhang"], result["contour"]),
+						 (1.5, 2.0, 0.5, 1.0))
+		self.assertEqual(len(self.written), 1)
+
+	def testFailsOnRenamedAttributes(self):
+		del self.stats.overhang_area
+		self.stats.overhang = 0.5
+		with self.assertRaises(AttributeError):
+			orientation._orient("in.stl", "out.stl", True, True)
+
+
+def _frustum(base, top, height):
+	"""Return the 12 triangles of a frustum of a square pyramid standing on its base, the normals point outwards."""
+	offset = (base - top) / 2
+	corners = np.array([[0, 0, 0], [base, 0, 0], [base, base, 0], [0, base, 0], [offset, offset, height],
+						[offset + top, offset, height], [offset + top, offset + top, height],
+						[offset, offset + top, height]], np.float64)
+	quads = [[0, 3, 2, 1], [4, 5, 6, 7], [0, 1, 5, 4], [1, 2, 6, 5], [2, 3, 7, 6], [3, 0, 4, 7]]
+	return np.array([corners[[q[0], q[i], q[i + 1]]] for q in quads for i in (1, 2)])
+
+
+def _rotate(triangles, x_angle, y_angle):
+	"""Return the triangles rotated by the angles in degrees about the x- and then the y-axis."""
+	a, b = np.radians([x_angle, y_angle])
+	rx = np.array([[1, 0, 0], [0, np.cos(a), -np.sin(a)], [0, np.sin(a), np.cos(a)]])
+	ry = np.array([[np.cos(b), 0, np.sin(b)], [0, 1, 0], [-np.sin(b), 0, np.cos(b)]])
+	return triangles @ (ry @ rx).T
+
+
+def _subdivide(triangles, times):
+	"""Return the triangles split into 4 ** times triangles each, by their edge midpoints."""
+	for _ in range(times):
+		a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+		ab, bc, ca = (a + b) / 2, (b + c) / 2, (c + a) / 2
+		triangles = np.concatenate([np.stack(corners, axis=1)
+									for corners in [(a, ab, ca), (ab, b, bc), (ca, bc, c), (ab, bc, ca)]])
+	return triangles
+
+
+def _bottom(triangles):
+	"""Return the face normal with the largest cumulated area, which Tweaker-3 considers first for the bottom."""
+	normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+	areas = np.linalg.norm(normals, axis=1)
+	normals = np.round(normals / areas[:, None], 3) + 0.0
+	unique, inverse = np.unique(normals, axis=0, return_inverse=True)
+	best = unique[np.argmax(np.bincount(inverse.ravel(), weights=areas))]
+	return best / np.linalg.norm(best)
+
+
+# finely meshed models with a unique best bottom, which the proxies must keep
+PROXY_MESHES = dict(
+	frustum=_subdivide(_frustum(40, 20, 10), 5),
+	tilted_frustum=_subdivide(_rotate(_frustum(40, 20, 10), 30, 70), 5),
+	steep_frustum=_subdivide(_rotate(_frustum(40, 10, 30), 120, 20), 5),
+)
+
+
+class TestOrientationProxy(TempDirTestCase):
+
+	def setUp(self):
+		super().setUp()
+		patcher = unittest.mock.patch.object(orientation.OrientationPool, "_start")
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.pool = orientation.OrientationPool("Tweaker-3", 1, proxy_triangles=2000)
+		self.oriented = list()
+		self.pool._run = self.run_tweaker
+
+	def run_tweaker(self, calls, job, poll_interval):
+		(_, input_path, output_path, _, _), = calls
+		self.oriented.append(mesh.load_triangles(input_path).copy())
+		matrix = [[1.0, 0.0, 0.0], [0.0, 0.0, -1.0], [0.0, 1.0, 0.0]]
+		mesh.rotate_model(input_path, output_path, matrix)
+		return [dict(matrix=matrix, unprintability=1.5, bottom_area=2.0, overhang=0.5, contour=1.0, cpu_time=0.25)]
+
+	def orient(self, triangles):
+		input_path = os.path.join(self.d, "model.stl")
+		mesh.write_binary_stl(input_path, triangles)
+		output_path = os.path.join(self.d, "tweaked.stl")
+		return self.pool.orient(input_path, output_path, True, True, None), mesh.load_triangles(output_path)
+
+	def testKeepsTheBottom(self):
+		for name, triangles in PROXY_MESHES.items():
+			for max_triangles in [500, 2000]:
+				with self.subTest(name=name, max_triangles=max_triangles):
+					proxy, _ = mesh.decimate(triangles, max_triangles)
+					self.assertGreater(_bottom(proxy) @ _bottom(triangles), np.cos(np.radians(1)))
+
+	def testRotatesTheFullMeshByTheOrientationOfTheProxy(self):
+		triangles = PROXY_MESHES["tilted_frustum"].astype(np.float32)
+		result, tweaked = self.orient(triangles)
+		proxy, = self.oriented
+		self.assertLessEqual(len(proxy), 2000)
+		self.assertEqual(result["proxy"]["triangles"], len(proxy))
+		self.assertGreater(result["proxy"]["cell_size"], 0)
+		self.assertGreaterEqual(result["cpu_time"], 0.25)
+		np.testing.assert_allclose(tweaked, triangles @ np.array(result["matrix"], np.float32), atol=1e-4)
+		self.assertEqual(sorted(os.listdir(self.d)), ["model.stl", "tweaked.stl"])
+		self.assertEqual(self.pool.stats()["orientations"], 1)
+
+	def testOrientsSmallMeshesInFull(self):
+		result, _ = self.orient(TETRAHEDRON)
+		self.assertNotIn("proxy", result)
+		self.assertEqual(len(self.oriented[0]), len(TETRAHEDRON))
+
+
+def _load_tweaker():
+	"""Return the module MeshTweaker of Tweaker-3 in TWEAKER_PATH, or None if it is missing or no real Tweaker-3."""
+	path = os.environ.get("TWEAKER_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "Tweaker-3"))
+	if not os.path.isfile(os.path.join(path, "MeshTweaker.py")):
+		return None
+	sys.path.insert(0, path)
+	try:
+		import MeshTweaker
+	except ImportError:
+		return None
+	finally:
+		sys.path.remove(path)
+	# the search of Tweaker-3 starts with the cumulation of the areas of parallel faces
+	return MeshTweaker if hasattr(MeshTweaker.Tweak, "area_cumulation") else None
+
+
+MeshTweaker = _load_tweaker()
+
+
+@unittest.skipIf(MeshTweaker is None, "Tweaker-3 is not available in TWEAKER_PATH")
+class TestOrientationProxyWithTweaker(unittest.TestCase):
+	"""Tweaker-3 must put the same face of the reference meshes on the bed, whether it orients them or their proxies."""
+
+	def bottom(self, triangles, extended_mode):
+		tweak = MeshTweaker.Tweak(triangles.reshape(-1, 3), extended_mode, False, False, None, True)
+		# the face normal that Tweaker-3 puts on the bed, its matrix is applied to row vectors
+		return np.array([0.0, 0.0, -1.0]) @ np.asarray(tweak.matrix, np.float64).T
+
+	def testKeepsTheBottomOfTweaker(self):
+		for name, triangles in PROXY_MESHES.items():
+			for extended_mode in [False, True]:
+				with self.subTest(name=name, extended_mode=extended_mode):
+					proxy, _ = mesh.decimate(triangles, 2000)
+					self.assertGreater(self.bottom(proxy, extended_mode) @ self.bottom(triangles, extended_mode),
+									   np.cos(np.radians(2)))
+
+
+if __name__ == '__main__':
+	unittest.main()
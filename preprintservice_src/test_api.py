@@ -1,5 +1,7 @@
 import os
 import json
+import hashlib
+import time
 import requests
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -64,4 +66,63 @@ r = requests.post(url, files={
 print(f"Testing tweak option: tweak_extended_volume+slicing, statuscode {r.status_code}")
 assert r.status_code
 
+r = requests.post(url, files={
+    'model': open(model_path, 'rb'),
+    'profile': open('preprintservice_src/profiles/profile_015mm_brim.ini', 'rb')
+    },
+    data={
+    "machinecode_name": output_path,
+    "tweak_option": "tweak_extended_volume"
+    })
+print(f"Testing the cached result of tweak_extended_volume+slicing, statuscode {r.status_code}")
+assert r.status_code == 200
+orientation = json.loads(r.headers["X-PrePrint-Analysis"])["orientation"]
+assert orientation["cached"] and orientation["cpu_time"] == 0
+
+
+print("\n########### Testing the Job API ###########")
+
+r = requests.post(url.replace("/tweak", "/jobs"),
+                  files={'model': open(model_path, 'rb')},
+                  data={"tweak_option": "tweak_fast_volume"})
+print(f"Testing job creation, statuscode {r.status_code}")
+assert r.status_code == 202
+job_url = url.replace("/tweak", r.headers["Location"])
+for _ in range(600):
+    r = requests.get(job_url)
+    assert r.status_code == 200
+    if r.json()["status"] not in ["queued", "running"]:
+        break
+    time.sleep(1)
+print(f"Testing job status, status {r.json()['status']}")
+assert r.json()["status"] == "finished"
+r = requests.get(job_url + "/result")
+print(f"Testing job result, statuscode {r.status_code}")
+assert r.status_code == 200
+assert "orientation" in json.loads(r.headers["X-PrePrint-Analysis"])
+assert r.headers.get("Content-Encoding") == "gzip"  # requests accepts and decodes gzip by default
+
+print("\n########### Testing the Batch API ###########")
+
+r = requests.post(url.replace("/tweak", "/batch"),
+                  files=[('model', open(model_path, 'rb')), ('model', open(model_path, 'rb'))],
+                  data={"tweak_option": "tweak_fast_volume", "response": "manifest"})
+print(f"Testing batch, statuscode {r.status_code}")
+assert r.status_code == 200
+assert [entry["status"] for entry in r.json()] == ["finished", "finished"]
+
+print("\n########### Testing the Profile Registry ###########")
+
+profile_path = 'preprintservice_src/profiles/profile_015mm_none.ini'
+with open(profile_path, 'rb') as f:
+    profile_hash = hashlib.sha256(f.read()).hexdigest()
+r = requests.put(url.replace("/tweak", f"/profiles/{profile_hash}"), data=open(profile_path, 'rb'))
+print(f"Testing profile upload, statuscode {r.status_code}")
+assert r.status_code in [200, 201]
+assert requests.head(url.replace("/tweak", f"/profiles/{profile_hash}")).status_code == 200
+r = requests.post(url.replace("/tweak", "/jobs"), files={'model': open(model_path, 'rb')},
+                  data={"tweak_option": "tweak_keep", "profile_hash": profile_hash})
+print(f"Testing job with profile hash, statuscode {r.status_code}")
+assert r.status_code == 202
+
 print("\nAll tests succeeded.")
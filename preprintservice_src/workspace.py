@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""Isolated work directories of the requests, with a janitor that enforces their maximal age and a disk quota.
+
+Each request saves its uploads and produces its intermediate files in its own directory, so that concurrent requests
+with the same filenames can't overwrite each other. Once the job is done, only its result is kept until it expires.
+
+The directories of running jobs hold an exclusive lock on their lock file, so that the janitors of other processes
+sharing the folder, e.g. the parent process of a reloader, leave them alone as well. The lock is released by the
+system if the process dies, so the directories of crashed processes expire as usual.
+"""
+import os
+import time
+import shutil
+import logging
+import tempfile
+import threading
+
+try:
+	import fcntl
+except ImportError:  # not on Windows, the directories are only protected within this process
+	fcntl = None
+
+PREFIX = "work-"
+LOCK_NAME = ".lock"
+
+logger = logging.getLogger(__name__)
+
+
+class WorkspaceFull(Exception):
+	"""Raised if the work directories of the running jobs exceed the disk quota."""
+
+
+def _dir_size(path):
+	size = 0
+	for root, _, files in os.walk(path):
+		for name in files:
+			try:
+				size += os.path.getsize(os.path.join(root, name))
+			except OSError:  # removed meanwhile
+				pass
+	return size
+
+
+def _lock(path):
+	"""Create the lock file of the work directory and return it with an exclusive lock held."""
+	lock = open(os.path.join(path, LOCK_NAME), "w")
+	if fcntl:
+		fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	return lock
+
+
+def _is_locked(path):
+	"""Return if the work directory is locked by a running job, of this or of another process."""
+	if not fcntl:
+		return False
+	try:
+		with open(os.path.join(path, LOCK_NAME)) as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except FileNotFoundError:
+		return False
+	except OSError:  # held by someone else
+		return True
+	return False
+
+
+class Workspace:
+	"""Create the work directories in folder, or in tmpfs_folder for requests of at most tmpfs_max_size bytes.
+	Released directories are removed by the janitor after max_age seconds, or earlier if the directories exceed
+	quota bytes in total, the oldest first. Directories of running jobs are never removed."""
+
+	def __init__(self, folder, quota, max_age, tmpfs_folder=None, tmpfs_max_size=0):
+		self.folder = folder
+		self.quota = quota  # in bytes, 0 disables the quota
+		self.max_age = max_age
+		self.tmpfs_folder = tmpfs_folder
+		self.tmpfs_max_size = tmpfs_max_size
+		self.removed = 0
+		self.size = 0  # of all work directories at the last cleaning
+		self._lock = threading.Lock()
+		self._clean_lock = threading.Lock()
+		self._active = dict()  # path: lock file
+		self._janitor = None
+		for path in [self.folder, self.tmpfs_folder]:
+			if path:
+				os.makedirs(path, exist_ok=True)
+
+	def create(self, size_hint=None):
+		"""Return the path of a new work directory, size_hint is the expected size of the upload."""
+		if self.quota and self.size > self.quota and self.clean() > self.quota:
+			raise WorkspaceFull(f"The work directories exceed the quota of {self.quota} bytes, retry later")
+		folder = self.folder
+		if self.tmpfs_folder and size_hint is not None and size_hint <= self.tmpfs_max_size:
+			folder = self.tmpfs_folder
+		# create, register and lock the directory at once, so that no janitor ever sees it unprotected
+		with self._lock:
+			path = tempfile.mkdtemp(prefix=PREFIX, dir=folder)
+			self._active[path] = _lock(path)
+		return path
+
+	def _unlock(self, path):
+		with self._lock:
+			lock = self._active.pop(path, None)
+		if lock:
+			lock.close()
+
+	def release(self, path, keep=None):
+		"""Remove the files of the work directory except the file keep, the directory itself is removed if nothing
+		is kept. Otherwise the janitor removes it once it expires."""
+		self._unlock(path)
+		if not keep or os.path.dirname(keep) != path:
+			self.remove(path)
+			return
+		for name in os.listdir(path):
+			if os.path.join(path, name) == keep:
+				continue
+			entry = os.path.join(path, name)
+			if os.path.isdir(entry):
+				shutil.rmtree(entry, ignore_errors=True)
+			else:
+				os.remove(entry)
+		os.utime(path)  # the retention starts now
+
+	def remove(self, path):
+		self._unlock(path)
+		shutil.rmtree(path, ignore_errors=True)
+
+	def _list(self):
+		"""Return the list of (mtime, path, size) of all work directories."""
+		entries = list()
+		for folder in {self.folder, self.tmpfs_folder} - {None}:
+			for name in os.listdir(folder):
+				path = os.path.join(folder, name)
+				if name.startswith(PREFIX) and os.path.isdir(path):
+					try:
+						entries.append((os.path.getmtime(path), path, _dir_size(path)))
+					except OSError:  # removed meanwhile
+						pass
+		return entries
+
+	def clean(self):
+		"""Remove the released work directories that are expired, and the oldest ones while the quota is exceeded.
+		Return the size of the remaining work directories."""
+		with self._clean_lock:
+			return self._clean()
+
+	def _clean(self):
+		entries = sorted(self._list())
+		size = sum(entry[2] for entry in entries)
+		threshold = time.time() - self.max_age
+		for mtime, path, entry_size in entries:
+			with self._lock:
+				if path in self._active:
+					continue
+			if _is_locked(path):
+				continue
+			if mtime < threshold or (self.quota and size > self.quota):
+				shutil.rmtree(path, ignore_errors=True)
+				size -= entry_size
+				self.removed += 1
+				logger.info(f"Removed the work directory '{path}' with {entry_size} bytes")
+		if self.quota and size > self.quota:
+			logger.warning(f"The work directories of the running jobs exceed the quota with {size} bytes")
+		self.size = size
+		return size
+
+	def start_janitor(self, interval):
+		"""Clean the work directories every interval seconds in a background thread."""
+		def run():
+			while True:
+				try:
+					self.clean()
+				except Exception:
+					logger.exception("Cleaning the work directories failed")
+				time.sleep(interval)
+		self._janitor = threading.Thread(target=run, name="janitor", daemon=True)
+		self._janitor.start()
+
+	def stats(self):
+		with self._lock:
+			active = len(self._active)
+		return dict(active=active, size=self.size, quota=self.quota, max_age=self.max_age, removed=self.removed,
+					folder=self.folder, tmpfs_folder=self.tmpfs_folder)